@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, Header, Depends, WebSocket, WebSocketDisconnect, Request, Body, File, UploadFile, Form
+import asyncio
 import secrets
 import time
 import hmac
@@ -14,17 +15,19 @@ except ImportError:
     print("Warning: pypdf module not found. PDF processing will be disabled.")
 
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional 
+from typing import List, Dict, Any, Optional, Tuple
 import sqlite3
 import io
 import csv
 from datetime import datetime, timedelta
-import warnings 
 import os
 import logging
 import uuid
 import shutil
 import json
+import threading
+import weakref
+from contextlib import contextmanager, asynccontextmanager
 import re
 from fastapi.staticfiles import StaticFiles
 import random
@@ -35,6 +38,96 @@ try:
     from backend.rbac_module import init_rbac_module, router as rbac_router
 except Exception:
     from rbac_module import init_rbac_module, router as rbac_router
+try:
+    from backend.db_pool import ConnectionPool, PoolTimeout, resolve_ipv4
+except Exception:
+    from db_pool import ConnectionPool, PoolTimeout, resolve_ipv4
+try:
+    from backend.db_async import AsyncConnection, DBExecutor
+except Exception:
+    from db_async import AsyncConnection, DBExecutor
+try:
+    from backend.db_indexes import index_by_name
+except Exception:
+    from db_indexes import index_by_name
+try:
+    from backend.migrations import MigrationRegistry
+except Exception:
+    from migrations import MigrationRegistry
+try:
+    from backend.ttl_cache import TTLCache
+except Exception:
+    from ttl_cache import TTLCache
+try:
+    from backend.recommendation_model import RecommendationModelManager
+except Exception:
+    from recommendation_model import RecommendationModelManager
+try:
+    from backend.db_bulk import chunked, insert_rows, sql_placeholders
+except Exception:
+    from db_bulk import chunked, insert_rows, sql_placeholders
+try:
+    from backend.email_transport import EmailSettings, EmailTransport, PermanentDeliveryError
+    from backend.outbox import CHANNEL_EMAIL, CHANNEL_MESSAGE, OutboxDispatcher, UndeliverableError, outbox_ddl
+    from backend.outbox import enqueue as outbox_enqueue
+except Exception:
+    from email_transport import EmailSettings, EmailTransport, PermanentDeliveryError
+    from outbox import CHANNEL_EMAIL, CHANNEL_MESSAGE, OutboxDispatcher, UndeliverableError, outbox_ddl
+    from outbox import enqueue as outbox_enqueue
+try:
+    from backend.llm_gateway import GroqProvider, LLMGateway, StubProvider, sse_events
+except Exception:
+    from llm_gateway import GroqProvider, LLMGateway, StubProvider, sse_events
+try:
+    from backend.response_cache import ResponseCache, context_fingerprint
+except Exception:
+    from response_cache import ResponseCache, context_fingerprint
+try:
+    from backend.course_retrieval import CHUNK_COLUMNS, CourseRetriever, chunks_ddl, module_chunk_rows
+except Exception:
+    from course_retrieval import CHUNK_COLUMNS, CourseRetriever, chunks_ddl, module_chunk_rows
+try:
+    from backend.resource_search import resource_search_ddl, search_resources
+except Exception:
+    from resource_search import resource_search_ddl, search_resources
+try:
+    from backend.sql_guard import GuardedQueryExecutor, QueryRejected, QueryTimeout
+except Exception:
+    from sql_guard import GuardedQueryExecutor, QueryRejected, QueryTimeout
+try:
+    from backend.batch_grading import BatchGrader, GradingItem
+except Exception:
+    from batch_grading import BatchGrader, GradingItem
+try:
+    from backend import gl_balances
+except Exception:
+    import gl_balances
+try:
+    from backend.doc_sequences import SequenceAllocator, sequences_ddl
+except Exception:
+    from doc_sequences import SequenceAllocator, sequences_ddl
+try:
+    from backend import gl_import
+except Exception:
+    import gl_import
+try:
+    from backend.depreciation import compute_charges, post_charges
+except Exception:
+    from depreciation import compute_charges, post_charges
+try:
+    from backend.prompt_budget import PromptAssembler, PromptSection, StaticPrefix, trim_to_tokens
+except Exception:
+    from prompt_budget import PromptAssembler, PromptSection, StaticPrefix, trim_to_tokens
+try:
+    from backend.quiz_feedback import QuizFeedbackWorker, feedback_jobs_ddl
+    from backend.quiz_feedback import enqueue as enqueue_quiz_feedback
+except Exception:
+    from quiz_feedback import QuizFeedbackWorker, feedback_jobs_ddl
+    from quiz_feedback import enqueue as enqueue_quiz_feedback
+try:
+    from backend.text_extraction import STATUS_DONE, STATUS_PENDING, TextExtractionService, content_hash, extraction_ddl
+except Exception:
+    from text_extraction import STATUS_DONE, STATUS_PENDING, TextExtractionService, content_hash, extraction_ddl
 try:
     import requests
     REQUESTS_IMPORT_ERROR = None
@@ -207,18 +300,84 @@ def send_email(to_email: str, subject: str, body: str):
         logger.error(f"[EMAIL] All email delivery attempts failed for {to_email}. Error: {e}")
         return False
 
+# --- NOTIFICATION OUTBOX ---
+# Handlers enqueue in-app messages and emails in their own transaction; the
+# dispatcher thread delivers them in batches with retries (see outbox.py).
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+OUTBOX_RESEND_RATE = float(os.getenv("OUTBOX_RESEND_RATE", "2"))
+OUTBOX_SMTP_RATE = float(os.getenv("OUTBOX_SMTP_RATE", "1"))
+
+EMAIL_TRANSPORT = EmailTransport(
+    EmailSettings(
+        smtp_email=SMTP_EMAIL,
+        smtp_password=SMTP_PASSWORD,
+        smtp_server=SMTP_SERVER,
+        smtp_port=SMTP_PORT,
+        resend_api_key=os.getenv("RESEND_API_KEY", ""),
+        resend_from=os.getenv("RESEND_FROM_EMAIL", SMTP_EMAIL),
+    ),
+    resend_rate=OUTBOX_RESEND_RATE,
+    smtp_rate=OUTBOX_SMTP_RATE,
+)
+
+MESSAGE_COLUMNS = ("sender_id", "receiver_id", "subject", "content", "timestamp", "is_read")
+
+def _deliver_outbox_messages(conn, items):
+    rows = [(i["sender_id"], i["recipient"], i["subject"], i["body"], i["created_at"], False) for i in items]
+    try:
+        insert_rows(conn, "messages", MESSAGE_COLUMNS, rows)
+        return {i["id"]: None for i in items}
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"[OUTBOX] Batch insert of {len(rows)} messages failed ({e}); retrying row by row")
+    # Isolate the bad rows (e.g. a receiver that no longer exists) so they do not block the rest.
+    results = {}
+    for item, row in zip(items, rows):
+        try:
+            insert_rows(conn, "messages", MESSAGE_COLUMNS, [row])
+            conn.commit()
+            results[item["id"]] = None
+        except Exception as e:
+            conn.rollback()
+            results[item["id"]] = UndeliverableError(str(e))
+    return results
+
+def _deliver_outbox_emails(conn, items):
+    """External channel: called with conn=None, outside any transaction."""
+    results = {}
+    for item in items:
+        try:
+            EMAIL_TRANSPORT.send(item["recipient"], item["subject"] or "", item["body"] or "")
+            results[item["id"]] = None
+        except Exception as e:
+            results[item["id"]] = e
+    return results
+
+OUTBOX_DISPATCHER = OutboxDispatcher(
+    connect=lambda: get_db_connection(),
+    handlers={CHANNEL_MESSAGE: _deliver_outbox_messages, CHANNEL_EMAIL: _deliver_outbox_emails},
+    batch_size=OUTBOX_BATCH_SIZE,
+    poll_interval=OUTBOX_POLL_SECONDS,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    permanent_errors=(PermanentDeliveryError,),
+    on_stop=EMAIL_TRANSPORT.close,
+    external_channels=(CHANNEL_EMAIL,),
+)
+
+def enqueue_notifications(cursor, channel: str, rows) -> int:
+    """Queue (sender_id, recipient, subject, body) rows; committed with the caller's transaction."""
+    queued = outbox_enqueue(cursor, channel, rows)
+    OUTBOX_DISPATCHER.wake()
+    return queued
+
 def _send_messages(conn, sender_id: str, recipient_ids: List[str], subject: str, content: str):
     if not recipient_ids:
         return 0
-    ts = datetime.now().isoformat()
-    sent = 0
-    for rid in sorted(set(recipient_ids)):
-        conn.execute("""
-            INSERT INTO messages (sender_id, receiver_id, subject, content, timestamp, is_read)
-            VALUES (?, ?, ?, ?, ?, FALSE)
-        """, (sender_id, rid, subject, content, ts))
-        sent += 1
-    return sent
+    return enqueue_notifications(
+        conn, CHANNEL_MESSAGE, [(sender_id, rid, subject, content) for rid in sorted(set(recipient_ids))]
+    )
 
 FORM_RESOURCE_TEMPLATES: Dict[str, Dict[str, str]] = {
     "sports": {
@@ -297,33 +456,57 @@ FORM_RESOURCE_TEMPLATES: Dict[str, Dict[str, str]] = {
     }
 }
 
-def _get_school_broadcast_recipients(conn, school_id: int) -> Dict[str, List[str]]:
-    teacher_rows = conn.execute(
-        "SELECT id FROM students WHERE school_id = ? AND role = 'Teacher'",
-        (school_id,)
-    ).fetchall()
-    student_rows = conn.execute(
-        "SELECT id FROM students WHERE school_id = ? AND role = 'Student'",
-        (school_id,)
-    ).fetchall()
-    parent_rows = conn.execute(
-        """
-        SELECT DISTINCT p.id
-        FROM guardians g
-        JOIN students s ON s.id = g.student_id
+def _resolve_recipients(conn, school_id: int, grade=None, section_id=None, include_teachers: bool = False) -> List[Tuple[str, str, Optional[str]]]:
+    """(recipient_id, audience, student_name) for every student in scope, each of their
+    parent accounts, and optionally every teacher of the school, in one query.
+
+    audience is 'student', 'parent' or 'teacher'; student_name is the child a parent
+    row is about (the student's own name for 'student', None for 'teacher').
+    """
+    scope_sql = "s.role = 'Student' AND s.school_id = ?"
+    scope_params: List[Any] = [school_id]
+    if grade is not None:
+        scope_sql += " AND s.grade = ?"
+        scope_params.append(grade)
+    if section_id:
+        scope_sql += " AND s.section_id = ?"
+        scope_params.append(section_id)
+
+    query = f"""
+        SELECT s.id AS recipient_id, 'student' AS audience, s.name AS student_name
+        FROM students s
+        WHERE {scope_sql}
+        UNION
+        SELECT p.id AS recipient_id, 'parent' AS audience, s.name AS student_name
+        FROM students s
+        JOIN guardians g ON g.student_id = s.id
         JOIN students p ON p.id = g.email
-        WHERE s.school_id = ?
-          AND s.role = 'Student'
+        WHERE {scope_sql}
           AND p.school_id = ?
           AND p.role IN ('Parent', 'Parent_Guardian')
-        """,
-        (school_id, school_id)
-    ).fetchall()
-    return {
-        "teachers": [r["id"] for r in teacher_rows if r["id"]],
-        "students": [r["id"] for r in student_rows if r["id"]],
-        "parents": [r["id"] for r in parent_rows if r["id"]],
-    }
+    """
+    params = scope_params + scope_params + [school_id]
+    if include_teachers:
+        query += """
+        UNION
+        SELECT t.id AS recipient_id, 'teacher' AS audience, NULL AS student_name
+        FROM students t
+        WHERE t.school_id = ? AND t.role = 'Teacher'
+        """
+        params.append(school_id)
+    query += " ORDER BY audience, recipient_id"
+    rows = conn.execute(query, params).fetchall()
+    return [(r["recipient_id"], r["audience"], r["student_name"]) for r in rows if r["recipient_id"]]
+
+def _get_school_broadcast_recipients(conn, school_id: int) -> Dict[str, List[str]]:
+    grouped: Dict[str, List[str]] = {"teachers": [], "students": [], "parents": []}
+    seen = set()
+    for recipient_id, audience, _ in _resolve_recipients(conn, school_id, include_teachers=True):
+        key = f"{audience}s"
+        if (key, recipient_id) not in seen:
+            seen.add((key, recipient_id))
+            grouped[key].append(recipient_id)
+    return grouped
 
 def _build_exam_message(schedule: Dict[str, Any], audience: str, student_name: Optional[str] = None, custom_message: Optional[str] = None, items_required: Optional[str] = None) -> str:
     title = schedule.get("title") or "Exam"
@@ -357,31 +540,19 @@ def _notify_exam_schedule(conn, schedule: Dict[str, Any], sender_id: str, custom
     grade_level = schedule.get("grade_level")
     section_id = schedule.get("section_id")
 
-    # Students in scope
-    student_query = "SELECT id, name FROM students WHERE role = 'Student' AND school_id = ? AND grade = ?"
-    params = [school_id, grade_level]
-    if section_id:
-        student_query += " AND section_id = ?"
-        params.append(section_id)
-    students = conn.execute(student_query, params).fetchall()
-
-    # Send to students
-    student_ids = [s["id"] for s in students]
+    # Students in scope and their parents, resolved in one query
+    recipients = _resolve_recipients(conn, school_id, grade=grade_level, section_id=section_id) if grade_level is not None else []
+    rows = []
+    student_ids = sorted({rid for rid, audience, _ in recipients if audience == "student"})
     if student_ids:
         content = _build_exam_message(schedule, "student", custom_message=custom_message, items_required=items_required)
-        sent_counts["students"] = _send_messages(conn, sender_id, student_ids, "Exam Schedule Update", content)
-
-    # Send to parents/guardians
-    for s in students:
-        guardians = conn.execute("SELECT email, name FROM guardians WHERE student_id = ?", (s["id"],)).fetchall()
-        for g in guardians:
-            parent_user = conn.execute(
-                "SELECT id FROM students WHERE id = ? AND role IN ('Parent', 'Parent_Guardian') AND school_id = ?",
-                (g["email"], school_id)
-            ).fetchone()
-            if parent_user:
-                content = _build_exam_message(schedule, "parent", student_name=s["name"], custom_message=custom_message, items_required=items_required)
-                sent_counts["parents"] += _send_messages(conn, sender_id, [parent_user["id"]], "Exam Schedule Update", content)
+        rows += [(sender_id, rid, "Exam Schedule Update", content) for rid in student_ids]
+        sent_counts["students"] = len(student_ids)
+    for rid, audience, student_name in recipients:
+        if audience == "parent":
+            content = _build_exam_message(schedule, "parent", student_name=student_name, custom_message=custom_message, items_required=items_required)
+            rows.append((sender_id, rid, "Exam Schedule Update", content))
+            sent_counts["parents"] += 1
 
     # Send to teachers
     if include_teachers:
@@ -430,75 +601,165 @@ def _notify_exam_schedule(conn, schedule: Dict[str, Any], sender_id: str, custom
 
         if teacher_ids:
             content = _build_exam_message(schedule, "teacher", custom_message=custom_message, items_required=items_required)
-            sent_counts["teachers"] = _send_messages(conn, sender_id, list(teacher_ids), "Exam Schedule Update", content)
+            rows += [(sender_id, tid, "Exam Schedule Update", content) for tid in sorted(teacher_ids)]
+            sent_counts["teachers"] = len(teacher_ids)
 
+    # One multi-row insert for every recipient
+    if rows:
+        enqueue_notifications(conn, CHANNEL_MESSAGE, rows)
     return sent_counts
 
 
-try:
-    # Initialize the Groq Client.
-    from groq import Groq
-    
-    # User provided key overrides env var for now to ensure it works
+# --- LLM GATEWAY ---
+# Every chat completion goes through LLM (see llm_gateway.py). Each feature keeps its
+# own API key via a named provider; LLM_PROVIDER=stub answers locally so the AI
+# endpoints can be load-tested without a Groq key.
+GROQ_MODEL = "llama-3.1-8b-instant"
+ENGAGEMENT_HELPER_MODEL = os.environ.get("ENGAGEMENT_HELPER_MODEL", "llama-3.1-8b-instant")
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "groq").strip().lower()
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "10"))
+
+def _build_llm_providers() -> Dict[str, Any]:
+    names = ("default", "lesson_planner", "grade_helper", "engagement_helper")
+    if LLM_PROVIDER == "stub":
+        stub = StubProvider(
+            latency=float(os.getenv("LLM_STUB_LATENCY_MS", "200")) / 1000.0,
+            tokens_per_second=float(os.getenv("LLM_STUB_TOKENS_PER_SECOND", "200")),
+        )
+        logger.info("AI Chat System Initialized (local stub provider).")
+        return {name: stub for name in names}
+
     api_key = os.getenv("GROQ_API_KEY")
-    
-    if api_key:
-        GROQ_CLIENT = Groq(api_key=api_key)
-        GROQ_MODEL = "llama-3.1-8b-instant" 
-        
-        # Dedicated Client for Lesson Planner
-        lesson_planner_key = os.environ.get("LESSON_PLANNER_API_KEY") or api_key
-             
-        LESSON_PLANNER_CLIENT = Groq(api_key=lesson_planner_key)
-        
-        AI_ENABLED = True
+    keys = {
+        "default": api_key,
+        "lesson_planner": os.environ.get("LESSON_PLANNER_API_KEY") or api_key,
+        "grade_helper": os.environ.get("GRADE_HELPER_API_KEY") or api_key,
+        "engagement_helper": os.environ.get("ENGAGEMENT_HELPER_API_KEY") or api_key,
+    }
+    providers: Dict[str, Any] = {}
+    clients_by_key: Dict[str, Any] = {}
+    try:
+        for name in names:
+            key = keys[name]
+            if not key:
+                continue
+            if key not in clients_by_key:
+                clients_by_key[key] = GroqProvider(key, timeout=LLM_TIMEOUT_SECONDS)
+            providers[name] = clients_by_key[key]
+    except ImportError:
+        logger.error("Groq library not installed. AI features disabled.")
+        return {}
+    except Exception as e:
+        logger.error(f"Failed to initialize AI clients. Error: {e}")
+        return {}
+
+    if "default" in providers:
         logger.info("AI Chat System Initialized (Groq Powered).")
     else:
         logger.warning("GROQ_API_KEY not found. AI features disabled.")
-        GROQ_CLIENT = None
-        LESSON_PLANNER_CLIENT = None
-        AI_ENABLED = False
-except ImportError:
-    logger.error("Groq library not installed. AI features disabled.")
-    AI_ENABLED = False
-except Exception as e:
-    logger.error(f"Failed to initialize AI clients. Error: {e}")
-    AI_ENABLED = False
+    return providers
+
+LLM = LLMGateway(
+    _build_llm_providers(),
+    default_model=GROQ_MODEL,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT_SECONDS,
+    queue_timeout=LLM_QUEUE_TIMEOUT_SECONDS,
+)
+AI_ENABLED = LLM.available("default")
+
+# Answers to repeated questions, per school and prompt context (see response_cache.py).
+# AI_RESPONSE_CACHE_SIMILARITY > 0 also reuses answers for near-identical wording
+# (e.g. 0.9); 0 keeps lookups exact. AI_RESPONSE_CACHE_TTL=0 disables the cache.
+AI_RESPONSE_CACHE_TTL = float(os.getenv("AI_RESPONSE_CACHE_TTL", "21600"))
+AI_RESPONSE_CACHE = ResponseCache(
+    maxsize=int(os.getenv("AI_RESPONSE_CACHE_SIZE", "2048")) if AI_RESPONSE_CACHE_TTL > 0 else 0,
+    ttl=AI_RESPONSE_CACHE_TTL,
+    similarity_threshold=float(os.getenv("AI_RESPONSE_CACHE_SIMILARITY", "0")),
+)
 
-# --- NEW GRADE HELPER AI CONFIGURATION ---
-# --- NEW GRADE HELPER AI CONFIGURATION ---
-GRADE_HELPER_API_KEY = os.environ.get("GRADE_HELPER_API_KEY") or os.environ.get("GROQ_API_KEY")
-try:
-    if GRADE_HELPER_API_KEY:
-        GRADE_HELPER_CLIENT = Groq(api_key=GRADE_HELPER_API_KEY)
-        logger.info("Grade Helper AI Initialized.")
+# Course chat answers from the top-k BM25 chunks of the course's modules (see course_retrieval.py).
+COURSE_CHUNK_WORDS = int(os.getenv("COURSE_CHUNK_WORDS", "180"))
+COURSE_CHUNK_OVERLAP = int(os.getenv("COURSE_CHUNK_OVERLAP", "30"))
+
+def _load_course_chunks(course_id: int, after_id: int):
+    conn = get_db_connection()
+    try:
+        return conn.execute(
+            "SELECT id, module_id, title, text FROM lms_module_chunks WHERE course_id = ? AND id > ? ORDER BY id",
+            (course_id, after_id),
+        ).fetchall()
+    finally:
+        conn.close()
+
+COURSE_RETRIEVER = CourseRetriever(
+    _load_course_chunks,
+    top_k=int(os.getenv("COURSE_RETRIEVAL_TOP_K", "6")),
+    max_courses=int(os.getenv("COURSE_RETRIEVAL_MAX_COURSES", "256")),
+)
+
+RESOURCE_MATCH_LIMIT = int(os.getenv("RESOURCE_MATCH_LIMIT", "3"))
+
+# Rendered pieces of the AI prompts, so back-to-back chat turns skip the queries:
+#   ("student", student_id) -> profile line + activity history of one user
+#   ("school", school_id)   -> student / activity counts for the teacher co-pilot
+#   ("resources", school_id) -> library title list
+# Writes to students and activities call invalidate_ai_context, resource writes
+# invalidate_resource_summary; other workers catch up within AI_CONTEXT_CACHE_TTL.
+AI_CONTEXT_CACHE_TTL = float(os.getenv("AI_CONTEXT_CACHE_TTL", "300"))
+AI_CONTEXT_CACHE = TTLCache(
+    maxsize=int(os.getenv("AI_CONTEXT_CACHE_SIZE", "4096")) if AI_CONTEXT_CACHE_TTL > 0 else 0,
+    ttl=AI_CONTEXT_CACHE_TTL,
+)
+
+def invalidate_ai_context(school_id: Optional[int] = None, student_id: Optional[str] = None):
+    """Drop one user's snapshot (if given) and the school's counts (every school's when school_id is None)."""
+    if student_id is not None:
+        AI_CONTEXT_CACHE.invalidate(("student", student_id))
+    if school_id is None:
+        AI_CONTEXT_CACHE.invalidate_where(lambda key: key[0] == "school")
     else:
-        GRADE_HELPER_CLIENT = None
-        logger.warning("GRADE_HELPER_API_KEY not found.")
-except Exception as e:
-    logger.error(f"Failed to initialize Grade Helper AI: {e}")
-    GRADE_HELPER_CLIENT = None
+        AI_CONTEXT_CACHE.invalidate(("school", school_id))
 
-ENGAGEMENT_HELPER_API_KEY = os.environ.get("ENGAGEMENT_HELPER_API_KEY") or os.environ.get("GROQ_API_KEY")
-ENGAGEMENT_HELPER_MODEL = os.environ.get("ENGAGEMENT_HELPER_MODEL", "llama-3.1-8b-instant")
-try:
-    if ENGAGEMENT_HELPER_API_KEY:
-        ENGAGEMENT_HELPER_CLIENT = Groq(api_key=ENGAGEMENT_HELPER_API_KEY)
-        logger.info("Engagement Helper AI Initialized (Groq).")
+def invalidate_resource_summary(school_id: Optional[int] = None):
+    if school_id is None:
+        AI_CONTEXT_CACHE.invalidate_where(lambda key: key[0] == "resources")
     else:
-        ENGAGEMENT_HELPER_CLIENT = None
-        logger.warning("ENGAGEMENT_HELPER_API_KEY/GROQ_API_KEY not found.")
-except Exception as e:
-    logger.error(f"Failed to initialize Engagement Helper AI: {e}")
-    ENGAGEMENT_HELPER_CLIENT = None
-from contextlib import asynccontextmanager
+        AI_CONTEXT_CACHE.invalidate(("resources", school_id))
+
+_PERSONAL_PROMPT_RE = re.compile(r"\b(i|i'm|im|i've|ive|my|mine|myself)\b", re.IGNORECASE)
+
+def _is_personal_prompt(prompt: str) -> bool:
+    """True for questions about the asker's own record ("how did I do", "my grades")."""
+    return bool(_PERSONAL_PROMPT_RE.search(prompt or ""))
+
+def _sse_response(chunks) -> StreamingResponse:
+    """Stream LLM text deltas to the browser as Server-Sent Events."""
+    return StreamingResponse(
+        sse_events(chunks),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def _replay_chunks(text: str):
+    yield text
+
+async def _tee_stream(chunks, on_complete):
+    """Pass deltas through; hand the full text to on_complete once the stream ends cleanly."""
+    parts = []
+    async for delta in chunks:
+        parts.append(delta)
+        yield delta
+    on_complete("".join(parts))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     try:
         logger.info("Initializing Database...")
-        initialize_db()
+        initialize_db(apply_migrations=DB_MIGRATE_ON_STARTUP)
         logger.info("Database Initialized.")
     except Exception as e:
         logger.error(f"Startup DB Error: {e}")
@@ -510,15 +771,27 @@ async def lifespan(app: FastAPI):
         logger.error(f"Startup RBAC module error: {e}")
 
     try:
-        logger.info("Training Recommendation Model (Lazy loaded on demand)...")
-        # train_recommendation_model() # Disabled to prevent startup hang
-        logger.info("Model training deferred.")
+        # Loads the persisted model (or trains one) on a background thread.
+        RECOMMENDER.start()
+        logger.info("Recommendation model trainer started.")
     except Exception as e:
         logger.warning(f"Startup ML Error: {e}")
+
+    OUTBOX_DISPATCHER.start()
+    logger.info("Notification outbox dispatcher started.")
+    if AI_ENABLED:
+        QUIZ_FEEDBACK.start()
+        logger.info("Quiz feedback worker started.")
     
     yield
     # Shutdown (if any cleanup is needed)
     logger.info("Shutting down...")
+    RECOMMENDER.stop()
+    OUTBOX_DISPATCHER.stop()
+    await QUIZ_FEEDBACK.stop()
+    EXTRACTION.shutdown()
+    DB_EXECUTOR.shutdown(wait=False)
+    close_pg_pool()
 
 # --- NEW AI ENGAGEMENT MODELS ---
 app = FastAPI(title="EdTech AI Portal API - Enhanced", lifespan=lifespan)
@@ -736,14 +1009,12 @@ PostgreSQL Schema Overview:
 1. students (id [text], name, grade, preferred_subject, attendance_rate, home_language, math_score, science_score, english_language_score, role ['Student', 'Teacher', 'Tenant_Admin'], school_id)
 2. activities (id, student_id, date, topic, difficulty, score [0-100], time_spent_min)
 3. schools (id, name, address, contact_email)
-   - Note: content is multi-tenant, filtered by school_id usually, but for general queries show all if not restricted.
+   - Note: queries only ever see the current school's rows; other tables are not available.
 4. groups (id, name, subject, description, school_id) - Represents classes/groups
 5. assignments (id, group_id, title, due_date, points)
 6. submissions (id, assignment_id, student_id, content, grade)
 7. guardians (student_id, name, relationship, phone, email)
 8. health_records (student_id, blood_group, allergies, medical_conditions, medications)
-9. staff (id, name, role, department_id, position_title, joining_date)
-10. departments (id, name, head_of_department_id)
 
 Relationships:
 - students.school_id -> schools.id
@@ -752,20 +1023,6 @@ Relationships:
 - assignments.group_id -> groups.id
 """
 
-def format_df_to_markdown(df):
-    if df.empty:
-        return "No results found."
-    columns = df.columns.tolist()
-    header = "| " + " | ".join(columns) + " |"
-    separator = "| " + " | ".join(["---"] * len(columns)) + " |"
-    rows = []
-    for _, row in df.iterrows():
-        # Convert values to string and replace newlines to keep table structure
-        row_values = [str(val).replace('\n', ' ') for val in row.values]
-        row_str = "| " + " | ".join(row_values) + " |"
-        rows.append(row_str)
-    return f"\n{header}\n{separator}\n" + "\n".join(rows) + "\n"
-
 # --- POSTGRES COMPATIBILITY LAYER ---
 # class sqlite3:
 #     """Compatibility layer to allow existing code to catch sqlite3 exceptions."""
@@ -774,8 +1031,10 @@ def format_df_to_markdown(df):
 #     Row = dict # Stub
 
 class PostgresCursorWrapper:
-    def __init__(self, cursor):
+    def __init__(self, cursor, owner=None):
         self.cursor = cursor
+        # Keeps the connection wrapper (and its pool slot) alive while the cursor is in use.
+        self._owner = owner
 
     def execute(self, query, params=None):
         # Naive replacement of ? to %s for Postgres
@@ -836,51 +1095,27 @@ class PostgresCursorWrapper:
         self.cursor.close()
 
 class PostgresConnectionWrapper:
-    def __init__(self, dsn):
+    def __init__(self, dsn, pool=None, timeout=None):
         if not load_psycopg2():
             raise RuntimeError("Postgres requested but psycopg2 is not available.")
-        
-        # Parse DSN to extract hostname for resolution
+        self._pool = pool
+        self.row_factory = None # Stub
+        if pool is not None:
+            # Borrowed connection: close() hands it back to the pool instead of
+            # tearing down the TLS session.
+            self.conn = pool.getconn(timeout)
+            # Handlers that raise before close() would otherwise hold the slot forever.
+            self._finalizer = weakref.finalize(self, _return_leaked_connection, pool, self.conn)
+            self._finalizer.atexit = False
+            return
         try:
-            from urllib.parse import urlparse
-            import socket
-            parsed = urlparse(dsn)
-            hostname = parsed.hostname
-            ip_address = None
-            
-            if hostname:
-                # Resolve IPv4
-                try:
-                    info = socket.getaddrinfo(hostname, 5432, family=socket.AF_INET, proto=socket.IPPROTO_TCP)
-                    if info:
-                        ip_address = info[0][4][0]
-                        print(f"Resolved {hostname} to IPv4 for connection: {ip_address}")
-                except Exception as e:
-                    logger.warning(f"Failed to resolve IPv4 for {hostname}: {e}")
-
-            # Prepare connection arguments
-            conn_args = {
-                "dsn": dsn,
-                "cursor_factory": DictCursor,
-                "connect_timeout": 10,
-                # "sslmode": "require" # Supabase needs this, usually in DSN
-            }
-            
-            # If we have an IP, force it using hostaddr
-            if ip_address:
-                conn_args["hostaddr"] = ip_address
-                # We KEEP the original dsn (with hostname) so SSL validation works!
-                # hostaddr overrides the DNS lookup but libpq uses the DSN hostname for cert verification.
-            
-            self.conn = psycopg2.connect(**conn_args)
-            
+            self.conn = _connect_postgres_raw(dsn)
         except Exception as e:
             logger.error(f"DB Connection Error (DSN: {dsn}): {e}")
             raise e
-        self.row_factory = None # Stub
 
     def cursor(self):
-        return PostgresCursorWrapper(self.conn.cursor())
+        return PostgresCursorWrapper(self.conn.cursor(), owner=self)
 
     def execute(self, query, params=None):
         cur = self.cursor()
@@ -891,11 +1126,56 @@ class PostgresConnectionWrapper:
         self.conn.commit()
 
     def close(self):
-        self.conn.close()
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return # Already closed / returned
+        if self._pool is not None:
+            self._finalizer.detach()
+            self._pool.putconn(conn)
+        else:
+            conn.close()
 
     def rollback(self):
         self.conn.rollback()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+def _return_leaked_connection(pool, raw):
+    """Finalizer of a pooled wrapper dropped without close(): hand the connection back.
+
+    GC can run this on any thread, including one inside the pool's lock, so it
+    only queues the connection; the pool rolls it back on its next checkout.
+    """
+    pool.return_leaked(raw)
+
+def _connect_postgres_raw(dsn):
+    """Open a raw psycopg2 connection, pinning the cached IPv4 address of the host."""
+    from urllib.parse import urlparse
+    parsed = urlparse(dsn)
+    hostname = parsed.hostname
+    ip_address = resolve_ipv4(hostname, parsed.port or 5432, ttl=DB_DNS_CACHE_TTL) if hostname else None
+
+    # Prepare connection arguments
+    conn_args = {
+        "dsn": dsn,
+        "cursor_factory": DictCursor,
+        "connect_timeout": 10,
+        # "sslmode": "require" # Supabase needs this, usually in DSN
+    }
+
+    # If we have an IP, force it using hostaddr
+    if ip_address:
+        conn_args["hostaddr"] = ip_address
+        # We KEEP the original dsn (with hostname) so SSL validation works!
+        # hostaddr overrides the DNS lookup but libpq uses the DSN hostname for cert verification.
+
+    return psycopg2.connect(**conn_args)
+
  
 
 # --- 2. DATA MODELS ---
@@ -1436,12 +1716,64 @@ class LMSModuleResponse(BaseModel):
 # --- 3. DATABASE HELPER FUNCTIONS ---
 
 
+# Connection pool settings (Postgres only; SQLite connections are local and cheap).
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_HEALTHCHECK_SECONDS = float(os.getenv("DB_POOL_HEALTHCHECK_SECONDS", "30"))
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", "1800"))
+DB_DNS_CACHE_TTL = float(os.getenv("DB_DNS_CACHE_TTL", "300"))
+# Set to false when migrations are run out-of-band (python migrate.py) before deploys.
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true"
+
+PG_POOL = None
+_PG_POOL_LOCK = threading.Lock()
+
+def get_pg_pool():
+    """Lazily build the process-wide Postgres pool (one per worker process)."""
+    global PG_POOL
+    if PG_POOL is None:
+        with _PG_POOL_LOCK:
+            if PG_POOL is None:
+                PG_POOL = ConnectionPool(
+                    lambda: _connect_postgres_raw(DATABASE_URL),
+                    minconn=DB_POOL_MIN_SIZE,
+                    maxconn=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    healthcheck_after=DB_POOL_HEALTHCHECK_SECONDS,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                )
+                logger.info(f"Postgres connection pool ready (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+    return PG_POOL
+
+def close_pg_pool():
+    global PG_POOL
+    with _PG_POOL_LOCK:
+        if PG_POOL is not None:
+            PG_POOL.closeall()
+            PG_POOL = None
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
 def get_db_connection():
     # Check if DATABASE_URL is set to Postgres
     if USE_POSTGRES and "postgres" in DATABASE_URL:
         if load_psycopg2():
             try:
-                return PostgresConnectionWrapper(DATABASE_URL)
+                # Called straight from an async handler: waiting for a slot would freeze the
+                # whole event loop, so fail fast instead (run_db / async_db_connection wait
+                # on a worker thread).
+                timeout = 0 if _on_event_loop() else None
+                return PostgresConnectionWrapper(DATABASE_URL, pool=get_pg_pool(), timeout=timeout)
+            except PoolTimeout as e:
+                # Pool exhausted: falling back to SQLite would silently serve the wrong data.
+                logger.error(f"Postgres pool exhausted: {e}")
+                raise HTTPException(status_code=503, detail="Database busy, please retry.")
             except Exception as e:
                 logger.error(f"Failed to connect to Postgres, falling back to SQLite: {e}")
         else:
@@ -1450,11 +1782,44 @@ def get_db_connection():
     # Use SQLite DB path from DATABASE_URL env (or default class_bridge.db)
     db_path = SQLITE_DB_PATH or os.path.join(os.path.dirname(os.path.abspath(__file__)), "class_bridge.db")
     # print(f"DEBUG: sqlite3 object: {sqlite3}")
-    conn = sqlite3.connect(db_path)
+    # check_same_thread=False: async handlers hand the connection to DB worker threads
+    # (one at a time), see async_db_connection().
+    conn = sqlite3.connect(db_path, check_same_thread=False)
     conn.execute("PRAGMA foreign_keys = ON")
     conn.row_factory = sqlite3.Row
     return conn
 
+@contextmanager
+def db_connection():
+    """Context-manager form of get_db_connection(); the connection is always released.
+
+        with db_connection() as conn:
+            conn.execute(...)
+    """
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+# Blocking DB work from async handlers runs here instead of on the event loop.
+# Sized like the connection pool so workers never queue behind a checkout.
+DB_EXECUTOR = DBExecutor(max_workers=int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE))))
+
+async def run_db(fn, *args, **kwargs):
+    """Await a blocking (sync) DB function without stalling the event loop."""
+    return await DB_EXECUTOR.run(fn, *args, **kwargs)
+
+@asynccontextmanager
+async def async_db_connection():
+    """Async counterpart of db_connection(); see db_async.AsyncConnection."""
+    conn = await run_db(get_db_connection)
+    aconn = AsyncConnection(conn, DB_EXECUTOR)
+    try:
+        yield aconn
+    finally:
+        await aconn.close()
+
 
 from sqlalchemy import create_engine
 
@@ -1492,6 +1857,106 @@ def fetch_data_df(query, params=()):
         print(f"CRITICAL PANDAS ERROR: {e}") 
         return pd.DataFrame()
 
+# --- AI-WRITTEN SQL (DATABASE mode) ---
+# Each table the model may query, as the rows and columns one school may see
+# (see sql_guard.py). Anything not listed here is rejected.
+AI_SQL_SCOPES = {
+    "students": "SELECT id, name, grade, preferred_subject, attendance_rate, home_language, math_score, science_score, english_language_score, role, school_id FROM {schema}.students WHERE school_id = {school_id}",
+    "activities": "SELECT a.id, a.student_id, a.date, a.topic, a.difficulty, a.score, a.time_spent_min FROM {schema}.activities a JOIN {schema}.students s ON s.id = a.student_id WHERE s.school_id = {school_id}",
+    "schools": "SELECT id, name, address, contact_email FROM {schema}.schools WHERE id = {school_id}",
+    "groups": "SELECT id, name, subject, description, school_id FROM {schema}.groups WHERE school_id = {school_id}",
+    "assignments": "SELECT a.id, a.group_id, a.title, a.due_date, a.points FROM {schema}.assignments a JOIN {schema}.groups g ON g.id = a.group_id WHERE g.school_id = {school_id}",
+    "submissions": "SELECT sub.id, sub.assignment_id, sub.student_id, sub.content_text AS content, sub.grade FROM {schema}.assignment_submissions sub JOIN {schema}.students s ON s.id = sub.student_id WHERE s.school_id = {school_id}",
+    "guardians": "SELECT g.student_id, g.name, g.relationship, g.phone, g.email FROM {schema}.guardians g JOIN {schema}.students s ON s.id = g.student_id WHERE s.school_id = {school_id}",
+    "health_records": "SELECT h.student_id, h.blood_group, h.allergies, h.medical_conditions, h.medications FROM {schema}.health_records h JOIN {schema}.students s ON s.id = h.student_id WHERE s.school_id = {school_id}",
+}
+# Students and parents never get contact or health data through the tutor.
+AI_SQL_LEARNER_ROLES = {"Student", "Parent", "Parent_Guardian"}
+AI_SQL_LEARNER_TABLES = {"students", "activities", "schools", "groups", "assignments"}
+
+@contextmanager
+def _ai_readonly_cursor(timeout_ms: int):
+    """Cursor on a read-only connection that cancels statements after timeout_ms."""
+    if USE_POSTGRES and "postgres" in DATABASE_URL and load_psycopg2():
+        pool = get_pg_pool()
+        raw = pool.getconn()
+        try:
+            cur = raw.cursor()
+            cur.execute("SET TRANSACTION READ ONLY")
+            cur.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+            try:
+                yield cur
+            except psycopg2.errors.QueryCanceled as e:
+                raise QueryTimeout(f"Query cancelled after {timeout_ms} ms") from e
+        finally:
+            raw.rollback()
+            pool.putconn(raw)
+        return
+
+    from urllib.parse import quote
+    db_path = SQLITE_DB_PATH or os.path.join(os.path.dirname(os.path.abspath(__file__)), "class_bridge.db")
+    conn = sqlite3.connect(f"file:{quote(db_path)}?mode=ro", uri=True, check_same_thread=False)
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    conn.set_progress_handler(lambda: 1 if time.monotonic() > deadline else 0, 10000)
+    try:
+        yield conn.cursor()
+    except sqlite3.OperationalError as e:
+        if "interrupted" in str(e):
+            raise QueryTimeout(f"Query cancelled after {timeout_ms} ms") from e
+        raise
+    finally:
+        conn.close()
+
+AI_SQL = GuardedQueryExecutor(
+    _ai_readonly_cursor,
+    AI_SQL_SCOPES,
+    schema="public" if USE_POSTGRES and "postgres" in DATABASE_URL.lower() else "main",
+    max_rows=int(os.getenv("AI_SQL_MAX_ROWS", "200")),
+    page_size=int(os.getenv("AI_SQL_PAGE_SIZE", "50")),
+    timeout_ms=int(os.getenv("AI_SQL_TIMEOUT_MS", "3000")),
+    cache_ttl=float(os.getenv("AI_SQL_CACHE_TTL", "60")),
+)
+
+def _run_ai_query(sql: str, user_id: str):
+    """Run model-written SQL for user_id in the sandbox. Raises QueryRejected / QueryTimeout."""
+    user = AI_CONTEXT_CACHE.get_or_load(("student", user_id), lambda: _load_student_context(user_id))
+    if not user:
+        raise QueryRejected("Unknown user")
+    school_id = user['school_id'] or 1
+    allowed = AI_SQL_LEARNER_TABLES if user['role'] in AI_SQL_LEARNER_ROLES else None
+    logger.info(f"[AI SQL] user={user_id} school={school_id}: {sql}")
+    return AI_SQL.run(sql, school_id, allowed)
+
+def _ai_query_error_reply(error: Exception) -> str:
+    if isinstance(error, QueryRejected):
+        return f"I can only run read-only queries on your school's data, and this one was not allowed: {error}"
+    if isinstance(error, QueryTimeout):
+        return "That query took too long to run. Try asking for something more specific."
+    logger.error(f"AI SQL Execution Error: {error}")
+    return f"I tried to run a database query but ran into an error: {error}"
+
+# Uploaded PDFs are parsed once per content hash, in worker processes (see text_extraction.py).
+# Requests wait up to EXTRACTION_WAIT_SECONDS for the text and otherwise carry on
+# without it; the extraction finishes in the background for the next upload or a poll.
+EXTRACTION_WAIT_SECONDS = float(os.getenv("EXTRACTION_WAIT_SECONDS", "15"))
+EXTRACTION = TextExtractionService(
+    get_db_connection,
+    max_workers=int(os.getenv("EXTRACTION_WORKERS", "2")),
+    max_pages=int(os.getenv("EXTRACTION_MAX_PAGES", "50")),
+    timeout=float(os.getenv("EXTRACTION_TIMEOUT_SECONDS", "20")),
+    hard_timeout=float(os.getenv("EXTRACTION_HARD_TIMEOUT_SECONDS", "30")),
+    max_bytes=int(os.getenv("EXTRACTION_MAX_BYTES", str(20 * 1024 * 1024))),
+)
+
+async def _extract_upload(file: UploadFile, wait: Optional[float] = None):
+    """ExtractionResult for an uploaded file, or None if it is still running after ``wait`` seconds."""
+    data = await file.read(EXTRACTION.max_bytes + 1)  # anything longer is refused by submit()
+    future = await run_db(EXTRACTION.submit, data, file.filename)
+    return await EXTRACTION.wait(future, EXTRACTION_WAIT_SECONDS if wait is None else wait)
+
+def _extracted_text(result) -> str:
+    return result.text if result is not None and result.status == STATUS_DONE else ""
+
 def log_auth_event(user_id: str, event_type: str, details: str = ""):
     try:
         conn = get_db_connection()
@@ -1660,8 +2125,7 @@ def _row_value(row, key: str, default=0):
 # --- 4. DATABASE INITIALIZATION ---
 
 
-def initialize_db():
-    conn = get_db_connection()
+def _create_baseline_schema(conn):
     cursor = conn.cursor()
 
     # Helper for migrations
@@ -3456,13 +3920,165 @@ def initialize_db():
     safe_migrate("ALTER TABLE student_marks ADD COLUMN published_by TEXT")
 
     conn.commit()
-    
-    # --- SEED RBAC DATA ---
+
+
+# --- SCHEMA MIGRATIONS ---
+# Append new steps with the next version number; never edit or renumber one that
+# has shipped. To re-run a seed (e.g. after changing the permission list in
+# seed_rbac_data), register a new step that calls it again.
+SCHEMA_MIGRATIONS = MigrationRegistry()
+
+
+@SCHEMA_MIGRATIONS.register(1, "baseline schema")
+def _migration_baseline_schema(conn):
+    _create_baseline_schema(conn)
+
+
+# The indexes migration 2 shipped with, frozen: later catalogue changes get
+# their own migrations (4, 12, 13) instead of silently changing this one.
+_MIGRATION_2_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_students_lower_id ON students (LOWER(id))",
+    "CREATE INDEX IF NOT EXISTS ix_students_school_role_grade ON students (school_id, role, grade)",
+    "CREATE INDEX IF NOT EXISTS ix_auth_logs_user_event ON auth_logs (user_id, event_type)",
+    "CREATE INDEX IF NOT EXISTS ix_user_roles_role ON user_roles (role_id)",
+    "CREATE INDEX IF NOT EXISTS ix_guardians_student ON guardians (student_id)",
+    "CREATE INDEX IF NOT EXISTS ix_guardians_email ON guardians (email)",
+    "CREATE INDEX IF NOT EXISTS ix_guardians_lower_email ON guardians (LOWER(email))",
+    "CREATE INDEX IF NOT EXISTS ix_messages_receiver_ts ON messages (receiver_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_sender ON messages (sender_id)",
+    "CREATE INDEX IF NOT EXISTS ix_activities_student_date ON activities (student_id, date)",
+    "CREATE INDEX IF NOT EXISTS ix_student_attendance_student_date ON student_attendance (student_id, date)",
+    "CREATE INDEX IF NOT EXISTS ix_quiz_attempts_student_quiz ON quiz_attempts (student_id, quiz_id)",
+    "CREATE INDEX IF NOT EXISTS ix_quiz_attempts_quiz ON quiz_attempts (quiz_id)",
+    "CREATE INDEX IF NOT EXISTS ix_student_marks_student ON student_marks (student_id, exam_name)",
+    "CREATE INDEX IF NOT EXISTS ix_group_members_student ON group_members (student_id)",
+    "CREATE INDEX IF NOT EXISTS ix_lms_sections_course ON lms_course_sections (course_id)",
+    "CREATE INDEX IF NOT EXISTS ix_lms_modules_section ON lms_course_modules (section_id)",
+    "CREATE INDEX IF NOT EXISTS ix_resources_school_uploaded ON resources (school_id, uploaded_at)",
+    "CREATE INDEX IF NOT EXISTS ix_journal_lines_entry ON journal_lines (journal_entry_id)",
+    "CREATE INDEX IF NOT EXISTS ix_journal_lines_account ON journal_lines (account_id)",
+    "CREATE INDEX IF NOT EXISTS ix_journal_entries_school_status_date ON journal_entries (school_id, status, entry_date)",
+)
+
+@SCHEMA_MIGRATIONS.register(2, "hot-path indexes")
+def _migration_indexes(conn):
+    # See db_indexes.INDEX_CATALOGUE for which endpoints each index serves.
+    for statement in _MIGRATION_2_INDEXES:
+        conn.execute(statement)
+
+
+@SCHEMA_MIGRATIONS.register(3, "seed reference data")
+def _migration_seed_reference_data(conn):
     seed_rbac_data(conn)
     seed_finance_master_data(conn)
     seed_resource_library_data(conn)
 
-    conn.close()
+
+@SCHEMA_MIGRATIONS.register(4, "unique attendance per student and date")
+def _migration_unique_attendance(conn):
+    # The old delete-then-insert path could leave duplicates; keep the latest row.
+    conn.execute("""
+        DELETE FROM student_attendance
+        WHERE id NOT IN (SELECT MAX(id) FROM student_attendance GROUP BY student_id, date)
+    """)
+    conn.execute("DROP INDEX IF EXISTS ix_student_attendance_student_date")
+    conn.execute(index_by_name("ux_student_attendance_student_date").create_sql())
+
+
+@SCHEMA_MIGRATIONS.register(5, "notification outbox")
+def _migration_notification_outbox(conn):
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in outbox_ddl("SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+
+
+@SCHEMA_MIGRATIONS.register(6, "course module chunks for retrieval")
+def _migration_module_chunks(conn):
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in chunks_ddl("SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+    modules = conn.execute("""
+        SELECT m.id, s.course_id, m.title, m.searchable_text FROM lms_course_modules m
+        JOIN lms_course_sections s ON m.section_id = s.id
+        WHERE m.searchable_text IS NOT NULL AND m.searchable_text != ''
+        ORDER BY m.id
+    """).fetchall()
+    rows = []
+    for m in modules:
+        rows.extend(module_chunk_rows(m['id'], m['course_id'], m['title'], m['searchable_text'], COURSE_CHUNK_WORDS, COURSE_CHUNK_OVERLAP))
+    insert_rows(conn, "lms_module_chunks", CHUNK_COLUMNS, rows)
+
+
+@SCHEMA_MIGRATIONS.register(7, "resource full-text index")
+def _migration_resource_search(conn):
+    # FTS5 table + sync triggers on SQLite, generated tsvector + GIN index on Postgres.
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in resource_search_ddl(is_postgres):
+        conn.execute(statement)
+
+
+@SCHEMA_MIGRATIONS.register(8, "extracted text cache")
+def _migration_extracted_texts(conn):
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in extraction_ddl("SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+
+
+@SCHEMA_MIGRATIONS.register(9, "quiz feedback jobs")
+def _migration_quiz_feedback_jobs(conn):
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in feedback_jobs_ddl("SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+
+
+@SCHEMA_MIGRATIONS.register(10, "materialized gl balances")
+def _migration_gl_balances(conn):
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in gl_balances.balances_ddl("SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+    gl_balances.rebuild(conn)
+
+
+@SCHEMA_MIGRATIONS.register(11, "document number sequences")
+def _migration_doc_sequences(conn):
+    # Counters start from the numbers already in use the first time each one is needed.
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    for statement in sequences_ddl("SERIAL PRIMARY KEY" if is_postgres else "INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+
+
+@SCHEMA_MIGRATIONS.register(12, "depreciation schedule period index")
+def _migration_depreciation_period_index(conn):
+    conn.execute(index_by_name("ix_depreciation_schedule_period").create_sql())
+
+
+@SCHEMA_MIGRATIONS.register(13, "payroll indexes")
+def _migration_payroll_indexes(conn):
+    conn.execute(index_by_name("ix_payroll_lines_run_employee").create_sql())
+    conn.execute(index_by_name("ix_salary_structures_school_status").create_sql())
+
+
+def initialize_db(apply_migrations: bool = True):
+    """Bring the schema up to date; returns the resulting schema version.
+
+    On an up-to-date database this is a single version lookup. With
+    apply_migrations=False pending steps are only reported (run migrate.py).
+    """
+    conn = get_db_connection()
+    try:
+        current = SCHEMA_MIGRATIONS.current_version(conn)
+        head = SCHEMA_MIGRATIONS.head
+        if current >= head:
+            logger.info(f"Database schema up to date (version {current}).")
+            return current
+        if not apply_migrations:
+            logger.warning(f"Database schema at version {current}, code expects {head}. Run `python migrate.py`.")
+            return current
+        applied = SCHEMA_MIGRATIONS.migrate(conn)
+        logger.info(f"Database migrated from version {current} to {head} ({len(applied)} step(s)).")
+        return head
+    finally:
+        conn.close()
 
 def seed_rbac_data(conn):
     cursor = conn.cursor()
@@ -3699,6 +4315,7 @@ def seed_rbac_data(conn):
     ])
 
     conn.commit()
+    invalidate_permission_cache()
 
 def seed_finance_master_data(conn):
     cursor = conn.cursor()
@@ -3797,7 +4414,8 @@ def seed_finance_master_data(conn):
     except Exception:
         conn.rollback()
 
-def seed_resource_library_data(conn):
+def seed_resource_library_data(conn, school_ids: Optional[List[int]] = None):
+    """Seed the standard form resources for school_ids (default: every school)."""
     cursor = conn.cursor()
     now = datetime.now().isoformat()
     uploaded_by = "admin_user"
@@ -3806,8 +4424,9 @@ def seed_resource_library_data(conn):
     os.makedirs(resources_dir, exist_ok=True)
 
     try:
-        school_rows = cursor.execute("SELECT id FROM schools").fetchall()
-        school_ids = [int(r["id"]) for r in school_rows if r["id"] is not None] if school_rows else [1]
+        if school_ids is None:
+            school_rows = cursor.execute("SELECT id FROM schools").fetchall()
+            school_ids = [int(r["id"]) for r in school_rows if r["id"] is not None] if school_rows else [1]
         if not school_ids:
             school_ids = [1]
 
@@ -3849,6 +4468,8 @@ def seed_resource_library_data(conn):
                     (title, description, web_path, uploaded_by, now, school_id)
                 )
         conn.commit()
+        for school_id in school_ids:
+            invalidate_resource_summary(school_id)
     except Exception:
         conn.rollback()
 
@@ -3940,6 +4561,7 @@ async def update_permission(perm_id: int, req: UpdatePermissionRequest, x_user_i
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Permission not found")
         conn.commit()
+        invalidate_permission_cache()
         return {"success": True}
     except Exception as e:
         conn.rollback()
@@ -4062,6 +4684,7 @@ async def create_role(req: RoleCreateRequest):
                 cur.execute("INSERT INTO role_permissions (role_id, permission_id) VALUES (?, ?)", (role_id, perm['id']))
         
         conn.commit()
+        invalidate_permission_cache()
         return {"success": True, "role_id": role_id}
     except Exception as e:
         conn.rollback()
@@ -4085,6 +4708,7 @@ async def update_role(role_id: int, req: RoleCreateRequest):
                 cur.execute("INSERT INTO role_permissions (role_id, permission_id) VALUES (?, ?)", (role_id, perm['id']))
                 
         conn.commit()
+        invalidate_permission_cache()
         return {"success": True}
     except Exception as e:
         conn.rollback()
@@ -4104,6 +4728,7 @@ async def delete_role(role_id: int):
              
         cur.execute("DELETE FROM roles WHERE id = ?", (role_id,))
         conn.commit()
+        invalidate_permission_cache()
         return {"success": True}
     except HTTPException as he:
         raise he
@@ -4252,34 +4877,57 @@ async def delete_role(role_id: int):
 
 # --- 5. ML ENGINE ---
 
-ML_MODEL = None
 DIFF_LABEL_MAP = {0: 'Easy', 1: 'Medium', 2: 'Hard'}
 DIFFICULTY_MAP = {'Easy': 0, 'Medium': 1, 'Hard': 2}
 
+RECOMMENDER_MODEL_PATH = os.getenv("RECOMMENDER_MODEL_PATH", os.path.join(BASE_DIR, "models", "recommendation.joblib"))
+RECOMMENDER_RETRAIN_AFTER = int(os.getenv("RECOMMENDER_RETRAIN_AFTER", "50"))
+RECOMMENDER_RETRAIN_INTERVAL = float(os.getenv("RECOMMENDER_RETRAIN_INTERVAL", "3600"))
+
+def _count_activities_since(watermark: int) -> int:
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT COUNT(*) AS c FROM activities WHERE id > ?", (watermark,)).fetchone()
+        return int(row['c'] or 0) if row else 0
+    finally:
+        conn.close()
+
+RECOMMENDER = RecommendationModelManager(
+    load_training_data=lambda: fetch_data_df("SELECT id, score, time_spent_min, difficulty FROM activities"),
+    count_new_since=_count_activities_since,
+    label_encoding=DIFFICULTY_MAP,
+    path=RECOMMENDER_MODEL_PATH,
+    min_samples=MIN_ACTIVITIES,
+    retrain_after=RECOMMENDER_RETRAIN_AFTER,
+    interval=RECOMMENDER_RETRAIN_INTERVAL,
+    retry_base=float(os.getenv("RECOMMENDER_RETRY_SECONDS", "30")),
+)
+
 def train_recommendation_model():
-    global ML_MODEL
-    # Lazy import to prevent startup bottleneck
-    from sklearn.ensemble import RandomForestClassifier
-    df = fetch_data_df("SELECT score, time_spent_min, difficulty FROM activities")
-    
-    if len(df) < MIN_ACTIVITIES:
-        ML_MODEL = None
-        return
+    """Refit synchronously (the background trainer normally does this)."""
+    return RECOMMENDER.train_now()
 
-    X = df[['score', 'time_spent_min']]
-    y = [DIFFICULTY_MAP.get(d, 1) for d in df['difficulty']] 
-    
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        clf = RandomForestClassifier(n_estimators=50, random_state=42)
-        clf.fit(X, y)
-    
-    ML_MODEL = clf
+def _format_recommendation(score, prediction: Optional[int]) -> str:
+    rec_diff = DIFF_LABEL_MAP.get(prediction, 'Medium')
+    return f"Based on your last score of {score}%, we recommend trying a **{rec_diff}** difficulty topic next!"
 
-def get_recommendation(student_id: str) -> Optional[str]:
-    train_recommendation_model() 
-    if not ML_MODEL:
-        return "Not enough data (minimum 5 activities) to generate an ML-based recommendation."
+RECOMMENDER_NOT_ENOUGH_DATA = f"Not enough data (minimum {MIN_ACTIVITIES} activities) to generate an ML-based recommendation."
+RECOMMENDER_TRAINING = "The recommendation model is still being trained. Check back in a minute."
+RECOMMENDER_FAILED = "Recommendations are temporarily unavailable: the model could not be trained."
+
+def _recommender_unavailable_message() -> Optional[str]:
+    """Why no recommendation can be made right now, or None when the model is ready."""
+    state = RECOMMENDER.state
+    if state == "ready":
+        return None
+    if state == "failed":
+        return RECOMMENDER_FAILED
+    return RECOMMENDER_TRAINING if state == "training" else RECOMMENDER_NOT_ENOUGH_DATA
+
+def get_recommendation(student_id: str) -> Optional[str]:
+    unavailable = _recommender_unavailable_message()
+    if unavailable:
+        return unavailable
 
     df_history = fetch_data_df("SELECT score, time_spent_min FROM activities WHERE student_id = ? ORDER BY date DESC LIMIT 1", (student_id,))
     
@@ -4287,15 +4935,35 @@ def get_recommendation(student_id: str) -> Optional[str]:
         return "No activity history available to base a recommendation on."
 
     last_activity = df_history.iloc[0]
-    import numpy as np
-    X_pred = np.array([[last_activity['score'], last_activity['time_spent_min']]])
-    
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        pred_idx = ML_MODEL.predict(X_pred)[0]
-    
-    rec_diff = DIFF_LABEL_MAP.get(pred_idx, 'Medium')
-    return f"Based on your last score of {last_activity['score']}%, we recommend trying a **{rec_diff}** difficulty topic next!"
+    pred_idx = RECOMMENDER.predict(last_activity['score'] or 0, last_activity['time_spent_min'] or 0)
+    return _format_recommendation(last_activity['score'], pred_idx)
+
+def get_recommendations_batch(student_ids: List[str]) -> Dict[str, str]:
+    """Recommendation per student from each one's latest activity, scored in one predict call."""
+    if not student_ids:
+        return {}
+    unavailable = _recommender_unavailable_message()
+    if unavailable:
+        return {sid: unavailable for sid in student_ids}
+
+    df = fetch_data_df(f"""
+        SELECT student_id, score, time_spent_min FROM (
+            SELECT student_id, score, time_spent_min,
+                   ROW_NUMBER() OVER (PARTITION BY student_id ORDER BY date DESC) AS rn
+            FROM activities
+            WHERE student_id IN ({sql_placeholders(len(student_ids))})
+        ) latest
+        WHERE rn = 1
+    """, tuple(student_ids))
+
+    results = {sid: "No activity history available to base a recommendation on." for sid in student_ids}
+    if df.empty:
+        return results
+    rows = list(zip(df['score'].fillna(0), df['time_spent_min'].fillna(0)))
+    preds = RECOMMENDER.predict_batch(rows) or []
+    for sid, score, pred in zip(df['student_id'], df['score'], preds):
+        results[sid] = _format_recommendation(score, pred)
+    return results
 
 # ML Model training moved to startup event
 
@@ -4333,66 +5001,84 @@ def check_permission(user_role: str, required_permission: str) -> bool:
         return False
     return required_permission in ROLE_PERMISSIONS[user_role]
 
-async def verify_permission(permission: str, x_user_role: str = Header(None, alias="X-User-Role"), x_user_id: str = Header(None, alias="X-User-Id")):
-    if not x_user_id:
-         raise HTTPException(status_code=401, detail="Authentication required")
+# Effective permissions per user, so guarded endpoints skip the students lookup and
+# the user_roles/role_permissions/permissions join on repeat calls. Cleared on any
+# role/permission change (invalidate_permission_cache); other workers catch up
+# within PERMISSION_CACHE_TTL seconds.
+PERMISSION_CACHE_TTL = float(os.getenv("PERMISSION_CACHE_TTL", "60"))
+PERMISSION_CACHE_SIZE = int(os.getenv("PERMISSION_CACHE_SIZE", "4096"))
+PERMISSION_CACHE = TTLCache(maxsize=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL)
+
+def invalidate_permission_cache(user_id: Optional[str] = None):
+    """Drop one user's cached permissions, or everyone's when user_id is None."""
+    if user_id is None:
+        PERMISSION_CACHE.clear()
+    else:
+        PERMISSION_CACHE.invalidate(user_id)
 
+def _load_user_permissions(user_id: str) -> Optional[Dict[str, Any]]:
     conn = get_db_connection()
     try:
-        user = conn.execute("SELECT role, is_super_admin FROM students WHERE id = ?", (x_user_id,)).fetchone()
-        
+        user = conn.execute("SELECT role, is_super_admin FROM students WHERE id = ?", (user_id,)).fetchone()
         if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-
-        current_role = user['role']
-        is_super = user['is_super_admin']
-
-        # 1. Super Admin Override
-        if is_super or current_role == 'Super Admin':
-            return True
-
-        # 2. Check DB Permissions
-        # Join user_roles -> roles -> role_permissions -> permissions
-        # Also check for wildcard '*' permission assignment
-        query = """
-            SELECT 1 
+            return None
+        rows = conn.execute("""
+            SELECT DISTINCT p.code
             FROM user_roles ur
             JOIN role_permissions rp ON ur.role_id = rp.role_id
             JOIN permissions p ON rp.permission_id = p.id
-            WHERE ur.user_id = ? 
-            AND (p.code = ? OR p.code = '*')
-        """
-        has_perm = conn.execute(query, (x_user_id, permission)).fetchone()
-
-        if not has_perm:
-            # Fallback to legacy hardcoded check if DB check fails (temporary migration specific)
-            # Remove this if fully migrated
-            if current_role in ROLE_PERMISSIONS and permission in ROLE_PERMISSIONS[current_role]:
-                return True
-                
-            log_auth_event(x_user_id, "Unauthorized Access", f"Missing permission: {permission}")
-            raise HTTPException(status_code=403, detail=f"Permission denied: {permission} required.")
-        
-        return True
+            WHERE ur.user_id = ?
+        """, (user_id,)).fetchall()
+        return {
+            "role": user['role'],
+            "is_super_admin": bool(user['is_super_admin']),
+            "codes": frozenset(r['code'] for r in rows),
+        }
     finally:
         conn.close()
 
+def get_user_permissions(user_id: str) -> Optional[Dict[str, Any]]:
+    """Cached {"role", "is_super_admin", "codes"} for a user, or None if the user does not exist."""
+    return PERMISSION_CACHE.get_or_load(user_id, lambda: _load_user_permissions(user_id))
+
+async def verify_permission(permission: str, x_user_role: str = Header(None, alias="X-User-Role"), x_user_id: str = Header(None, alias="X-User-Id")):
+    if not x_user_id:
+         raise HTTPException(status_code=401, detail="Authentication required")
+    await run_db(_check_permissions_sync, [permission], x_user_id)
+    return True
+
+def _check_permissions_sync(permission_codes: List[str], x_user_id: str) -> str:
+    """Return the first code in permission_codes the user holds; raise 401/403 otherwise."""
+    perms = get_user_permissions(x_user_id)
+    if not perms:
+        raise HTTPException(status_code=401, detail="User not found")
+
+    current_role = perms['role']
+
+    # 1. Super Admin Override
+    if perms['is_super_admin'] or current_role == 'Super Admin':
+        return permission_codes[0] if permission_codes else ""
+
+    # 2. DB permissions, including the wildcard '*' assignment
+    codes = perms['codes']
+    for permission in permission_codes:
+        if '*' in codes or permission in codes:
+            return permission
+        # Fallback to legacy hardcoded check if DB check fails (temporary migration specific)
+        # Remove this if fully migrated
+        if current_role in ROLE_PERMISSIONS and permission in ROLE_PERMISSIONS[current_role]:
+            return permission
+
+    if not permission_codes:
+        raise HTTPException(status_code=403, detail="Permission denied.")
+    log_auth_event(x_user_id, "Unauthorized Access", f"Missing permission: {' | '.join(permission_codes)}")
+    raise HTTPException(status_code=403, detail=f"Permission denied: {permission_codes[-1]} required.")
+
 async def verify_any_permission(permission_codes: List[str], x_user_id: str) -> str:
+    """Return the first of permission_codes the user holds, with a single (cached) lookup."""
     if not x_user_id:
         raise HTTPException(status_code=401, detail="Authentication required")
-    denied = None
-    for code in permission_codes:
-        try:
-            await verify_permission(code, x_user_id=x_user_id)
-            return code
-        except HTTPException as e:
-            denied = e
-            if e.status_code == 401:
-                raise
-            continue
-    if denied:
-        raise denied
-    raise HTTPException(status_code=403, detail="Permission denied.")
+    return await run_db(_check_permissions_sync, list(permission_codes), x_user_id)
 
 
 # --- LMS & UPLOADS CONFIGURATION ---
@@ -4451,6 +5137,22 @@ async def health_check():
         "message": "ClassBridge Backend is running",
         "environment": "production" if IS_PRODUCTION else "development",
         "database": db_status,
+        "db_pool": PG_POOL.stats() if PG_POOL is not None else None,
+        "permission_cache": PERMISSION_CACHE.stats(),
+        "teacher_overview_cache": TEACHER_OVERVIEW_CACHE.stats(),
+        "recommender": RECOMMENDER.status(),
+        "outbox": OUTBOX_DISPATCHER.stats(),
+        "llm": LLM.stats(),
+        "ai_response_cache": AI_RESPONSE_CACHE.stats(),
+        "ai_context_cache": AI_CONTEXT_CACHE.stats(),
+        "ai_sql": AI_SQL.stats(),
+        "extraction": EXTRACTION.stats(),
+        "grading": GRADER.stats(),
+        "quiz_feedback": QUIZ_FEEDBACK.stats(),
+        "doc_sequences": DOC_SEQUENCES.stats(),
+        "prompts": {**PROMPT_ASSEMBLER.stats(), "tutor_prefix_tokens": TUTOR_PROMPT_PREFIX.tokens,
+                    "teacher_prefix_tokens": TEACHER_PROMPT_PREFIX.tokens},
+        "course_retrieval": COURSE_RETRIEVER.stats(),
         "cors_enabled": True,
         "ai_enabled": AI_ENABLED,
         "timestamp": datetime.now().isoformat()
@@ -4606,23 +5308,47 @@ def _as_bool(value: Any, default: bool = True) -> bool:
         return value.strip().lower() in ("1", "true", "yes", "y", "on")
     return default
 
+# Journal and document numbers come from per-(school, prefix, period) counters
+# (see doc_sequences.py). Blocks need their own committed connection, which a
+# SQLite writer would wait on, so they are only used on Postgres.
+DOC_SEQUENCE_BLOCK_SIZE = int(os.getenv("DOC_SEQUENCE_BLOCK_SIZE", "1"))
+DOC_SEQUENCES = SequenceAllocator(
+    get_db_connection,
+    block_size=DOC_SEQUENCE_BLOCK_SIZE if USE_POSTGRES and ('postgres' in DATABASE_URL.lower()) else 1,
+)
+
+def _max_number_in_use(conn, school_id: int, table_name: str, column_name: str, start: str) -> int:
+    rows = conn.execute(
+        f"SELECT {column_name} AS val FROM {table_name} WHERE school_id = ? AND {column_name} LIKE ?",
+        (school_id, start + "%")
+    ).fetchall()
+    highest = 0
+    for r in rows:
+        try:
+            highest = max(highest, int(str(r["val"])[len(start):]))
+        except (TypeError, ValueError):
+            continue
+    return highest
+
 def _gl_next_journal_number(conn, school_id: int, prefix: str = "GL") -> str:
     day = datetime.now().strftime("%Y%m%d")
     start = f"{prefix}-{day}-"
-    row = conn.execute(
-        "SELECT journal_number FROM journal_entries WHERE school_id = ? AND journal_number LIKE ? ORDER BY journal_number DESC LIMIT 1",
-        (school_id, start + "%")
-    ).fetchone()
-    if not row:
-        seq = 1
-    else:
-        last = row["journal_number"] or ""
-        try:
-            seq = int(last.split("-")[-1]) + 1
-        except Exception:
-            seq = 1
+    seq = DOC_SEQUENCES.next(
+        conn, school_id, f"journal_entries.{prefix}", day,
+        seed=lambda c: _max_number_in_use(c, school_id, "journal_entries", "journal_number", start)
+    )
     return f"{start}{seq:04d}"
 
+def _gl_reserve_journal_numbers(conn, school_id: int, count: int, prefix: str = "GL") -> List[str]:
+    """``count`` consecutive journal numbers from one counter increment."""
+    day = datetime.now().strftime("%Y%m%d")
+    start = f"{prefix}-{day}-"
+    first = DOC_SEQUENCES.reserve(
+        conn, school_id, f"journal_entries.{prefix}", count, day,
+        seed=lambda c: _max_number_in_use(c, school_id, "journal_entries", "journal_number", start)
+    )
+    return [f"{start}{seq:04d}" for seq in range(first, first + count)]
+
 def _gl_resolve_account_id(conn, school_id: int, line: GLJournalLineInput) -> int:
     if line.account_id:
         row = conn.execute(
@@ -4750,6 +5476,49 @@ async def create_gl_journal(request: GLJournalCreateRequest, x_user_id: str = He
     finally:
         conn.close()
 
+GL_IMPORT_MAX_ROWS = int(os.getenv("GL_IMPORT_MAX_ROWS", "50000"))
+GL_IMPORT_CHUNK_JOURNALS = int(os.getenv("GL_IMPORT_CHUNK_JOURNALS", "200"))
+
+@app.post("/api/finance/gl/journals/import")
+@app.post("/finance/gl/journals/import")
+async def import_gl_journals(
+    file: UploadFile = File(...),
+    post: bool = Form(False),
+    x_user_id: str = Header(None, alias="X-User-Id")
+):
+    """Create many journals from a CSV or JSON-lines file (see gl_import.py).
+
+    Columns: journal_ref, entry_date, description, reference, period_id,
+    account_code or account_id, line_description, debit, credit,
+    cost_center_id, tax_code_id, party_id. With post=true the journals are
+    created as Posted instead of Draft.
+    """
+    await verify_any_permission(["finance.gl.manage", "finance.manage"], x_user_id)
+    data = await file.read()
+    return await run_db(_import_gl_journals_sync, data, file.filename, post, x_user_id)
+
+def _import_gl_journals_sync(data: bytes, filename: Optional[str], post: bool, x_user_id: Optional[str]):
+    result = gl_import.ImportResult()
+    rows = gl_import.parse_upload(data, filename, result)
+    if len(rows) > GL_IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=413, detail=f"Import is limited to {GL_IMPORT_MAX_ROWS} rows per file.")
+    if not rows and not result.errors:
+        raise HTTPException(status_code=400, detail="The file contains no journal rows.")
+    conn = get_db_connection()
+    try:
+        school_id = _resolve_school_id(conn, x_user_id)
+        accounts = conn.execute("SELECT id, code FROM accounts WHERE school_id = ? AND is_active = TRUE", (school_id,)).fetchall()
+        periods = {int(p["id"]): p["status"] for p in conn.execute("SELECT id, status FROM periods WHERE school_id = ?", (school_id,)).fetchall()}
+        journals = gl_import.prepare(rows, accounts, periods, result)
+        gl_import.write_journals(
+            conn, school_id, x_user_id, journals,
+            lambda c, count: _gl_reserve_journal_numbers(c, school_id, count, "GL"),
+            result, post=post, chunk_size=GL_IMPORT_CHUNK_JOURNALS
+        )
+        return {"status": "Posted" if post else "Draft", **result.to_dict()}
+    finally:
+        conn.close()
+
 @app.post("/api/finance/gl/journals/{journal_id}/post")
 @app.post("/finance/gl/journals/{journal_id}/post")
 async def post_gl_journal(journal_id: int, x_user_id: str = Header(None, alias="X-User-Id")):
@@ -4785,6 +5554,7 @@ async def post_gl_journal(journal_id: int, x_user_id: str = Header(None, alias="
             """,
             (round(total_debit, 2), round(total_credit, 2), now, x_user_id, now, journal_id)
         )
+        gl_balances.apply_journal(conn, journal_id, 1)
         conn.commit()
         posted = conn.execute("SELECT * FROM journal_entries WHERE id = ?", (journal_id,)).fetchone()
         return {"journal": dict(posted), "lines": _gl_fetch_lines(conn, journal_id)}
@@ -4865,6 +5635,8 @@ async def reverse_gl_journal(journal_id: int, request: Optional[GLJournalReverse
             """,
             (reversal_id, now, x_user_id, reason, now, journal_id)
         )
+        gl_balances.apply_journal(conn, journal_id, -1)
+        gl_balances.apply_journal(conn, reversal_id, 1)
         conn.commit()
         return {
             "message": "Journal reversed successfully.",
@@ -4880,20 +5652,6 @@ async def reverse_gl_journal(journal_id: int, request: Optional[GLJournalReverse
     finally:
         conn.close()
 
-def _gl_build_filters(period_id: Optional[int], date_from: Optional[str], date_to: Optional[str]) -> (str, List[Any]):
-    clauses = ["je.status = 'Posted'"]
-    params: List[Any] = []
-    if period_id:
-        clauses.append("je.period_id = ?")
-        params.append(period_id)
-    if date_from:
-        clauses.append("je.entry_date >= ?")
-        params.append(date_from)
-    if date_to:
-        clauses.append("je.entry_date <= ?")
-        params.append(date_to)
-    return " AND ".join(clauses), params
-
 @app.get("/api/finance/gl/reports/trial-balance")
 @app.get("/finance/gl/reports/trial-balance")
 async def get_gl_trial_balance(
@@ -4906,25 +5664,7 @@ async def get_gl_trial_balance(
     conn = get_db_connection()
     try:
         school_id = _resolve_school_id(conn, x_user_id)
-        filter_sql, filter_params = _gl_build_filters(period_id, date_from, date_to)
-        rows = conn.execute(
-            f"""
-            SELECT
-                a.id AS account_id,
-                a.code AS account_code,
-                a.name AS account_name,
-                a.account_type,
-                COALESCE(SUM(jl.debit), 0) AS total_debit,
-                COALESCE(SUM(jl.credit), 0) AS total_credit
-            FROM journal_lines jl
-            JOIN journal_entries je ON je.id = jl.journal_entry_id
-            JOIN accounts a ON a.id = jl.account_id
-            WHERE je.school_id = ? AND {filter_sql}
-            GROUP BY a.id, a.code, a.name, a.account_type
-            ORDER BY a.code
-            """,
-            (school_id, *filter_params)
-        ).fetchall()
+        rows = gl_balances.account_totals(conn, school_id, period_id, date_from, date_to)
         data = []
         debit_total = 0.0
         credit_total = 0.0
@@ -4935,8 +5675,8 @@ async def get_gl_trial_balance(
             credit_total += tc
             data.append({
                 "account_id": r["account_id"],
-                "account_code": r["account_code"],
-                "account_name": r["account_name"],
+                "account_code": r["code"],
+                "account_name": r["name"],
                 "account_type": r["account_type"],
                 "total_debit": round(td, 2),
                 "total_credit": round(tc, 2),
@@ -4966,21 +5706,7 @@ async def get_gl_profit_and_loss(
     conn = get_db_connection()
     try:
         school_id = _resolve_school_id(conn, x_user_id)
-        filter_sql, filter_params = _gl_build_filters(period_id, date_from, date_to)
-        rows = conn.execute(
-            f"""
-            SELECT a.code, a.name, a.account_type,
-                   COALESCE(SUM(jl.debit), 0) AS total_debit,
-                   COALESCE(SUM(jl.credit), 0) AS total_credit
-            FROM journal_lines jl
-            JOIN journal_entries je ON je.id = jl.journal_entry_id
-            JOIN accounts a ON a.id = jl.account_id
-            WHERE je.school_id = ? AND {filter_sql} AND a.account_type IN ('Revenue', 'Expense')
-            GROUP BY a.code, a.name, a.account_type
-            ORDER BY a.code
-            """,
-            (school_id, *filter_params)
-        ).fetchall()
+        rows = gl_balances.account_totals(conn, school_id, period_id, date_from, date_to, account_types=("Revenue", "Expense"))
         revenues = []
         expenses = []
         total_revenue = 0.0
@@ -5021,22 +5747,7 @@ async def get_gl_balance_sheet(
     conn = get_db_connection()
     try:
         school_id = _resolve_school_id(conn, x_user_id)
-        filter_sql, filter_params = _gl_build_filters(period_id, date_from, date_to)
-        rows = conn.execute(
-            f"""
-            SELECT a.code, a.name, a.account_type,
-                   COALESCE(SUM(jl.debit), 0) AS total_debit,
-                   COALESCE(SUM(jl.credit), 0) AS total_credit
-            FROM journal_lines jl
-            JOIN journal_entries je ON je.id = jl.journal_entry_id
-            JOIN accounts a ON a.id = jl.account_id
-            WHERE je.school_id = ? AND {filter_sql}
-              AND a.account_type IN ('Asset', 'Liability', 'Equity')
-            GROUP BY a.code, a.name, a.account_type
-            ORDER BY a.code
-            """,
-            (school_id, *filter_params)
-        ).fetchall()
+        rows = gl_balances.account_totals(conn, school_id, period_id, date_from, date_to, account_types=("Asset", "Liability", "Equity"))
         assets = []
         liabilities = []
         equity = []
@@ -5073,18 +5784,42 @@ async def get_gl_balance_sheet(
     finally:
         conn.close()
 
-def _next_doc_number(conn, school_id: int, table_name: str, column_name: str, prefix: str) -> str:
-    row = conn.execute(
-        f"SELECT {column_name} AS val FROM {table_name} WHERE school_id = ? AND {column_name} LIKE ? ORDER BY {column_name} DESC LIMIT 1",
-        (school_id, prefix + "%")
-    ).fetchone()
-    if not row or not row["val"]:
-        return f"{prefix}0001"
+@app.post("/api/finance/gl/balances/rebuild")
+@app.post("/finance/gl/balances/rebuild")
+async def rebuild_gl_balances(x_user_id: str = Header(None, alias="X-User-Id")):
+    """Recompute the school's materialized balances from its posted journal lines."""
+    await verify_any_permission(["finance.gl.manage", "finance.manage"], x_user_id)
+    conn = get_db_connection()
     try:
-        last_seq = int(str(row["val"]).replace(prefix, ""))
-    except Exception:
-        last_seq = 0
-    return f"{prefix}{last_seq + 1:04d}"
+        school_id = _resolve_school_id(conn, x_user_id)
+        buckets = gl_balances.rebuild(conn, school_id)
+        conn.commit()
+        return {"message": "GL balances rebuilt.", "buckets": buckets}
+    except Exception as e:
+        conn.rollback()
+        raise HTTPException(status_code=400, detail=f"Unable to rebuild GL balances: {str(e)}")
+    finally:
+        conn.close()
+
+@app.get("/api/finance/gl/balances/check")
+@app.get("/finance/gl/balances/check")
+async def check_gl_balances(x_user_id: str = Header(None, alias="X-User-Id")):
+    """Compare the materialized balances with the raw posted lines."""
+    await verify_any_permission(["finance.reports.read", "finance.view", "finance.gl.manage"], x_user_id)
+    conn = get_db_connection()
+    try:
+        school_id = _resolve_school_id(conn, x_user_id)
+        mismatches = gl_balances.check(conn, school_id)
+        return {"consistent": not mismatches, "mismatches": mismatches}
+    finally:
+        conn.close()
+
+def _next_doc_number(conn, school_id: int, table_name: str, column_name: str, prefix: str) -> str:
+    seq = DOC_SEQUENCES.next(
+        conn, school_id, f"{table_name}.{prefix}",
+        seed=lambda c: _max_number_in_use(c, school_id, table_name, column_name, prefix)
+    )
+    return f"{prefix}{seq:04d}"
 
 def _finance_log_audit(conn, school_id: int, module: str, action: str, entity_type: str, entity_id: Any, actor_id: Optional[str], details: Dict[str, Any]):
     conn.execute(
@@ -5152,6 +5887,7 @@ def _finance_posting_service(
     journal_id = cur.lastrowid
     cur.execute("INSERT INTO journal_lines (journal_entry_id, line_no, account_id, description, debit, credit) VALUES (?, 1, ?, ?, ?, 0)", (journal_id, debit_account_id, description, amount))
     cur.execute("INSERT INTO journal_lines (journal_entry_id, line_no, account_id, description, debit, credit) VALUES (?, 2, ?, ?, 0, ?)", (journal_id, credit_account_id, description, amount))
+    gl_balances.apply_journal(conn, journal_id, 1)
     cur.execute(
         """
         INSERT INTO finance_posting_events (
@@ -5297,42 +6033,17 @@ async def run_finance_reconciliation(x_user_id: str = Header(None, alias="X-User
             "SELECT COALESCE(SUM(valuation_amount),0) AS val FROM stock_valuation WHERE school_id = ?",
             (school_id,)
         ).fetchone()
-        ar_gl = conn.execute(
-            """
-            SELECT COALESCE(SUM(jl.debit),0) - COALESCE(SUM(jl.credit),0) AS val
-            FROM journal_lines jl
-            JOIN journal_entries je ON je.id = jl.journal_entry_id
-            JOIN accounts a ON a.id = jl.account_id
-            WHERE je.school_id = ? AND je.status = 'Posted' AND a.code = '1100'
-            """,
-            (school_id,)
-        ).fetchone()
-        ap_gl = conn.execute(
-            """
-            SELECT COALESCE(SUM(jl.credit),0) - COALESCE(SUM(jl.debit),0) AS val
-            FROM journal_lines jl
-            JOIN journal_entries je ON je.id = jl.journal_entry_id
-            JOIN accounts a ON a.id = jl.account_id
-            WHERE je.school_id = ? AND je.status = 'Posted' AND a.code = '2000'
-            """,
-            (school_id,)
-        ).fetchone()
-        inv_gl = conn.execute(
-            """
-            SELECT COALESCE(SUM(jl.debit),0) - COALESCE(SUM(jl.credit),0) AS val
-            FROM journal_lines jl
-            JOIN journal_entries je ON je.id = jl.journal_entry_id
-            JOIN accounts a ON a.id = jl.account_id
-            WHERE je.school_id = ? AND je.status = 'Posted' AND a.code = '1200'
-            """,
-            (school_id,)
-        ).fetchone()
+        gl = {r["code"]: (float(r["total_debit"] or 0), float(r["total_credit"] or 0))
+              for r in gl_balances.account_totals(conn, school_id, account_codes=("1100", "2000", "1200"))}
+        ar_debit, ar_credit = gl.get("1100", (0.0, 0.0))
+        ap_debit, ap_credit = gl.get("2000", (0.0, 0.0))
+        inv_debit, inv_credit = gl.get("1200", (0.0, 0.0))
         ar_subledger = round(float(ar_subledger_row["val"] or 0), 2)
         ap_subledger = round(float(ap_subledger_row["val"] or 0), 2)
         inv_subledger = round(float(inv_subledger_row["val"] or 0), 2)
-        ar_gl_val = round(float(ar_gl["val"] or 0), 2)
-        ap_gl_val = round(float(ap_gl["val"] or 0), 2)
-        inv_gl_val = round(float(inv_gl["val"] or 0), 2)
+        ar_gl_val = round(ar_debit - ar_credit, 2)
+        ap_gl_val = round(ap_credit - ap_debit, 2)
+        inv_gl_val = round(inv_debit - inv_credit, 2)
         return {
             "ar": {"subledger": ar_subledger, "gl_control": ar_gl_val, "difference": round(ar_subledger - ar_gl_val, 2), "matched": abs(ar_subledger - ar_gl_val) <= 0.01},
             "ap": {"subledger": ap_subledger, "gl_control": ap_gl_val, "difference": round(ap_subledger - ap_gl_val, 2), "matched": abs(ap_subledger - ap_gl_val) <= 0.01},
@@ -5786,6 +6497,84 @@ async def run_asset_depreciation(payload: Dict[str, Any] = Body(...), x_user_id:
     finally:
         conn.close()
 
+ASSET_DEPRECIATION_JOURNAL_SIZE = int(os.getenv("ASSET_DEPRECIATION_JOURNAL_SIZE", "0"))
+
+@app.post("/api/finance/assets/depreciation/run-period")
+async def run_period_depreciation(payload: Dict[str, Any] = Body(...), x_user_id: str = Header(None, alias="X-User-Id")):
+    """Charge one period's depreciation for every active asset (see depreciation.py).
+
+    journal_size > 0 posts one journal per that many assets instead of one
+    summarised journal; dry_run returns the charges without posting them.
+    """
+    await verify_any_permission(["finance.assets.manage", "finance.manage"], x_user_id)
+    if not payload.get("period_label") or not payload.get("period_start") or not payload.get("period_end"):
+        raise HTTPException(status_code=400, detail="period_label, period_start and period_end are required.")
+    try:
+        period_end = datetime.fromisoformat(str(payload["period_end"])).date().isoformat()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="period_end must be an ISO date (YYYY-MM-DD).")
+    return await run_db(_run_period_depreciation_sync, payload, period_end, x_user_id)
+
+def _run_period_depreciation_sync(payload: Dict[str, Any], period_end: str, x_user_id: Optional[str]):
+    started = time.perf_counter()
+    period = {"period_label": str(payload["period_label"]), "period_start": payload["period_start"], "period_end": period_end}
+    conn = get_db_connection()
+    try:
+        school_id = _resolve_school_id(conn, x_user_id)
+        assets = conn.execute(
+            """
+            SELECT fa.id, fa.asset_code, fa.status, fa.capitalization_date, fa.cost, fa.residual_value,
+                   fa.useful_life_months, fa.accumulated_depreciation,
+                   ac.depreciation_expense_account_id, ac.accumulated_depreciation_account_id
+            FROM fixed_assets fa
+            JOIN asset_categories ac ON ac.id = fa.category_id
+            WHERE fa.school_id = ?
+            ORDER BY fa.id
+            """,
+            (school_id,)
+        ).fetchall()
+        already_charged = {int(r["asset_id"]) for r in conn.execute(
+            "SELECT asset_id FROM depreciation_schedule WHERE school_id = ? AND period_label = ? AND status = 'Posted'",
+            (school_id, period["period_label"])
+        ).fetchall()}
+        # Payload accounts override the category's; the category's override the school defaults.
+        expense_override = payload.get("depreciation_expense_account_id")
+        accumulated_override = payload.get("accumulated_depreciation_account_id")
+        defaults: Dict[str, int] = {}
+        def default_account(code: str) -> int:
+            if code not in defaults:
+                defaults[code] = _finance_account_id_by_code(conn, school_id, code)
+            return defaults[code]
+        computed = compute_charges(
+            assets, period_end, already_charged,
+            lambda a: int(expense_override or a["depreciation_expense_account_id"] or default_account("5100")),
+            lambda a: int(accumulated_override or a["accumulated_depreciation_account_id"] or default_account("1300")),
+        )
+        charges = computed["charges"]
+        result = {
+            "period_label": period["period_label"],
+            "assets_charged": len(charges),
+            "total_depreciation": round(sum(c.amount for c in charges), 2),
+            "skipped": computed["skipped"],
+        }
+        if _as_bool(payload.get("dry_run"), False):
+            result["charges"] = [c.__dict__ for c in charges]
+        elif charges:
+            posted = post_charges(
+                conn, school_id, x_user_id, period, charges,
+                lambda c, count: _gl_reserve_journal_numbers(c, school_id, count, "GL"),
+                journal_size=int(payload.get("journal_size", ASSET_DEPRECIATION_JOURNAL_SIZE) or 0),
+                posting_date=payload.get("posting_date"),
+            )
+            result.update(posted)
+        result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return result
+    except HTTPException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
 @app.post("/api/finance/assets/dispose")
 async def dispose_fixed_asset(payload: Dict[str, Any] = Body(...), x_user_id: str = Header(None, alias="X-User-Id")):
     await verify_any_permission(["finance.assets.manage", "finance.manage"], x_user_id)
@@ -5893,19 +6682,50 @@ async def generate_payroll_run(payload: Dict[str, Any] = Body(...), x_user_id: s
         cur = conn.cursor()
         cur.execute("INSERT INTO payroll_runs (school_id, run_code, period_label, period_start, period_end, pay_date, status, created_by, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, 'Draft', ?, ?, ?)", (school_id, run_code, payload["period_label"], payload["period_start"], payload["period_end"], payload.get("pay_date"), x_user_id, now, now))
         run_id = cur.lastrowid
-        structs = conn.execute("SELECT ss.*, e.id AS employee_id FROM salary_structures ss JOIN employees e ON e.id = ss.employee_id WHERE ss.school_id = ? AND ss.status = 'Active' AND e.status = 'Active'", (school_id,)).fetchall()
-        gross_total = ded_total = tax_total = net_total = 0.0
-        for s in structs:
-            basic = float(s["basic_salary"] or 0); allow = float(s["allowances"] or 0); ded = float(s["deductions"] or 0); tax = float(s["tax_amount"] or 0)
-            net = round((basic + allow) - (ded + tax), 2); gross = round(basic + allow, 2)
-            cur.execute("INSERT INTO payroll_lines (payroll_run_id, employee_id, basic_salary, allowances, deductions, tax_amount, net_pay, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'Generated', ?, ?)", (run_id, s["employee_id"], basic, allow, ded, tax, net, now, now))
-            gross_total += gross; ded_total += ded; tax_total += tax; net_total += net
-        conn.execute("UPDATE payroll_runs SET total_gross = ?, total_deductions = ?, total_tax = ?, total_net = ?, updated_at = ? WHERE id = ?", (round(gross_total, 2), round(ded_total, 2), round(tax_total, 2), round(net_total, 2), now, run_id))
+        line_count = _generate_payroll_lines(conn, school_id, run_id, now)
         conn.commit()
-        return {"run": dict(conn.execute("SELECT * FROM payroll_runs WHERE id = ?", (run_id,)).fetchone()), "line_count": len(structs)}
+        return {"run": dict(conn.execute("SELECT * FROM payroll_runs WHERE id = ?", (run_id,)).fetchone()), "line_count": line_count}
     finally:
         conn.close()
 
+def _generate_payroll_lines(conn, school_id: int, run_id: int, now: str) -> int:
+    """One payroll line per active salary structure of an active employee, then the run totals.
+
+    Both steps are single statements, so the cost no longer grows with a
+    Python loop over the staff list. Returns the number of lines.
+    """
+    conn.execute(
+        """
+        INSERT INTO payroll_lines (payroll_run_id, employee_id, basic_salary, allowances, deductions, tax_amount, net_pay, status, created_at, updated_at)
+        SELECT ?, ss.employee_id,
+               COALESCE(ss.basic_salary, 0), COALESCE(ss.allowances, 0), COALESCE(ss.deductions, 0), COALESCE(ss.tax_amount, 0),
+               ROUND(CAST(COALESCE(ss.basic_salary, 0) + COALESCE(ss.allowances, 0)
+                          - COALESCE(ss.deductions, 0) - COALESCE(ss.tax_amount, 0) AS NUMERIC), 2),
+               'Generated', ?, ?
+        FROM salary_structures ss
+        JOIN employees e ON e.id = ss.employee_id
+        WHERE ss.school_id = ? AND ss.status = 'Active' AND e.status = 'Active'
+        """,
+        (run_id, now, now, school_id)
+    )
+    conn.execute(
+        """
+        UPDATE payroll_runs
+        SET total_gross = t.gross, total_deductions = t.deductions, total_tax = t.tax, total_net = t.net, updated_at = ?
+        FROM (
+            SELECT ROUND(CAST(COALESCE(SUM(ROUND(CAST(basic_salary + allowances AS NUMERIC), 2)), 0) AS NUMERIC), 2) AS gross,
+                   ROUND(CAST(COALESCE(SUM(deductions), 0) AS NUMERIC), 2) AS deductions,
+                   ROUND(CAST(COALESCE(SUM(tax_amount), 0) AS NUMERIC), 2) AS tax,
+                   ROUND(CAST(COALESCE(SUM(net_pay), 0) AS NUMERIC), 2) AS net
+            FROM payroll_lines WHERE payroll_run_id = ?
+        ) t
+        WHERE payroll_runs.id = ?
+        """,
+        (now, run_id, run_id)
+    )
+    row = conn.execute("SELECT COUNT(*) AS n FROM payroll_lines WHERE payroll_run_id = ?", (run_id,)).fetchone()
+    return int(row["n"] or 0)
+
 @app.post("/api/finance/payroll/runs/{run_id}/approve")
 async def approve_payroll_run(run_id: int, x_user_id: str = Header(None, alias="X-User-Id")):
     await verify_any_permission(["finance.payroll.approve", "finance.manage"], x_user_id)
@@ -5951,6 +6771,7 @@ async def post_payroll_run(run_id: int, payload: Dict[str, Any] = Body(default={
         cur.execute("INSERT INTO journal_lines (journal_entry_id, line_no, account_id, description, debit, credit) VALUES (?, 1, ?, 'Payroll Expense', ?, 0)", (jid, payroll_exp_acc, debit_total))
         cur.execute("INSERT INTO journal_lines (journal_entry_id, line_no, account_id, description, debit, credit) VALUES (?, 2, ?, 'Payroll Payable (Net)', 0, ?)", (jid, payroll_payable_acc, net_pay))
         cur.execute("INSERT INTO journal_lines (journal_entry_id, line_no, account_id, description, debit, credit) VALUES (?, 3, ?, 'Tax Payable', 0, ?)", (jid, tax_payable_acc, tax_amt))
+        gl_balances.apply_journal(conn, jid, 1)
         cur.execute("INSERT INTO finance_posting_events (school_id, module, transaction_type, source_ref, idempotency_key, amount, status, journal_entry_id, event_payload, created_by, created_at) VALUES (?, 'payroll', 'PAYROLL_RUN', ?, ?, ?, 'Posted', ?, ?, ?, ?)", (school_id, f'PAYROLL:{run_id}', idempotency_key, debit_total, jid, json.dumps({"run_code": run["run_code"]}), x_user_id, now))
         conn.execute("UPDATE payroll_runs SET status = 'Posted', gl_journal_id = ?, updated_at = ? WHERE id = ?", (jid, now, run_id))
         conn.commit()
@@ -6470,10 +7291,7 @@ async def generate_lesson_plan(
     if file:
         try:
             if file.filename.endswith('.pdf'):
-                pdf_reader = PdfReader(file.file)
-                for page in pdf_reader.pages:
-                    pdf_context += page.extract_text() + "\n"
-                pdf_context = pdf_context[:5000] # Limit to 5k chars to allow context window
+                pdf_context = _extracted_text(await _extract_upload(file))[:5000] # Limit to 5k chars to allow context window
             else:
                 # Text fallback?
                 content = await file.read()
@@ -6499,7 +7317,8 @@ async def generate_lesson_plan(
 
     if AI_ENABLED:
         try:
-            chat_completion = LESSON_PLANNER_CLIENT.chat.completions.create(
+            chat_completion = await LLM.complete(
+                endpoint="lesson_plan_upload",
                 messages=[
                     {
                         "role": "system",
@@ -6511,9 +7330,10 @@ async def generate_lesson_plan(
                     }
                 ],
                 model=GROQ_MODEL,
+                provider="lesson_planner",
                 temperature=0.7,
             )
-            return LessonPlanResponse(content=chat_completion.choices[0].message.content)
+            return LessonPlanResponse(content=chat_completion.content)
         except Exception as e:
             logger.error(f"AI Generation Failed: {e}")
             # Fallback to heuristic if AI fails
@@ -6817,6 +7637,7 @@ async def login_user(request: LoginRequest):
                  try:
                     cursor.execute("INSERT INTO user_roles (user_id, role_id) VALUES (?, ?)", (auth_user_id, role_row['id']))
                     conn.commit()
+                    invalidate_permission_cache(auth_user_id)
                  except:
                     pass 
 
@@ -7249,6 +8070,8 @@ async def create_school(
         )
         
         conn.commit()
+        # Reference data is seeded once by migration; new schools get their forms here.
+        seed_resource_library_data(conn, [school_id])
     except sqlite3.IntegrityError:
         conn.rollback()
         raise HTTPException(status_code=400, detail="School name or Admin email already exists.")
@@ -7339,6 +8162,8 @@ async def root_add_student(req: RootAdminStudentCreateRequest, x_user_id: str =
             )
         )
         conn.commit()
+        invalidate_teacher_overview(target_school_id)
+        invalidate_ai_context(target_school_id)
         return {"message": "User created", "user_id": email, "role": target_role}
     finally:
         conn.close()
@@ -7483,6 +8308,7 @@ async def root_create_school_account(
             raise HTTPException(status_code=500, detail="Failed to send OTP email.")
 
         conn.commit()
+        seed_resource_library_data(conn, [school_id])
         return {"message": "School created. OTP sent from Root Admin email.", "school_id": school_id}
     finally:
         conn.close()
@@ -7883,146 +8709,116 @@ async def reset_password(request: ResetPasswordRequest):
 
 # --- TEACHER DASHBOARD ---
 
-@app.get("/api/teacher/overview", response_model=TeacherOverviewResponse)
-async def get_teacher_overview(
-    x_user_role: str = Header(None, alias="X-User-Role"),
-    x_user_id: str = Header(None, alias="X-User-Id"),
-    x_target_school_id: str = Header(None, alias="X-School-Id") # Optional Override
-):
-    # Verify permission - allow Teacher, Admin, and SuperAdmins
-    await verify_permission("view_all_grades", x_user_id=x_user_id)
+# Overview per (school_id, grade scope), where grade 0 means the whole school. Entries
+# are dropped by invalidate_teacher_overview on student/activity writes; other workers
+# catch up within TEACHER_OVERVIEW_CACHE_TTL seconds (0 disables the cache).
+TEACHER_OVERVIEW_CACHE_TTL = float(os.getenv("TEACHER_OVERVIEW_CACHE_TTL", "30"))
+TEACHER_OVERVIEW_CACHE = TTLCache(
+    maxsize=int(os.getenv("TEACHER_OVERVIEW_CACHE_SIZE", "256")) if TEACHER_OVERVIEW_CACHE_TTL > 0 else 0,
+    ttl=TEACHER_OVERVIEW_CACHE_TTL,
+)
+
+def invalidate_teacher_overview(school_id: Optional[int] = None):
+    """Drop cached overviews for one school, or for every school when school_id is None."""
+    if school_id is None:
+        TEACHER_OVERVIEW_CACHE.clear()
+    else:
+        TEACHER_OVERVIEW_CACHE.invalidate_where(lambda key: key[0] == school_id)
 
+def _load_teacher_overview(school_id: int, grade: int) -> TeacherOverviewResponse:
+    grade_filter = " AND s.grade = ?" if grade else ""
+    scope = [school_id, grade] if grade else [school_id]
     conn = get_db_connection()
     try:
-        # 1. Get User/Teacher Context
-        user_row = conn.execute("SELECT school_id, grade, role, is_super_admin FROM students WHERE id = ?", (x_user_id,)).fetchone()
-        
-        if not user_row:
-             raise HTTPException(status_code=404, detail="Current user profile not found.")
-             
-        is_super = bool(user_row['is_super_admin']) or user_row['role'] in ['Super Admin', 'SuperAdmin']
-        
-        # Determine active school_id
-        school_id = 1 # Fallback
-        if x_target_school_id and is_super:
-            try:
-                school_id = int(x_target_school_id)
-            except:
-                school_id = user_row['school_id'] or 1
-        else:
-            school_id = user_row['school_id'] or 1
-            
-        teacher_grade = user_row['grade'] if user_row['grade'] is not None else 0
-        
-        # 2. Fetch Students
-        query = """
-            SELECT s.id, s.name, s.grade, s.preferred_subject, s.attendance_rate, s.home_language, 
-                   s.math_score, s.science_score, s.english_language_score
+        # Roster with section and per-student activity average in one pass.
+        rows = conn.execute(f"""
+            SELECT s.id, s.name, s.grade, s.preferred_subject, s.attendance_rate, s.home_language,
+                   (COALESCE(s.math_score, 0) + COALESCE(s.science_score, 0) + COALESCE(s.english_language_score, 0)) / 3.0 AS initial_score,
+                   sec.id AS section_id, sec.name AS section_name,
+                   COALESCE(act.avg_score, 0) AS avg_score
             FROM students s
-            WHERE s.role = 'Student' AND s.school_id = ?
-        """
-        params = [school_id]
-        
-        # Only filter by grade if the teacher is assigned to a specific grade and isn't a super admin
-        if not is_super and teacher_grade > 0:
-            query += " AND s.grade = ?"
-            params.append(teacher_grade)
-            
-        students_df = fetch_data_df(query, params=tuple(params))
-        
-        # Handle Section ID/Name if table exists (dynamic schema check)
-        students_df['section_id'] = None
-        students_df['section_name'] = None
-        try:
-             sections_df = fetch_data_df("SELECT s.id as student_id, sec.id as section_id, sec.name as section_name FROM students s JOIN sections sec ON s.section_id = sec.id WHERE s.school_id = ?", (school_id,))
-             if not sections_df.empty:
-                 students_df = students_df.merge(sections_df, left_on='id', right_on='student_id', how='left')
-        except:
-             pass # Sections missing or column missing, proceed without
-
-        # 3. Calculate Metrics
-        total_students = len(students_df)
-        class_avg_attendance = students_df['attendance_rate'].mean() if not students_df.empty else 0.0
-        
-        # Activities / Scores
-        activities_query = "SELECT a.student_id, a.score FROM activities a JOIN students s ON a.student_id = s.id WHERE s.school_id = ?"
-        activities_params = [school_id]
-        if not is_super and teacher_grade > 0:
-             activities_query += " AND s.grade = ?"
-             activities_params.append(teacher_grade)
-             
-        activities_df = fetch_data_df(activities_query, params=tuple(activities_params))
-        
-        avg_scores_map = {}
-        if not activities_df.empty:
-            avg_scores_map = activities_df.groupby('student_id')['score'].mean().to_dict()
-
-        # Build Roster
-        roster_list = []
-        class_avg_score_total = 0
-        
-        if not students_df.empty:
-            import pandas as pd
-            for _, row in students_df.iterrows():
-                student_avg_activity = avg_scores_map.get(row['id'], 0.0)
-                initial_score = (row['math_score'] + row['science_score'] + row['english_language_score']) / 3
-                
-                roster_list.append({
-                    "ID": row['id'],
-                    "Name": row['name'],
-                    "Grade": row['grade'],
-                    "Attendance %": round(row['attendance_rate'] or 0.0, 1),
-                    "Avg Activity Score": round(student_avg_activity, 1), 
-                    "Initial Score": round(initial_score, 1), 
-                    "Subject": row['preferred_subject'] or 'General',
-                    "Home Language": row['home_language'] or 'English',
-                    "Section ID": row.get('section_id') if pd.notna(row.get('section_id')) else None,
-                    "Section Name": row.get('section_name') if pd.notna(row.get('section_name')) else None
-                })
-                class_avg_score_total += student_avg_activity
-            
-            class_avg_score = class_avg_score_total / total_students if total_students > 0 else 0.0
-        else:
-            class_avg_score = 0.0
+            LEFT JOIN sections sec ON sec.id = s.section_id
+            LEFT JOIN (
+                SELECT a.student_id, AVG(a.score) AS avg_score
+                FROM activities a JOIN students s ON s.id = a.student_id
+                WHERE s.school_id = ?{grade_filter}
+                GROUP BY a.student_id
+            ) act ON act.student_id = s.id
+            WHERE s.role = 'Student' AND s.school_id = ?{grade_filter}
+            ORDER BY s.id
+        """, (*scope, *scope)).fetchall()
+
+        counts = conn.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM students WHERE role IN ('Teacher', 'Principal', 'Admin') AND school_id = ?) AS total_teachers,
+                (SELECT COUNT(*) FROM students WHERE role NOT IN ('Student') AND school_id = ?) AS total_staff,
+                (SELECT COUNT(*) FROM quiz_attempts qa JOIN students s ON qa.student_id = s.id
+                 WHERE s.school_id = ? AND qa.score >= 80) AS total_awards,
+                (SELECT name FROM schools WHERE id = ?) AS school_name
+        """, (school_id, school_id, school_id, school_id)).fetchone()
+    finally:
+        conn.close()
+
+    roster = [{
+        "ID": r['id'],
+        "Name": r['name'],
+        "Grade": r['grade'],
+        "Attendance %": round(float(r['attendance_rate'] or 0.0), 1),
+        "Avg Activity Score": round(float(r['avg_score']), 1),
+        "Initial Score": round(float(r['initial_score']), 1),
+        "Subject": r['preferred_subject'] or 'General',
+        "Home Language": r['home_language'] or 'English',
+        "Section ID": r['section_id'],
+        "Section Name": r['section_name'],
+    } for r in rows]
+
+    attendance = [float(r['attendance_rate']) for r in rows if r['attendance_rate'] is not None]
+    total_students = len(rows)
+    return TeacherOverviewResponse(
+        total_students=total_students,
+        class_attendance_avg=round(sum(attendance) / len(attendance), 1) if attendance else 0.0,
+        class_score_avg=round(sum(float(r['avg_score']) for r in rows) / total_students, 1) if total_students else 0.0,
+        roster=roster,
+        total_teachers=counts['total_teachers'] or 0,
+        total_staff=counts['total_staff'] or 0,
+        total_awards=counts['total_awards'] or 0,
+        school_name=counts['school_name'] or "Noble Nexus Academy",
+    )
 
-        # 4. Fetch real counts from DB
-        total_teachers = conn.execute(
-            "SELECT COUNT(*) FROM students WHERE role IN ('Teacher', 'Principal', 'Admin') AND school_id = ?",
-            (school_id,)
-        ).fetchone()[0]
+def _get_teacher_overview_sync(user_id: str, target_school_id: Optional[str]) -> TeacherOverviewResponse:
+    conn = get_db_connection()
+    try:
+        user_row = conn.execute("SELECT school_id, grade, role, is_super_admin FROM students WHERE id = ?", (user_id,)).fetchone()
+    finally:
+        conn.close()
+    if not user_row:
+        raise HTTPException(status_code=404, detail="Current user profile not found.")
 
-        total_staff = conn.execute(
-            "SELECT COUNT(*) FROM students WHERE role NOT IN ('Student') AND school_id = ?",
-            (school_id,)
-        ).fetchone()[0]
+    is_super = bool(user_row['is_super_admin']) or user_row['role'] in ['Super Admin', 'SuperAdmin']
 
-        # Awards = total quiz attempts with score >= 80 for this school's students
+    # Determine active school_id
+    school_id = user_row['school_id'] or 1
+    if target_school_id and is_super:
         try:
-            total_awards = conn.execute(
-                "SELECT COUNT(*) FROM quiz_attempts qa JOIN students s ON qa.student_id = s.id "
-                "WHERE s.school_id = ? AND qa.score >= 80",
-                (school_id,)
-            ).fetchone()[0]
-        except Exception:
-            total_awards = 0
+            school_id = int(target_school_id)
+        except ValueError:
+            pass
 
-        # School name
-        school_row = conn.execute("SELECT name FROM schools WHERE id = ?", (school_id,)).fetchone()
-        school_name = school_row['name'] if school_row else "Noble Nexus Academy"
+    # Only filter by grade if the teacher is assigned to a specific grade and isn't a super admin
+    teacher_grade = user_row['grade'] if user_row['grade'] is not None else 0
+    grade = teacher_grade if not is_super and teacher_grade > 0 else 0
 
-    finally:
-        conn.close()
+    return TEACHER_OVERVIEW_CACHE.get_or_load((school_id, grade), lambda: _load_teacher_overview(school_id, grade))
 
-    return TeacherOverviewResponse(
-        total_students=total_students,
-        class_attendance_avg=round(class_avg_attendance, 1),
-        class_score_avg=round(class_avg_score, 1),
-        roster=roster_list,
-        total_teachers=total_teachers,
-        total_staff=total_staff,
-        total_awards=total_awards,
-        school_name=school_name
-    )
+@app.get("/api/teacher/overview", response_model=TeacherOverviewResponse)
+async def get_teacher_overview(
+    x_user_role: str = Header(None, alias="X-User-Role"),
+    x_user_id: str = Header(None, alias="X-User-Id"),
+    x_target_school_id: str = Header(None, alias="X-School-Id") # Optional Override
+):
+    # Verify permission - allow Teacher, Admin, and SuperAdmins
+    await verify_permission("view_all_grades", x_user_id=x_user_id)
+    return await run_db(_get_teacher_overview_sync, x_user_id, x_target_school_id)
 
 @app.post("/api/students/add", status_code=201)
 async def add_new_student(
@@ -8064,6 +8860,8 @@ async def add_new_student(
             )
         )
         conn.commit()
+        invalidate_teacher_overview(school_id)
+        invalidate_ai_context(school_id)
         return {"message": f"Student {request.id} ({request.name}) added successfully."}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail=f"Student ID '{request.id}' already exists.")
@@ -8101,7 +8899,7 @@ async def update_student(
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        result = cursor.execute("SELECT id FROM students WHERE id = ?", (student_id,)).fetchone()
+        result = cursor.execute("SELECT id, school_id FROM students WHERE id = ?", (student_id,)).fetchone()
         if result is None:
             raise HTTPException(status_code=404, detail=f"Student ID '{student_id}' not found.")
             
@@ -8147,6 +8945,10 @@ async def update_student(
              cursor.execute("UPDATE students SET role = ? WHERE id = ?", (first_role_name, student_id))
 
         conn.commit()
+        if request.roles is not None:
+            invalidate_permission_cache(student_id)
+        invalidate_teacher_overview(result['school_id'])
+        invalidate_ai_context(result['school_id'], student_id)
         return {"message": f"Student {student_id} updated successfully."}
     finally:
         conn.close()
@@ -8159,12 +8961,15 @@ async def delete_student(student_id: str):
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        result = cursor.execute("SELECT id FROM students WHERE id = ?", (student_id,)).fetchone()
+        result = cursor.execute("SELECT id, school_id FROM students WHERE id = ?", (student_id,)).fetchone()
         if result is None:
             raise HTTPException(status_code=404, detail=f"Student ID '{student_id}' not found.")
             
         cursor.execute("DELETE FROM students WHERE id = ?", (student_id,))
         conn.commit()
+        invalidate_permission_cache(student_id)
+        invalidate_teacher_overview(result['school_id'])
+        invalidate_ai_context(result['school_id'], student_id)
         return {"message": f"Student {student_id} and all related activities deleted successfully."}
     finally:
         conn.close()
@@ -8201,7 +9006,7 @@ async def add_new_activity(
     conn = get_db_connection()
     try:
         cursor = conn.cursor()
-        student_check = cursor.execute("SELECT id FROM students WHERE id = ?", (request.student_id,)).fetchone()
+        student_check = cursor.execute("SELECT id, school_id FROM students WHERE id = ?", (request.student_id,)).fetchone()
         if student_check is None:
             raise HTTPException(status_code=404, detail=f"Student ID '{request.student_id}' not found.")
             
@@ -8216,7 +9021,9 @@ async def add_new_activity(
             )
         )
         conn.commit()
-        train_recommendation_model()
+        RECOMMENDER.notify_new_activities(1)
+        invalidate_teacher_overview(student_check['school_id'])
+        invalidate_ai_context(student_check['school_id'], request.student_id)
         return {"message": f"Activity for student {request.student_id} added successfully."}
     except Exception as e:
         conn.rollback()
@@ -8225,60 +9032,65 @@ async def add_new_activity(
     finally:
         conn.close()
 
-# Refactored common AI logic
-def build_ai_context_and_prompt(student_id, user_query, specific_file_content=""):
+def _load_resource_summary(school_id: int) -> str:
     conn = get_db_connection()
-    student = conn.execute("SELECT name, grade, preferred_subject, math_score, science_score, english_language_score, role, school_id FROM students WHERE id = ?", (student_id,)).fetchone()
-    
-    # Fetch Resources Context (Global Library) - ONLY if no specific file content or supplemental
-    # For now, let's keep it additive
-    school_id = student['school_id'] if student and 'school_id' in student else 1
-    resources = conn.execute("SELECT title, description, extracted_text FROM resources WHERE school_id = ? ORDER BY uploaded_at DESC", (school_id,)).fetchall()
-    conn.close()
-    
+    try:
+        rows = conn.execute(
+            "SELECT title, SUBSTR(description, 1, 50) AS description FROM resources WHERE school_id = ? ORDER BY uploaded_at DESC",
+            (school_id,),
+        ).fetchall()
+    finally:
+        conn.close()
+    return "\nAvailable Library Resources:\n" + "".join(f"- {r['title']} ({r['description'] or ''}...)\n" for r in rows)
+
+def _load_student_context(student_id: str) -> Optional[Dict[str, Any]]:
+    """Profile line and recent activity table for the tutor prompt; None for unknown users."""
+    conn = get_db_connection()
+    try:
+        student = conn.execute("SELECT name, grade, preferred_subject, role, school_id FROM students WHERE id = ?", (student_id,)).fetchone()
+    finally:
+        conn.close()
+    if not student:
+        return None
+
     # Fetch Activity History
     history_df = fetch_data_df("SELECT date, topic, difficulty, score FROM activities WHERE student_id = ? ORDER BY date DESC LIMIT 20", (student_id,))
-    history_context = ""
     if not history_df.empty:
         history_context = "\nRecent Activity History:\n" + history_df.to_markdown(index=False)
     else:
         history_context = "\nNo recent activity history found."
+    return {
+        "school_id": student['school_id'],
+        "name": student['name'],
+        "role": student['role'],
+        "grade": student['grade'],
+        "profile": f"User Profile: Name={student['name']}, Role={student['role']}, Grade={student['grade']}, Prefers={student['preferred_subject']}.",
+        "history": history_context,
+    }
 
-    # Process Resources
-    resource_summary = "\nAvailable Library Resources:\n"
-    matched_resource_text = ""
-    user_query_lower = user_query.lower()
-    
-    for res in resources:
-        title = res['title']
-        desc = res['description'] or ""
-        resource_summary += f"- {title} ({desc[:50]}...)\n"
-        
-        if len(title) > 3 and title.lower() in user_query_lower:
-            text = res['extracted_text'] or "No text content available."
-            matched_resource_text += f"\n[Resource Content: {title}]\n{text[:3000]}\n[End Resource Content]\n"
-
-    student_context_str = ""
-    if student:
-        grade = student['grade']
-        student_context_str = f"User Profile: Name={student['name']}, Role={student['role']}, Grade={grade}, Prefers={student['preferred_subject']}."
-        student_context_str += f"\n{history_context}"
-        student_context_str += f"\n{resource_summary}"
-        if matched_resource_text:
-            student_context_str += f"\nDetailed Resource Context (Relevant to Query):\n{matched_resource_text}"
-    else:
-        student_context_str = "User Profile: Unknown/Guest"
+def _load_school_ai_stats(school_id: int) -> Dict[str, int]:
+    conn = get_db_connection()
+    try:
+        row = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM students WHERE school_id = ?) AS student_count,
+                   (SELECT COUNT(*) FROM activities WHERE student_id IN (SELECT id FROM students WHERE school_id = ?)) AS activity_count
+        """, (school_id, school_id)).fetchone()
+    finally:
+        conn.close()
+    return {"student_count": row['student_count'], "activity_count": row['activity_count']}
 
-    # Inject Specific Attached File Content
-    if specific_file_content:
-        student_context_str += f"\n\n[USER ATTACHED FILE CONTENT]\n{specific_file_content}\n[END ATTACHED FILE CONTENT]\n"
-        student_context_str += "\nNOTE: The user has attached a file. PRIORITIZE using the [USER ATTACHED FILE CONTENT] to answer their query."
+# System prompts = static instructions (identical on every request, so the provider
+# can cache the prefix) + per-request context trimmed to PROMPT_TOKEN_BUDGET
+# (see prompt_budget.py). Lower-priority sections are cut first.
+PROMPT_ASSEMBLER = PromptAssembler(budget=int(os.getenv("PROMPT_TOKEN_BUDGET", "6000")))
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS", "800"))
+PROMPT_LIBRARY_TOKENS = int(os.getenv("PROMPT_LIBRARY_TOKENS", "400"))
+PROMPT_RESOURCE_TOKENS = int(os.getenv("PROMPT_RESOURCE_TOKENS", "1500"))
+PROMPT_FILE_TOKENS = int(os.getenv("PROMPT_FILE_TOKENS", "3000"))
 
-    system_prompt = f"""
+TUTOR_PROMPT_PREFIX = StaticPrefix(f"""
 You are a professional Education and Data Assistant integrated into a sidebar chatbot interface.
-You operate in two clearly defined modes:
-
-{student_context_str}
+You operate in two clearly defined modes. The context for the current user and request follows these instructions.
 
 **Mode 1: Education Assistant**
 Activate this mode when the user asks about:
@@ -8330,35 +9142,12 @@ You must strictly output a JSON object with the following structure:
   "content": "Your education response text here (null if DATABASE mode)",
   "query": "Your SQL query here (null if EDUCATION mode)"
 }}
-"""
-    return system_prompt
+""")
 
-def build_teacher_ai_context(teacher_id, user_query):
-    try:
-        conn = get_db_connection()
-        # Fetch Teacher Profile
-        teacher = conn.execute("SELECT name, role, school_id FROM students WHERE id = ?", (teacher_id,)).fetchone()
-        
-        if not teacher:
-             conn.close()
-             return "User not found."
-    
-        school_id = teacher['school_id'] if teacher and 'school_id' in teacher else 1
-        
-        # Fetch School Stats for Context
-        student_count = conn.execute("SELECT COUNT(*) FROM students WHERE school_id = ?", (school_id,)).fetchone()[0]
-        recent_activities = conn.execute("SELECT COUNT(*) FROM activities WHERE student_id IN (SELECT id FROM students WHERE school_id = ?)", (school_id,)).fetchone()[0]
-        
-        conn.close()
-    
-        context_str = f"Teacher Profile: Name={teacher['name']}, Role={teacher['role']}, School ID={school_id}.\n"
-        context_str += f"School Environment Context: Currently managing {student_count} students with {recent_activities} total activities recorded.\n"
-    
-        system_prompt = f"""
+TEACHER_PROMPT_PREFIX = StaticPrefix(f"""
 You are the "ClassBridge AI Co-Pilot", an intelligent assistant specifically for teachers and school administrators.
 Your goal is to save teachers time by helping with day-to-day administrative, pedagogical, and analytical tasks.
-
-{context_str}
+The context for the current user follows these instructions.
 
 **Capabilities:**
 1. **Administrative Helper**: Draft parent emails, write announcements, create meeting agendas, or structure school newsletters.
@@ -8373,7 +9162,6 @@ Your goal is to save teachers time by helping with day-to-day administrative, pe
 **Database Guidelines (PostgreSQL):**
 - You have access to the following schema:
 {DB_SCHEMA_CONTEXT}
-- IMPORTANT: ALWAYS filter queries by `school_id = {school_id}` to ensure data privacy.
 - Return a valid PostgreSQL SELECT query in the 'query' field.
 
 ### OUTPUT FORMAT (STRICT JSON)
@@ -8383,13 +9171,124 @@ You must strictly output a JSON object:
   "content": "Your helpful response here (null if DATABASE mode)",
   "query": "Your SQL query here (null if EDUCATION mode)"
 }}
-"""
+""")
+
+# Refactored common AI logic
+def _ai_tutor_context(student_id, user_query, specific_file_content="", shared=False) -> Tuple[str, Optional[Tuple[int, str]]]:
+    """System prompt for the tutor, plus the (school_id, fingerprint) its answers may be cached under.
+
+    The full prompt carries the student's name, preferences and activity history and
+    is never cached (key None). With ``shared=True`` those per-student sections are
+    left out and the profile is reduced to role and grade, so the answer only depends
+    on what the fingerprint covers (role, grade, matched library text) and can be
+    reused by classmates. Guests and attached files never get a key.
+    """
+    student = AI_CONTEXT_CACHE.get_or_load(("student", student_id), lambda: _load_student_context(student_id))
+
+    # Fetch Resources Context (Global Library) - ONLY if no specific file content or supplemental
+    # For now, let's keep it additive
+    school_id = (student['school_id'] if student else None) or 1
+    is_postgres = USE_POSTGRES and ('postgres' in DATABASE_URL.lower())
+    conn = get_db_connection()
+    matches = search_resources(conn, school_id, user_query, is_postgres, limit=RESOURCE_MATCH_LIMIT)
+    conn.close()
+
+    # Process Resources
+    resource_summary = AI_CONTEXT_CACHE.get_or_load(("resources", school_id), lambda: _load_resource_summary(school_id))
+    matched_resource_text = ""
+    for res in matches:
+        text = res['snippet'] or "No text content available."
+        matched_resource_text += f"\n[Resource Content: {res['title']}]\n{text}\n[End Resource Content]\n"
+
+    shared = shared and bool(student) and not specific_file_content
+    if not student:
+        profile = "User Profile: Unknown/Guest"
+    elif shared:
+        profile = f"User Profile: Role={student['role']}, Grade={student['grade']}."
+    else:
+        profile = student['profile']
+    sections = [PromptSection("profile", f"**Current User Context:**\n{profile}", priority=100)]
+    if student:
+        if not shared:
+            sections.append(PromptSection("history", student['history'], priority=40, max_tokens=PROMPT_HISTORY_TOKENS))
+        sections.append(PromptSection("library", resource_summary, priority=20, max_tokens=PROMPT_LIBRARY_TOKENS))
+        if matched_resource_text:
+            sections.append(PromptSection(
+                "matched_resources", f"Detailed Resource Context (Relevant to Query):\n{matched_resource_text}",
+                priority=60, max_tokens=PROMPT_RESOURCE_TOKENS,
+            ))
+
+    # Inject Specific Attached File Content
+    if specific_file_content:
+        file_text = trim_to_tokens(specific_file_content, PROMPT_FILE_TOKENS)
+        sections.append(PromptSection(
+            "attached_file",
+            "NOTE: The user has attached a file. PRIORITIZE using the [USER ATTACHED FILE CONTENT] to answer their query.\n"
+            f"[USER ATTACHED FILE CONTENT]\n{file_text}\n[END ATTACHED FILE CONTENT]",
+            priority=80,
+        ))
+
+    system_prompt = PROMPT_ASSEMBLER.assemble(TUTOR_PROMPT_PREFIX, sections).text
+    cache_key = None
+    if shared:
+        cache_key = (school_id, context_fingerprint("tutor", student['role'], student['grade'], matched_resource_text))
+    return system_prompt, cache_key
+
+def build_ai_context_and_prompt(student_id, user_query, specific_file_content=""):
+    return _ai_tutor_context(student_id, user_query, specific_file_content)[0]
+
+def build_teacher_ai_context(teacher_id, user_query):
+    try:
+        # Fetch Teacher Profile
+        teacher = AI_CONTEXT_CACHE.get_or_load(("student", teacher_id), lambda: _load_student_context(teacher_id))
+        if not teacher:
+             return "User not found."
+    
+        school_id = teacher['school_id'] or 1
+        
+        # Fetch School Stats for Context
+        stats = AI_CONTEXT_CACHE.get_or_load(("school", school_id), lambda: _load_school_ai_stats(school_id))
+    
+        context_str = f"**Current User Context:**\nTeacher Profile: Name={teacher['name']}, Role={teacher['role']}, School ID={school_id}.\n"
+        context_str += f"School Environment Context: Currently managing {stats['student_count']} students with {stats['activity_count']} total activities recorded.\n"
+        context_str += f"IMPORTANT: ALWAYS filter database queries by `school_id = {school_id}` to ensure data privacy."
+        system_prompt = PROMPT_ASSEMBLER.assemble(TEACHER_PROMPT_PREFIX, [PromptSection("profile", context_str, priority=100)]).text
         return system_prompt
     except Exception as e:
         logger.error(f"Teacher Context Error: {e}")
         return "You are a professional educational assistant."
 
 
+def _require_known_user(x_user_id: Optional[str]) -> None:
+    if not x_user_id:
+        raise HTTPException(status_code=400, detail="User Identity Missing")
+    with db_connection() as conn:
+        if not conn.execute("SELECT 1 FROM students WHERE id = ?", (x_user_id,)).fetchone():
+            raise HTTPException(status_code=403, detail="Unknown user.")
+
+@app.post("/api/extractions")
+async def submit_extraction(file: UploadFile = File(...), wait: float = Form(0), x_user_id: str = Header(None, alias="X-User-Id")):
+    """Queue text extraction for a file; waits up to ``wait`` seconds, then poll GET /api/extractions/{hash}."""
+    await run_db(_require_known_user, x_user_id)
+    if file.filename.lower().endswith(".pdf") and not PdfReader:
+        raise HTTPException(status_code=503, detail="PDF processing is unavailable on the server.")
+    data = await file.read(EXTRACTION.max_bytes + 1)
+    if len(data) > EXTRACTION.max_bytes:
+        raise HTTPException(status_code=413, detail=f"File is larger than {EXTRACTION.max_bytes // (1024 * 1024)} MB.")
+    future = await run_db(EXTRACTION.submit, data, file.filename)
+    result = await EXTRACTION.wait(future, min(max(wait, 0), EXTRACTION_WAIT_SECONDS))
+    if result is None:
+        return {"content_hash": content_hash(data), "status": STATUS_PENDING}
+    return result.to_dict()
+
+
+@app.get("/api/extractions/{digest}")
+async def get_extraction(digest: str, include_text: bool = True, x_user_id: str = Header(None, alias="X-User-Id")):
+    await run_db(_require_known_user, x_user_id)
+    result = await run_db(EXTRACTION.status, digest.lower())
+    return result.to_dict(include_text=include_text)
+
+
 @app.post("/api/ai/chat_with_file/{student_id}", response_model=AIChatResponse)
 async def chat_with_ai_tutor_file(
     student_id: str, 
@@ -8401,19 +9300,14 @@ async def chat_with_ai_tutor_file(
     
     extracted_text = ""
     try:
-        if file.filename.lower().endswith('.pdf') and PdfReader:
-            # We need to read the file into memory to parse it
-            content = await file.read()
-            from io import BytesIO
-            reader = PdfReader(BytesIO(content))
-            text_content = []
-            for page in reader.pages:
-                 text = page.extract_text()
-                 if text: text_content.append(text)
-            extracted_text = "\n".join(text_content)
-        elif file.filename.lower().endswith(('.txt', '.md', '.csv')):
-            content = await file.read()
-            extracted_text = content.decode('utf-8')
+        if (file.filename.lower().endswith('.pdf') and PdfReader) or file.filename.lower().endswith(('.txt', '.md', '.csv')):
+            result = await _extract_upload(file)
+            if result is None:
+                extracted_text = f"[File: {file.filename} - still being processed, its text is not available yet.]"
+            elif result.status == STATUS_DONE:
+                extracted_text = result.text
+            else:
+                extracted_text = "Error extracting text from file."
         else:
              extracted_text = f"[File: {file.filename} (Type: {file.content_type}) - Content extraction not supported for this file type yet. Treat as metadata only.]"
     except Exception as e:
@@ -8423,7 +9317,8 @@ async def chat_with_ai_tutor_file(
     try:
         system_prompt = build_ai_context_and_prompt(student_id, prompt, extracted_text)
         
-        chat_completion = GROQ_CLIENT.chat.completions.create(
+        chat_completion = await LLM.complete(
+            endpoint="chat_with_file",
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
@@ -8433,7 +9328,7 @@ async def chat_with_ai_tutor_file(
             response_format={"type": "json_object"}
         )
         
-        response_content = chat_completion.choices[0].message.content
+        response_content = chat_completion.content
         try:
              parsed_response = json.loads(response_content)
              mode = parsed_response.get("mode", "EDUCATION")
@@ -8448,13 +9343,12 @@ async def chat_with_ai_tutor_file(
                  # If it IS database query, we execute it
                  sql_query = parsed_response.get("query")
                  try:
-                     df = fetch_data_df(sql_query)
-                     if not df.empty:
-                         return AIChatResponse(reply=f"**Query Result:**\n\n" + df.to_markdown(index=False))
-                     else:
-                         return AIChatResponse(reply="No data found for that query.")
+                     result = await run_db(_run_ai_query, sql_query, student_id)
                  except Exception as e:
-                     return AIChatResponse(reply=f"Query failed: {e}")
+                     return AIChatResponse(reply=_ai_query_error_reply(e))
+                 if result.row_count:
+                     return AIChatResponse(reply=f"**Query Result:**\n\n" + result.to_markdown())
+                 return AIChatResponse(reply="No data found for that query.")
              
              return AIChatResponse(reply=parsed_response.get("content", "I analyzed the file but have no specific comments."))
              
@@ -8472,44 +9366,46 @@ async def chat_with_ai_tutor(student_id: str, request: AIChatRequest):
         
     try:
         # Use shared prompt builder
-        system_prompt = build_ai_context_and_prompt(student_id, request.prompt)
-        
-        # Call LLM
-        chat_completion = GROQ_CLIENT.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": request.prompt}
-            ],
-            model=GROQ_MODEL, # "llama-3.1-8b-instant"
-            temperature=0.3,  # Lower temperature for reliable JSON and SQL
-            max_tokens=1000,
-            response_format={"type": "json_object"}
-        )
-        
-        response_content = chat_completion.choices[0].message.content
+        # Questions about the student's own record get their profile and history and are
+        # never cached; everything else is answered from the shared (role/grade) context.
+        shared = not _is_personal_prompt(request.prompt)
+        system_prompt, cache_key = await run_db(_ai_tutor_context, student_id, request.prompt, "", shared)
+
+        response_content = AI_RESPONSE_CACHE.get(*cache_key, request.prompt) if cache_key else None
+        if response_content is None:
+            # Call LLM
+            chat_completion = await LLM.complete(
+                endpoint="tutor_chat",
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": request.prompt}
+                ],
+                model=GROQ_MODEL, # "llama-3.1-8b-instant"
+                temperature=0.3,  # Lower temperature for reliable JSON and SQL
+                max_tokens=1000,
+                response_format={"type": "json_object"}
+            )
+            response_content = chat_completion.content
+        else:
+            cache_key = None  # already cached
         
         # Parse JSON response
         try:
             response_data = json.loads(response_content)
             mode = response_data.get("mode")
+            # Only reuse explanations; DATABASE answers are re-queried every time.
+            if cache_key and mode != "DATABASE" and response_data.get("content"):
+                AI_RESPONSE_CACHE.set(*cache_key, request.prompt, response_content)
             
             if mode == "DATABASE":
                 query = response_data.get("query")
                 if query:
-                    # Security Check: Ensure it's a SELECT query
-                    if not query.strip().lower().startswith("select"):
-                         reply = "I can only perform read-only database queries (SELECT)."
-                    else:
-                        try:
-                            logger.info(f"AI Executing SQL: {query}")
-                            # Execute Query
-                            df_result = fetch_data_df(query)
-                            # Format Result
-                            markdown_table = format_df_to_markdown(df_result)
-                            reply = f"Here is the data I found:\n\n{markdown_table}"
-                        except Exception as db_err:
-                            logger.error(f"AI SQL Execution Error: {db_err}")
-                            reply = f"I tried to run a database query but ran into an error: {str(db_err)}"
+                    # Read-only, school-scoped and row-limited; see sql_guard.py
+                    try:
+                        result = await run_db(_run_ai_query, query, student_id)
+                        reply = f"Here is the data I found:\n\n{result.to_markdown()}"
+                    except Exception as db_err:
+                        reply = _ai_query_error_reply(db_err)
                 else:
                     reply = "I understood this as a data request but couldn't generate a valid query."
                     
@@ -8538,7 +9434,8 @@ async def chat_with_ai_teacher(teacher_id: str, request: AIChatRequest):
         system_prompt = build_teacher_ai_context(teacher_id, request.prompt)
         
         # Call LLM
-        chat_completion = GROQ_CLIENT.chat.completions.create(
+        chat_completion = await LLM.complete(
+            endpoint="teacher_copilot",
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": request.prompt}
@@ -8549,7 +9446,7 @@ async def chat_with_ai_teacher(teacher_id: str, request: AIChatRequest):
             response_format={"type": "json_object"}
         )
         
-        response_content = chat_completion.choices[0].message.content
+        response_content = chat_completion.content
         
         try:
             response_data = json.loads(response_content)
@@ -8558,17 +9455,11 @@ async def chat_with_ai_teacher(teacher_id: str, request: AIChatRequest):
             if mode == "DATABASE":
                 query = response_data.get("query")
                 if query:
-                    if not query.strip().lower().startswith("select"):
-                         reply = "I am restricted to read-only database queries (SELECT)."
-                    else:
-                        try:
-                            logger.info(f"Teacher AI Executing SQL: {query}")
-                            df_result = fetch_data_df(query)
-                            markdown_table = format_df_to_markdown(df_result)
-                            reply = f"I've fetched the requested data from the school records:\n\n{markdown_table}"
-                        except Exception as db_err:
-                            logger.error(f"Teacher AI SQL Error: {db_err}")
-                            reply = f"I encountered an error while querying the database: {str(db_err)}"
+                    try:
+                        result = await run_db(_run_ai_query, query, teacher_id)
+                        reply = f"I've fetched the requested data from the school records:\n\n{result.to_markdown()}"
+                    except Exception as db_err:
+                        reply = _ai_query_error_reply(db_err)
                 else:
                     reply = "I understood this as a data request but couldn't generate a valid query."
             else:
@@ -8583,54 +9474,95 @@ async def chat_with_ai_teacher(teacher_id: str, request: AIChatRequest):
         
     return AIChatResponse(reply=reply)
 
+def _grade_helper_context(student_id: str) -> Optional[Tuple[str, Optional[int]]]:
+    """(system prompt tailored to the user's role and grade, school_id), or None if the user is unknown."""
+    # Fetch Student/User Details for Context
+    conn = get_db_connection()
+    user = conn.execute("SELECT role, grade, preferred_subject, school_id FROM students WHERE id = ?", (student_id,)).fetchone()
+    conn.close()
+
+    if not user:
+        return None
+
+    role = user['role']
+    grade = user['grade'] if user['grade'] is not None else "Unknown"
+
+    # dynamic system prompt based on role and grade
+    if role == 'Teacher':
+        system_prompt = (
+            f"You are a Grade {grade} Specialist Assistant for Teachers. "
+            f"Your goal is to assist a Grade {grade} teacher with lesson planning, student management, and educational strategies. "
+            "Keep your answers professional, helpful, and focused on education."
+        )
+    else:
+        system_prompt = (
+            f"You are a friendly Grade {grade} Study Buddy. "
+            f"Your goal is to help a Grade {grade} student with their studies. "
+            "Keep your answers simple, encouraging, and easy to understand for this age group. "
+            "Focus ONLY on grade-related disputes and education things."
+        )
+    return system_prompt, user['school_id']
+
+def _grade_helper_messages(student_id: str, prompt: str) -> Optional[List[Dict[str, str]]]:
+    context = _grade_helper_context(student_id)
+    if not context:
+        return None
+    return [
+        {"role": "system", "content": context[0]},
+        {"role": "user", "content": prompt}
+    ]
+
+# Using the same model class, assuming availability with this key
+GRADE_HELPER_PARAMS = {"model": "llama-3.1-8b-instant", "provider": "grade_helper", "endpoint": "grade_helper", "temperature": 0.7, "max_tokens": 600}
+
 @app.post("/api/ai/grade-helper/{student_id}", response_model=AIChatResponse)
 async def chat_with_grade_helper(student_id: str, request: AIChatRequest):
-    if not GRADE_HELPER_CLIENT:
+    if not LLM.available("grade_helper"):
         return AIChatResponse(reply="Grade Helper AI is currently unavailable.")
         
     try:
-        # Fetch Student/User Details for Context
-        conn = get_db_connection()
-        user = conn.execute("SELECT role, grade, preferred_subject FROM students WHERE id = ?", (student_id,)).fetchone()
-        conn.close()
-        
-        if not user:
+        context = await run_db(_grade_helper_context, student_id)
+        if not context:
              return AIChatResponse(reply="I can't find your profile to customize my answers.")
-             
-        role = user['role']
-        grade = user['grade'] if user['grade'] is not None else "Unknown"
-        
-        # dynamic system prompt based on role and grade
-        if role == 'Teacher':
-            system_prompt = (
-                f"You are a Grade {grade} Specialist Assistant for Teachers. "
-                f"Your goal is to assist a Grade {grade} teacher with lesson planning, student management, and educational strategies. "
-                "Keep your answers professional, helpful, and focused on education."
-            )
-        else:
-             system_prompt = (
-                f"You are a friendly Grade {grade} Study Buddy. "
-                f"Your goal is to help a Grade {grade} student with their studies. "
-                "Keep your answers simple, encouraging, and easy to understand for this age group. "
-                "Focus ONLY on grade-related disputes and education things."
-            )
 
-        chat_completion = GRADE_HELPER_CLIENT.chat.completions.create(
-            messages=[
+        # The prompt depends only on role and grade, so same-grade users share answers.
+        system_prompt, school_id = context
+        fingerprint = context_fingerprint("grade_helper", system_prompt)
+        reply = AI_RESPONSE_CACHE.get(school_id, fingerprint, request.prompt)
+        if reply is None:
+            messages = [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": request.prompt}
-            ],
-            model="llama-3.1-8b-instant", # Using the same model class, assuming availability with this key
-            temperature=0.7, 
-            max_tokens=600
-        )
-        reply = chat_completion.choices[0].message.content
+            ]
+            chat_completion = await LLM.complete(messages, **GRADE_HELPER_PARAMS)
+            reply = chat_completion.content
+            AI_RESPONSE_CACHE.set(school_id, fingerprint, request.prompt, reply)
     except Exception as e:
         logger.error(f"Grade Helper API Error for {student_id}: {e}")
         reply = "I'm having a bit of trouble connecting right now. Please try again."
         
     return AIChatResponse(reply=reply)
 
+@app.post("/api/ai/grade-helper/{student_id}/stream")
+async def stream_grade_helper(student_id: str, request: AIChatRequest):
+    """Same as /api/ai/grade-helper/{student_id}, streamed as Server-Sent Events."""
+    if not LLM.available("grade_helper"):
+        raise HTTPException(status_code=503, detail="Grade Helper AI is currently unavailable.")
+    context = await run_db(_grade_helper_context, student_id)
+    if not context:
+        raise HTTPException(status_code=404, detail="I can't find your profile to customize my answers.")
+    system_prompt, school_id = context
+    fingerprint = context_fingerprint("grade_helper", system_prompt)
+    cached = AI_RESPONSE_CACHE.get(school_id, fingerprint, request.prompt)
+    if cached is not None:
+        return _sse_response(_replay_chunks(cached))
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": request.prompt}
+    ]
+    chunks = LLM.stream(messages, **GRADE_HELPER_PARAMS)
+    return _sse_response(_tee_stream(chunks, lambda text: AI_RESPONSE_CACHE.set(school_id, fingerprint, request.prompt, text)))
+
 def _is_education_related_text(text: str) -> bool:
     if not text:
         return False
@@ -8647,7 +9579,7 @@ async def chat_with_engagement_helper(
     request: Request,
     x_user_id: str = Header(None, alias="X-User-Id"),
 ):
-    if not ENGAGEMENT_HELPER_CLIENT:
+    if not LLM.available("engagement_helper"):
         return AIChatResponse(reply="Engagement Helper AI is currently unavailable.")
 
     if not x_user_id:
@@ -8701,11 +9633,7 @@ async def chat_with_engagement_helper(
             if not PdfReader:
                 raise HTTPException(status_code=503, detail="PDF processing is unavailable on the server.")
             try:
-                pdf_reader = PdfReader(file.file)
-                for page in pdf_reader.pages:
-                    page_text = page.extract_text() or ""
-                    pdf_context += page_text + "\n"
-                pdf_context = pdf_context[:5000]
+                pdf_context = _extracted_text(await _extract_upload(file))[:5000]
             except Exception as e:
                 logger.error(f"Engagement Helper PDF read error: {e}")
                 pdf_context = ""
@@ -8718,17 +9646,19 @@ async def chat_with_engagement_helper(
                         "Return only JSON with keys: is_education (true/false), topic (short topic label), reason (short)."
                         f"\n\nCONTENT:\n{pdf_context}"
                     )
-                    classification = ENGAGEMENT_HELPER_CLIENT.chat.completions.create(
+                    classification = await LLM.complete(
+                        endpoint="engagement_classifier",
                         messages=[
                             {"role": "system", "content": "You are a strict JSON classifier."},
                             {"role": "user", "content": classification_prompt}
                         ],
                         model=ENGAGEMENT_HELPER_MODEL,
+                        provider="engagement_helper",
                         temperature=0.0,
                         max_tokens=200,
                         response_format={"type": "json_object"}
                     )
-                    classification_content = classification.choices[0].message.content
+                    classification_content = classification.content
                     classification_data = json.loads(classification_content)
                     is_education = bool(classification_data.get("is_education"))
                     pdf_topic = (classification_data.get("topic") or "").strip()
@@ -8767,16 +9697,18 @@ async def chat_with_engagement_helper(
                 f"\nPDF Content (excerpt):\n{pdf_context}\n"
             )
 
-        chat_completion = ENGAGEMENT_HELPER_CLIENT.chat.completions.create(
+        chat_completion = await LLM.complete(
+            endpoint="engagement_helper",
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt}
             ],
             model=ENGAGEMENT_HELPER_MODEL,
+            provider="engagement_helper",
             temperature=0.6,
             max_tokens=600
         )
-        reply = chat_completion.choices[0].message.content
+        reply = chat_completion.content
     except HTTPException:
         raise
     except Exception as e:
@@ -8890,6 +9822,8 @@ async def create_new_user(
             (request.id, request.name, request.grade, request.preferred_subject, request.password, request.role, school_id)
         )
         conn.commit()
+        invalidate_teacher_overview(school_id)
+        invalidate_ai_context(school_id)
         log_auth_event(x_user_id, "User Created", f"Created user {request.id} ({request.role})")
         return {"message": f"User {request.name} created successfully."}
     except sqlite3.IntegrityError:
@@ -9026,6 +9960,51 @@ async def get_student_data(
 
 # --- GROUP MANAGEMENT ---
 
+
+class RecommendationBatchRequest(BaseModel):
+    student_ids: List[str]
+
+@app.post("/api/recommendations/batch")
+async def get_recommendations_for_roster(
+    request: RecommendationBatchRequest,
+    x_user_id: str = Header(None, alias="X-User-Id")
+):
+    """Score a whole class roster in one model call."""
+    await verify_permission("view_all_grades", x_user_id=x_user_id)
+    if len(request.student_ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 students per request.")
+    if await run_db(lambda: RECOMMENDER.state) == "training":
+        raise HTTPException(status_code=503, detail=RECOMMENDER_TRAINING, headers={"Retry-After": "30"})
+
+    def _visible_students(conn):
+        requester = conn.execute("SELECT school_id, grade, is_super_admin FROM students WHERE id = ?", (x_user_id,)).fetchone()
+        if not requester:
+            raise HTTPException(status_code=403, detail="Unauthorized: Requester profile not found.")
+        ids = list(dict.fromkeys(request.student_ids))
+        if not ids:
+            return []
+        query = f"SELECT id FROM students WHERE id IN ({sql_placeholders(len(ids))})"
+        params = list(ids)
+        if not requester['is_super_admin']:
+            query += " AND school_id = ?"
+            params.append(requester['school_id'])
+            # Grade 0 means 'All Grades' access
+            if requester['grade']:
+                query += " AND grade = ?"
+                params.append(requester['grade'])
+        return [r['id'] for r in conn.execute(query, params).fetchall()]
+
+    async with async_db_connection() as conn:
+        student_ids = await conn.run(_visible_students)
+
+    recommendations = await run_db(get_recommendations_batch, student_ids)
+    model = RECOMMENDER.model
+    return {
+        "recommendations": recommendations,
+        "model_version": model.version if model else None,
+        "trained_at": model.trained_at if model else None,
+    }
+
 @app.post("/api/groups", status_code=201)
 async def create_group(
     request: GroupCreateRequest,
@@ -9278,11 +10257,7 @@ class LessonPlanRequest(BaseModel):
 class LessonPlanResponseAI(BaseModel):
     plan_markdown: str
 
-@app.post("/api/ai/generate-lesson-plan", response_model=LessonPlanResponseAI)
-async def generate_lesson_plan_v2(request: LessonPlanRequest):
-    if not LESSON_PLANNER_CLIENT:
-        raise HTTPException(status_code=503, detail="AI Service unavailable")
-
+def _lesson_plan_messages(request: LessonPlanRequest) -> List[Dict[str, str]]:
     prompt = f"""
     Create a detailed lesson plan for a {request.duration} class.
     Subject: {request.subject}
@@ -9299,27 +10274,33 @@ async def generate_lesson_plan_v2(request: LessonPlanRequest):
     
     Keep it engaging and practical.
     """
+    return [
+        {"role": "system", "content": "You are an expert educational consultant and curriculum developer."},
+        {"role": "user", "content": prompt}
+    ]
+
+LESSON_PLAN_PARAMS = {"model": "llama-3.1-8b-instant", "provider": "lesson_planner", "endpoint": "lesson_plan", "temperature": 0.7, "max_tokens": 1500, "top_p": 1}
+
+@app.post("/api/ai/generate-lesson-plan", response_model=LessonPlanResponseAI)
+async def generate_lesson_plan_v2(request: LessonPlanRequest):
+    if not LLM.available("lesson_planner"):
+        raise HTTPException(status_code=503, detail="AI Service unavailable")
 
     try:
-        completion = LESSON_PLANNER_CLIENT.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": "You are an expert educational consultant and curriculum developer."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=1500,
-            top_p=1,
-            stream=False,
-            stop=None,
-        )
-        
-        return LessonPlanResponseAI(plan_markdown=completion.choices[0].message.content)
+        completion = await LLM.complete(_lesson_plan_messages(request), **LESSON_PLAN_PARAMS)
+        return LessonPlanResponseAI(plan_markdown=completion.content)
 
     except Exception as e:
         logger.error(f"Lesson Plan Generation Failed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/ai/generate-lesson-plan/stream")
+async def stream_lesson_plan(request: LessonPlanRequest):
+    """Same as /api/ai/generate-lesson-plan, streamed as Server-Sent Events of Markdown."""
+    if not LLM.available("lesson_planner"):
+        raise HTTPException(status_code=503, detail="AI Service unavailable")
+    return _sse_response(LLM.stream(_lesson_plan_messages(request), **LESSON_PLAN_PARAMS))
+
 # --- ASSIGNMENTS & PROJECT MANAGEMENT ---
 @app.post("/api/ai/generate-quiz", response_model=GenerateQuizResponse)
 async def generate_quiz(
@@ -9339,10 +10320,7 @@ async def generate_quiz(
         if file and PdfReader:
             try:
                 if file.filename.endswith('.pdf'):
-                    pdf_reader = PdfReader(file.file)
-                    for page in pdf_reader.pages:
-                        pdf_context += page.extract_text() + "\n"
-                    pdf_context = pdf_context[:5000]
+                    pdf_context = _extracted_text(await _extract_upload(file))[:5000]
                 else:
                     content = await file.read()
                     pdf_context = content.decode('utf-8', errors='ignore')[:5000]
@@ -9376,7 +10354,8 @@ async def generate_quiz(
         
         # Use Groq Client (switched from OpenRouter)
         try:
-            chat_completion = GROQ_CLIENT.chat.completions.create(
+            chat_completion = await LLM.complete(
+                endpoint="generate_quiz",
                 messages=[
                     {
                         "role": "system", 
@@ -9390,7 +10369,7 @@ async def generate_quiz(
                 model=GROQ_MODEL, # Using Llama 3.1 8B Instant (fast) or 70B if configured
                 temperature=0.5,
             )
-            raw_content = chat_completion.choices[0].message.content.strip()
+            raw_content = chat_completion.content.strip()
             
             # Cleaning markdown if present
             if raw_content.startswith("```json"):
@@ -9777,55 +10756,120 @@ async def submit_quiz(quiz_id: int, request: QuizSubmitRequest):
                 score += 1
                 
         final_score_percent = (score / total) * 100 if total > 0 else 0
-        
-        # AI Assessment
+        # Deterministic until the feedback worker replaces it (see quiz_feedback.py).
         ai_feedback = "Good effort! Review the correct answers to improve."
-        if AI_ENABLED and GROQ_CLIENT:
-            try:
-                assessment_prompt = f"Quiz Title: {quiz['title']}\n"
-                for idx, q in enumerate(questions):
-                    user_ans = request.answers.get(str(idx), 'No Answer')
-                    assessment_prompt += f"Q{idx+1}: {q.get('question', 'Untitled')}\nCorrect: {q.get('correct_answer', 'N/A')}\nStudent Answer: {user_ans}\n\n"
-                
-                chat_completion = GROQ_CLIENT.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "system", 
-                            "content": "You are an encouraging AI Teacher. Review the student's quiz answers and provide a brief, personalized assessment (max 60 words). Mention what they did well and one thing to focus on."
-                        },
-                        {"role": "user", "content": assessment_prompt}
-                    ],
-                    model=GROQ_MODEL,
-                    temperature=0.7,
-                )
-                ai_feedback = chat_completion.choices[0].message.content.strip()
-            except Exception as ai_e:
-                logger.error(f"AI Assessment Error: {ai_e}")
 
         # Save Attempt
         answers_json = json.dumps(request.answers)
         submitted_at = datetime.now().isoformat()
+        cursor = conn.cursor()
         
-        conn.execute("INSERT INTO quiz_attempts (quiz_id, student_id, score, answers, ai_feedback, submitted_at) VALUES (?, ?, ?, ?, ?, ?)",
+        cursor.execute("INSERT INTO quiz_attempts (quiz_id, student_id, score, answers, ai_feedback, submitted_at) VALUES (?, ?, ?, ?, ?, ?)",
                     (quiz_id, request.student_id, final_score_percent, answers_json, ai_feedback, submitted_at))
+        attempt_id = cursor.lastrowid
         
         # Update Student Stats (XP, Activity Log)
-        conn.execute("INSERT INTO activities (student_id, date, topic, difficulty, score, time_spent_min, ai_feedback) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        cursor.execute("INSERT INTO activities (student_id, date, topic, difficulty, score, time_spent_min, ai_feedback) VALUES (?, ?, ?, ?, ?, ?, ?)",
                     (request.student_id, datetime.now().strftime("%Y-%m-%d"), f"Quiz: {quiz['title']}", "Medium", final_score_percent, 15, ai_feedback))
+        activity_id = cursor.lastrowid
 
+        student_row = conn.execute("SELECT school_id FROM students WHERE id = ?", (request.student_id,)).fetchone()
+        school_id = student_row['school_id'] if student_row else None
+        feedback_status = "pending" if AI_ENABLED else "unavailable"
+        if AI_ENABLED:
+            enqueue_quiz_feedback(cursor, attempt_id, activity_id, request.student_id, school_id)
         conn.commit()
         conn.close()
+        QUIZ_FEEDBACK.wake()
+        RECOMMENDER.notify_new_activities(1)
+        invalidate_teacher_overview(school_id)
+        invalidate_ai_context(school_id, request.student_id)
         
         return {
+            "attempt_id": attempt_id,
             "score_percent": final_score_percent, 
             "score": score, 
             "total": total, 
-            "ai_feedback": ai_feedback
+            "ai_feedback": ai_feedback,
+            "ai_feedback_status": feedback_status,
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Submit Quiz Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def _quiz_feedback_messages(conn, job):
+    """Assessment prompt for a queued attempt (see QUIZ_FEEDBACK); None if the attempt is gone."""
+    row = conn.execute("""
+        SELECT qa.answers, q.title, q.questions FROM quiz_attempts qa
+        JOIN quizzes q ON qa.quiz_id = q.id
+        WHERE qa.id = ?
+    """, (job['attempt_id'],)).fetchone()
+    if not row:
+        return None
+    answers = json.loads(row['answers'] or "{}")
+    assessment_prompt = f"Quiz Title: {row['title']}\n"
+    for idx, q in enumerate(json.loads(row['questions'] or "[]")):
+        user_ans = answers.get(str(idx), 'No Answer')
+        assessment_prompt += f"Q{idx+1}: {q.get('question', 'Untitled')}\nCorrect: {q.get('correct_answer', 'N/A')}\nStudent Answer: {user_ans}\n\n"
+    return [
+        {
+            "role": "system", 
+            "content": "You are an encouraging AI Teacher. Review the student's quiz answers and provide a brief, personalized assessment (max 60 words). Mention what they did well and one thing to focus on."
+        },
+        {"role": "user", "content": assessment_prompt}
+    ]
+
+async def _complete_quiz_feedback(messages):
+    completion = await LLM.complete(messages=messages, endpoint="quiz_feedback", model=GROQ_MODEL, temperature=0.7)
+    return completion.content
+
+def _quiz_feedback_saved(job):
+    invalidate_ai_context(job['school_id'], job['student_id'])
+
+# AI assessments of quiz attempts, written after the attempt is committed.
+# At most QUIZ_FEEDBACK_PER_SCHOOL LLM calls per school run at once.
+QUIZ_FEEDBACK = QuizFeedbackWorker(
+    connect=lambda: get_db_connection(),
+    build_messages=_quiz_feedback_messages,
+    complete=_complete_quiz_feedback,
+    run_blocking=run_db,
+    on_saved=_quiz_feedback_saved,
+    batch_size=int(os.getenv("QUIZ_FEEDBACK_BATCH_SIZE", "20")),
+    per_school=int(os.getenv("QUIZ_FEEDBACK_PER_SCHOOL", "2")),
+    poll_interval=float(os.getenv("QUIZ_FEEDBACK_POLL_SECONDS", "5")),
+    max_attempts=int(os.getenv("QUIZ_FEEDBACK_MAX_ATTEMPTS", "3")),
+)
+
+@app.get("/api/quizzes/attempts/{attempt_id}/feedback")
+async def get_quiz_attempt_feedback(
+    attempt_id: int,
+    x_user_id: str = Header(None, alias="X-User-Id"),
+    x_user_role: str = Header(None, alias="X-User-Role")
+):
+    """Poll for the AI assessment of a submitted attempt: status is pending, done, failed or unavailable."""
+    def load():
+        conn = get_db_connection()
+        try:
+            attempt = conn.execute("SELECT student_id, ai_feedback FROM quiz_attempts WHERE id = ?", (attempt_id,)).fetchone()
+            job = conn.execute(
+                "SELECT status FROM quiz_feedback_jobs WHERE attempt_id = ? ORDER BY id DESC LIMIT 1", (attempt_id,)
+            ).fetchone()
+            return attempt, job
+        finally:
+            conn.close()
+
+    attempt, job = await run_db(load)
+    if not attempt:
+        raise HTTPException(status_code=404, detail="Attempt not found")
+    if x_user_id != attempt['student_id'] and x_user_role not in ['Teacher', 'Admin', 'Super Admin', 'Principal', 'Tenant_Admin']:
+        raise HTTPException(status_code=403, detail="Not your attempt")
+    status = job['status'] if job else "unavailable"
+    if status == "running":
+        status = "pending"
+    return {"attempt_id": attempt_id, "status": status, "ai_feedback": attempt['ai_feedback']}
+
 @app.get("/api/quizzes/{quiz_id}/results")
 async def get_quiz_results(
     quiz_id: int, 
@@ -10056,31 +11100,27 @@ async def create_announcement(req: AnnouncementCreateRequest):
 @app.get("/api/communication/messages")
 async def get_messages(user_id: str = Header(None, alias="X-User-Id")):
     if not user_id: return []
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Get messages where I am receiver OR sender
-    msgs = c.execute("""
-        SELECT * FROM messages 
-        WHERE receiver_id = ? OR sender_id = ? 
-        ORDER BY timestamp DESC
-    """, (user_id, user_id)).fetchall()
-    conn.close()
+    async with async_db_connection() as conn:
+        # Get messages where I am receiver OR sender
+        msgs = await conn.fetchall("""
+            SELECT * FROM messages 
+            WHERE receiver_id = ? OR sender_id = ? 
+            ORDER BY timestamp DESC
+        """, (user_id, user_id))
     return [dict(m) for m in msgs]
 
 @app.post("/api/communication/messages")
 async def send_message(req: MessageSendRequest, user_id: str = Header(None, alias="X-User-Id")):
     if not user_id: raise HTTPException(status_code=401)
-    conn = get_db_connection()
-    try:
-        ts = datetime.now().isoformat()
-        conn.execute("INSERT INTO messages (sender_id, receiver_id, content, subject, timestamp, is_read) VALUES (?, ?, ?, ?, ?, FALSE)", 
-                     (user_id, req.receiver_id, req.content, req.subject, ts))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+    async with async_db_connection() as conn:
+        try:
+            ts = datetime.now().isoformat()
+            await conn.execute("INSERT INTO messages (sender_id, receiver_id, content, subject, timestamp, is_read) VALUES (?, ?, ?, ?, ?, FALSE)", 
+                               (user_id, req.receiver_id, req.content, req.subject, ts))
+            await conn.commit()
+        except Exception as e:
+            await conn.rollback()
+            raise HTTPException(status_code=500, detail=str(e))
     return {"success": True}
 
 @app.get("/api/communication/events")
@@ -10611,6 +11651,8 @@ async def assign_student_section(student_id: str, section_id: int, x_user_id: st
         if cursor.cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="Student not found")
         conn.commit()
+        invalidate_teacher_overview(section['school_id'])
+        invalidate_ai_context(section['school_id'], student_id)
     finally:
         conn.close()
     return {"message": "Student assigned to section successfully"}
@@ -11221,10 +12263,9 @@ def _notify_form_or_schedule_upload(conn, sender_id: str, school_id: int, title:
             f"File: {web_path}"
         )
     audiences = ("teachers", "parents") if is_schedule else ("teachers", "students", "parents")
-    for audience in audiences:
-        ids = [rid for rid in recipients[audience] if rid and rid != sender_id]
-        if ids:
-            _send_messages(conn, sender_id, ids, subject_line, body)
+    ids = [rid for audience in audiences for rid in recipients[audience] if rid and rid != sender_id]
+    if ids:
+        _send_messages(conn, sender_id, ids, subject_line, body)
 
 @app.get("/api/resources/form-templates")
 async def get_form_templates():
@@ -11284,6 +12325,7 @@ async def publish_form_template(
         )
 
         conn.commit()
+        invalidate_resource_summary(target_school_id)
         return ResourceResponse(
             id=resource_id,
             title=title,
@@ -11351,6 +12393,27 @@ async def get_resources(
     finally:
         conn.close()
 
+def _queue_resource_extraction(resource_id: int, school_id: int, file_location: str):
+    """Fill resources.extracted_text (and through it the full-text index) once the PDF is parsed."""
+    def _store(future):
+        result = future.result()
+        if result.status != STATUS_DONE or not result.text:
+            return
+        try:
+            conn = get_db_connection()
+            try:
+                conn.execute("UPDATE resources SET extracted_text = ? WHERE id = ?", (result.text, resource_id))
+                conn.commit()
+            finally:
+                conn.close()
+            invalidate_resource_summary(school_id)
+        except Exception as e:
+            logger.error(f"Could not save extracted text for resource {resource_id}: {e}")
+
+    with open(file_location, "rb") as f:
+        data = f.read()
+    EXTRACTION.submit(data, file_location).add_done_callback(_store)
+
 @app.post("/api/resources", response_model=ResourceResponse)
 async def create_resource(
     title: str = Form(...),
@@ -11450,6 +12513,9 @@ async def create_resource(
             logger.warning(f"Resource notification failed: {notify_err}")
 
         conn.commit()
+        invalidate_resource_summary(target_school_id)
+        if (file_ext or "").lower() == ".pdf" and PdfReader:
+            await run_db(_queue_resource_extraction, resource_id, target_school_id, file_location)
         
         return ResourceResponse(
             id=resource_id,
@@ -11478,6 +12544,7 @@ async def delete_resource(resource_id: int):
         cursor.execute("DELETE FROM resources WHERE id = ?", (resource_id,))
         # Check rowcount if possible, but wrapper might not expose it easily without result.
         conn.commit()
+        invalidate_resource_summary()
         return {"message": "Resource deleted successfully"}
     except Exception as e:
         logger.error(f"Error deleting resource: {e}")
@@ -11862,23 +12929,20 @@ async def add_section(course_id: int, section: LMSSectionCreateRequest):
     return {**section.dict(), "id": s_id, "course_id": course_id}
 
 
-def extract_text_from_file(file_path):
+async def extract_text_from_file(file_path):
+    if not file_path.endswith('.pdf') or not PdfReader:
+        return ""
     try:
-        from pypdf import PdfReader
-        if file_path.endswith('.pdf'):
-            reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages[:10]:
-                text += page.extract_text() + "\n"
-            return text
-    except: return ""
-    return ""
+        with open(file_path, "rb") as f:
+            data = f.read()
+        future = await run_db(EXTRACTION.submit, data, file_path)
+        return _extracted_text(await EXTRACTION.wait(future, EXTRACTION_WAIT_SECONDS))
+    except Exception as e:
+        logger.error(f"Module text extraction failed for {file_path}: {e}")
+        return ""
 
 @app.post("/api/lms/sections/{section_id}/modules", response_model=LMSModuleResponse)
 async def add_module(section_id: int, module: LMSModuleCreateRequest):
-    conn = get_db_connection()
-    c = conn.cursor()
-    
     # RAG Logic
     searchable_text = ""
     if module.type == 'html':
@@ -11887,15 +12951,28 @@ async def add_module(section_id: int, module: LMSModuleCreateRequest):
         # Local file
         fs_path = module.content_url.lstrip('/')
         if os.path.exists(fs_path):
-            searchable_text = extract_text_from_file(fs_path)
-    
+            searchable_text = await extract_text_from_file(fs_path)
+
+    conn = get_db_connection()
+    c = conn.cursor()
     c.execute("""
         INSERT INTO lms_course_modules (section_id, title, type, content_url, content_text, searchable_text, order_index)
         VALUES (?, ?, ?, ?, ?, ?, ?)
     """, (section_id, module.title, module.type, module.content_url, module.content_text, searchable_text, module.order_index))
     m_id = c.lastrowid
+
+    # Retrieval chunks for course chat, in the same transaction as the module.
+    course_id = None
+    if searchable_text:
+        section = c.execute("SELECT course_id FROM lms_course_sections WHERE id = ?", (section_id,)).fetchone()
+        if section:
+            course_id = section['course_id']
+            insert_rows(c, "lms_module_chunks", CHUNK_COLUMNS, module_chunk_rows(
+                m_id, course_id, module.title, searchable_text, COURSE_CHUNK_WORDS, COURSE_CHUNK_OVERLAP))
     conn.commit()
     conn.close()
+    if course_id is not None:
+        COURSE_RETRIEVER.refresh(course_id)
     return {**module.dict(), "id": m_id, "section_id": section_id}
 
 
@@ -11903,30 +12980,12 @@ class LMSCompletionRequest(BaseModel):
     score: float
     status: str
 
-@app.post("/api/ai/chat/course/{course_id}")
-async def chat_with_course(course_id: int, request: AIChatRequest):
-    if not AI_ENABLED or not GROQ_CLIENT:
-         return {"reply": "AI Service Unavailable"}
-
-    conn = get_db_connection()
-    # 1. Fetch relevant content (Naive RAG: Fetch all text for now, should use Vector DB in prod)
-    # Get all searchable text for this course
-    # Joined via sections
-    rows = conn.execute("""
-        SELECT m.searchable_text, m.title FROM lms_course_modules m
-        JOIN lms_course_sections s ON m.section_id = s.id
-        WHERE s.course_id = ? AND m.searchable_text IS NOT NULL AND m.searchable_text != ''
-    """, (course_id,)).fetchall()
-    
-    context = ""
-    for r in rows:
-        context += f"\n--- Module: {r['title']} ---\n{r['searchable_text'][:5000]}" # Limit size per module
-        
-    context = context[:20000] # Hard limit for prompt
-    conn.close()
-    
-    if not context:
-        return {"reply": "I don't have enough content from this course to answer yet."}
+def _course_chat_messages(course_id: int, prompt: str) -> Optional[List[Dict[str, str]]]:
+    """Tutor prompt grounded in the course chunks most relevant to ``prompt``, or None if the course has none."""
+    chunks = COURSE_RETRIEVER.search(course_id, prompt)
+    if not chunks:
+        return None
+    context = "".join(f"\n--- Module: {c['title']} ---\n{c['text']}" for c in chunks)
 
     system_prompt = (
         "You are an AI Tutor for a specific course. "
@@ -11934,21 +12993,39 @@ async def chat_with_course(course_id: int, request: AIChatRequest):
         "If the answer is not in the content, say 'I cannot find that in the course material'.\n\n"
         f"Course Content:\n{context}"
     )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt}
+    ]
+
+COURSE_CHAT_NO_CONTENT = "I don't have enough content from this course to answer yet."
+
+@app.post("/api/ai/chat/course/{course_id}")
+async def chat_with_course(course_id: int, request: AIChatRequest):
+    if not AI_ENABLED:
+         return {"reply": "AI Service Unavailable"}
+
+    messages = await run_db(_course_chat_messages, course_id, request.prompt)
+    if not messages:
+        return {"reply": COURSE_CHAT_NO_CONTENT}
     
     try:
-        completion = GROQ_CLIENT.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": request.prompt}
-            ],
-            model="llama-3.1-8b-instant",
-            temperature=0.3
-        )
-        return {"reply": completion.choices[0].message.content}
+        completion = await LLM.complete(messages, endpoint="course_chat", model="llama-3.1-8b-instant", temperature=0.3)
+        return {"reply": completion.content}
     except Exception as e:
         logger.error(f"AI Course Chat Error: {e}")
         return {"reply": "Sorry, I encountered an error while thinking."}
 
+@app.post("/api/ai/chat/course/{course_id}/stream")
+async def stream_chat_with_course(course_id: int, request: AIChatRequest):
+    """Same as /api/ai/chat/course/{course_id}, streamed as Server-Sent Events."""
+    if not AI_ENABLED:
+        raise HTTPException(status_code=503, detail="AI Service Unavailable")
+    messages = await run_db(_course_chat_messages, course_id, request.prompt)
+    if not messages:
+        raise HTTPException(status_code=404, detail=COURSE_CHAT_NO_CONTENT)
+    return _sse_response(LLM.stream(messages, endpoint="course_chat_stream", model="llama-3.1-8b-instant", temperature=0.3))
+
 @app.post("/api/lms/modules/{module_id}/complete")
 async def complete_module(module_id: int, request: LMSCompletionRequest, x_user_id: str = Header(None, alias="X-User-Id")):
     if not x_user_id:
@@ -11982,7 +13059,7 @@ class QuestionGradingRequest(BaseModel):
 
 @app.post("/api/ai/grade/short-answer")
 async def grade_quiz_short_answer(request: QuestionGradingRequest):
-    if not AI_ENABLED or not GROQ_CLIENT:
+    if not AI_ENABLED:
          return {"score": 0, "feedback": "AI Service Unavailable. Manual grading required."}
     
     system_prompt = (
@@ -11997,7 +13074,8 @@ async def grade_quiz_short_answer(request: QuestionGradingRequest):
         user_prompt += f"Context/Correct Answer Reference: {request.context}"
         
     try:
-        completion = GROQ_CLIENT.chat.completions.create(
+        completion = await LLM.complete(
+            endpoint="grade_short_answer",
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
@@ -12006,7 +13084,7 @@ async def grade_quiz_short_answer(request: QuestionGradingRequest):
             temperature=0.1,
             response_format={"type": "json_object"}
         )
-        content = completion.choices[0].message.content
+        content = completion.content
         import json
         result = json.loads(content)
         return result
@@ -12014,6 +13092,63 @@ async def grade_quiz_short_answer(request: QuestionGradingRequest):
         logger.error(f"AI Grading Error: {e}")
         return {"score": 0, "feedback": "Error during AI grading."}
 
+class BatchGradingItem(BaseModel):
+    id: Optional[str] = None # echoed back; defaults to the item's position
+    question: str
+    student_answer: str
+    context: Optional[str] = None # reference answer, as in QuestionGradingRequest
+
+class BatchGradingRequest(BaseModel):
+    items: List[BatchGradingItem]
+    stream: bool = True
+
+async def _complete_grading_batch(messages):
+    completion = await LLM.complete(messages, endpoint="grade_short_answer_batch", model="llama-3.1-8b-instant", temperature=0.1, response_format={"type": "json_object"})
+    return completion.content
+
+# Verdicts are cached per (question + reference, normalised answer) across requests (see batch_grading.py).
+GRADER = BatchGrader(
+    _complete_grading_batch,
+    batch_size=int(os.getenv("GRADING_BATCH_SIZE", "8")),
+    concurrency=int(os.getenv("GRADING_CONCURRENCY", "4")),
+    cache_size=int(os.getenv("GRADING_CACHE_SIZE", "20000")),
+    cache_ttl=float(os.getenv("GRADING_CACHE_TTL", "86400")),
+)
+GRADING_BATCH_MAX_ITEMS = int(os.getenv("GRADING_BATCH_MAX_ITEMS", "1000"))
+
+@app.post("/api/ai/grade/short-answer/batch")
+async def grade_short_answers_batch(request: BatchGradingRequest):
+    """Grade many answers at once.
+
+    Streams one Server-Sent Event per item as its verdict arrives
+    (``{"id", "score", "feedback", "cached"}``), then ``done`` with counts;
+    with ``stream: false`` returns ``{"results": [...]}`` in request order.
+    """
+    if not AI_ENABLED:
+        raise HTTPException(status_code=503, detail="AI Service Unavailable. Manual grading required.")
+    if len(request.items) > GRADING_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {GRADING_BATCH_MAX_ITEMS} items per batch.")
+    items = [
+        GradingItem(item.id if item.id is not None else str(i), item.question, item.student_answer, item.context)
+        for i, item in enumerate(request.items)
+    ]
+
+    if not request.stream:
+        by_id = {}
+        async for result in GRADER.grade(items):
+            by_id[result["id"]] = result
+        return {"results": [by_id[item.id] for item in items if item.id in by_id]}
+
+    async def events():
+        graded = errors = 0
+        async for result in GRADER.grade(items):
+            graded += 1
+            errors += bool(result.get("error"))
+            yield f"data: {json.dumps(result)}\n\n"
+        yield f"event: done\ndata: {json.dumps({'items': graded, 'errors': errors})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 # --- Attendance Module ---
 class AttendanceRecord(BaseModel):
     student_id: str
@@ -12035,63 +13170,64 @@ def _normalize_attendance_date(date_value: str) -> str:
             continue
     return raw
 
-def _resolve_parent_ids_for_student(cursor, student_id: str, school_id: Optional[int], guardians) -> List[str]:
-    parent_ids = set()
-
-    for g in guardians:
-        guardian_email = (g["email"] or "").strip()
-        guardian_name = (g["name"] or "").strip()
-
-        if guardian_email:
-            rows = cursor.execute(
-                """
-                SELECT id
-                FROM students
-                WHERE role IN ('Parent', 'Parent_Guardian')
-                  AND LOWER(id) = LOWER(?)
-                  AND (? IS NULL OR school_id = ?)
-                """,
-                (guardian_email, school_id, school_id)
-            ).fetchall()
-            for r in rows:
-                parent_ids.add(r["id"])
-
-        if guardian_name:
-            rows = cursor.execute(
-                """
-                SELECT id
-                FROM students
-                WHERE role IN ('Parent', 'Parent_Guardian')
-                  AND (
-                      LOWER(id) = LOWER(?)
-                      OR LOWER(name) = LOWER(?)
-                  )
-                  AND (? IS NULL OR school_id = ?)
-                """,
-                (guardian_name, guardian_name, school_id, school_id)
-            ).fetchall()
-            for r in rows:
-                parent_ids.add(r["id"])
+def _resolve_parent_ids_for_students(cursor, student_schools: Dict[str, Optional[int]], guardians_by_student: Dict[str, list]) -> Dict[str, List[str]]:
+    """Parent user ids per student, resolved for the whole batch with one students query.
 
-    # Backward-compatible fallback used in parent login flow: guardians.email == parent user_id
-    rows = cursor.execute(
-        """
-        SELECT DISTINCT s.id
-        FROM students s
-        JOIN guardians g ON LOWER(g.email) = LOWER(s.id)
-        WHERE g.student_id = ?
-          AND s.role IN ('Parent', 'Parent_Guardian')
-          AND (? IS NULL OR s.school_id = ?)
-        """,
-        (student_id, school_id, school_id)
-    ).fetchall()
-    for r in rows:
-        parent_ids.add(r["id"])
+    A guardian matches a Parent/Parent_Guardian user whose id equals the guardian
+    email or name, or whose name equals the guardian name (case-insensitive),
+    within the student's school when it is known.
+    """
+    keys, names = set(), set()
+    for guardians in guardians_by_student.values():
+        for g in guardians:
+            for value in (g["email"], (g["email"] or "").strip()):
+                if value:
+                    keys.add(value.lower())
+            guardian_name = (g["name"] or "").strip().lower()
+            if guardian_name:
+                keys.add(guardian_name)
+                names.add(guardian_name)
+
+    parents_by_id, parents_by_name = {}, {}
+    key_list, name_list = sorted(keys), sorted(names)
+    for chunk in chunked(key_list):
+        for r in cursor.execute(
+            f"SELECT id, school_id FROM students WHERE role IN ('Parent', 'Parent_Guardian') AND LOWER(id) IN ({sql_placeholders(len(chunk))})",
+            list(chunk)
+        ).fetchall():
+            parents_by_id.setdefault(r["id"].lower(), []).append((r["id"], r["school_id"]))
+    for chunk in chunked(name_list):
+        for r in cursor.execute(
+            f"SELECT id, name, school_id FROM students WHERE role IN ('Parent', 'Parent_Guardian') AND LOWER(name) IN ({sql_placeholders(len(chunk))})",
+            list(chunk)
+        ).fetchall():
+            parents_by_name.setdefault((r["name"] or "").lower(), []).append((r["id"], r["school_id"]))
+
+    result = {}
+    for student_id, school_id in student_schools.items():
+        parent_ids = set()
+        for g in guardians_by_student.get(student_id, []):
+            candidates = []
+            for value in {(g["email"] or "").lower(), (g["email"] or "").strip().lower()}:
+                if value:
+                    candidates += parents_by_id.get(value, [])
+            guardian_name = (g["name"] or "").strip().lower()
+            if guardian_name:
+                candidates += parents_by_id.get(guardian_name, []) + parents_by_name.get(guardian_name, [])
+            for pid, parent_school in candidates:
+                if school_id is None or parent_school == school_id:
+                    parent_ids.add(pid)
+        result[student_id] = sorted(parent_ids)
+    return result
 
-    return sorted(parent_ids)
+def _resolve_parent_ids_for_student(cursor, student_id: str, school_id: Optional[int], guardians) -> List[str]:
+    return _resolve_parent_ids_for_students(cursor, {student_id: school_id}, {student_id: list(guardians)})[student_id]
 
 @app.post("/api/attendance/bulk")
 async def take_bulk_attendance(req: BulkAttendanceRequest, x_user_id: str = Header(None, alias="X-User-Id")):
+    return await run_db(_take_bulk_attendance_sync, req, x_user_id)
+
+def _take_bulk_attendance_sync(req: BulkAttendanceRequest, x_user_id: Optional[str]):
     conn = get_db_connection()
     c = conn.cursor()
     created_at = datetime.now().isoformat()
@@ -12115,70 +13251,73 @@ async def take_bulk_attendance(req: BulkAttendanceRequest, x_user_id: str = Head
     notify_error_count = 0
     
     try:
+        # 1. Prefetch every submitted student and their guardians in one query each
+        submitted_ids = list(dict.fromkeys(r.student_id for r in req.records))
+        students = {}
+        guardians_by_student = {}
+        for chunk in chunked(submitted_ids):
+            for row in c.execute(
+                f"SELECT id, name, school_id FROM students WHERE role = 'Student' AND id IN ({sql_placeholders(len(chunk))})",
+                list(chunk)
+            ).fetchall():
+                students[row["id"]] = row
+        for chunk in chunked(list(students)):
+            for g in c.execute(
+                f"SELECT student_id, email, name FROM guardians WHERE student_id IN ({sql_placeholders(len(chunk))})",
+                list(chunk)
+            ).fetchall():
+                guardians_by_student.setdefault(g["student_id"], []).append(g)
+
+        # 2. Normalise records; the last record for a student wins
+        records = {}
         for record in req.records:
-            student_row = c.execute(
-                "SELECT id, name, school_id FROM students WHERE id = ? AND role = 'Student'",
-                (record.student_id,)
-            ).fetchone()
-            if not student_row:
+            if record.student_id not in students:
                 skipped_count += 1
                 continue
-
             status = str(record.status or "").strip().title()
             if status not in ("Present", "Absent", "Late"):
                 status = "Present"
-            remarks = (record.remarks or "").strip()
-
-            try:
-                c.execute("DELETE FROM student_attendance WHERE student_id = ? AND date = ?", (record.student_id, attendance_date))
-                c.execute("""
-                    INSERT INTO student_attendance (student_id, date, status, remarks, recorded_by, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                """, (record.student_id, attendance_date, status, remarks, sender_id, created_at))
-            except Exception as row_error:
-                logger.warning(f"Attendance row skipped for {record.student_id}: {row_error}")
-                skipped_count += 1
-                continue
-
-            saved_count += 1
+            records[record.student_id] = (status, (record.remarks or "").strip())
+
+        # 3. Upsert attendance against the unique (student_id, date) key
+        saved_count = insert_rows(
+            c, "student_attendance",
+            ("student_id", "date", "status", "remarks", "recorded_by", "created_at"),
+            [(sid, attendance_date, status, remarks, sender_id, created_at) for sid, (status, remarks) in records.items()],
+            suffix="ON CONFLICT (student_id, date) DO UPDATE SET status = excluded.status, remarks = excluded.remarks, "
+                   "recorded_by = excluded.recorded_by, created_at = excluded.created_at",
+        )
+        conn.commit()
 
-            # Notify student + parents on attendance update (non-blocking)
-            if sender_id and status in ("Present", "Absent", "Late"):
-                guardians = c.execute("SELECT email, name FROM guardians WHERE student_id = ?", (record.student_id,)).fetchall()
-                student_name = student_row["name"] if student_row else "Student"
-                school_id = student_row["school_id"] if student_row else None
+        # 4. Queue student + parent notifications with one multi-row insert
+        if sender_id and records:
+            parents = _resolve_parent_ids_for_students(
+                c, {sid: students[sid]["school_id"] for sid in records}, guardians_by_student
+            )
+            student_messages, parent_messages = [], []
+            for sid, (status, remarks) in records.items():
+                student_name = students[sid]["name"] or "Student"
                 status_upper = status.upper()
                 remarks_suffix = f" Remarks: {remarks}" if remarks else ""
+                student_messages.append((
+                    sender_id, sid, f"Your Attendance: {status}",
+                    f"Hi {student_name}, your attendance for {attendance_date} is marked as {status_upper}.{remarks_suffix}",
+                ))
+                for pid in parents.get(sid, []):
+                    parent_messages.append((
+                        sender_id, pid, f"Attendance: {student_name} is {status}",
+                        f"Your child {student_name} has been marked {status_upper} for {attendance_date}.{remarks_suffix}",
+                    ))
+            try:
+                enqueue_notifications(c, CHANNEL_MESSAGE, student_messages + parent_messages)
+                conn.commit()
+                student_notified = len(student_messages)
+                parent_notified = len(parent_messages)
+            except Exception as notify_err:
+                conn.rollback()
+                notify_error_count = len(student_messages) + len(parent_messages)
+                logger.warning(f"Attendance notifications failed for {attendance_date}: {notify_err}")
 
-                # Student notification
-                student_subject = f"Your Attendance: {status}"
-                student_content = f"Hi {student_name}, your attendance for {attendance_date} is marked as {status_upper}.{remarks_suffix}"
-                try:
-                    c.execute("""
-                        INSERT INTO messages (sender_id, receiver_id, subject, content, timestamp, is_read)
-                        VALUES (?, ?, ?, ?, ?, FALSE)
-                    """, (sender_id, record.student_id, student_subject, student_content, created_at))
-                    student_notified += 1
-                except Exception as notify_err:
-                    notify_error_count += 1
-                    logger.warning(f"Student attendance notification failed for {record.student_id}: {notify_err}")
-
-                # Parent notifications
-                parent_ids = _resolve_parent_ids_for_student(c, record.student_id, school_id, guardians)
-                for pid in parent_ids:
-                    subject = f"Attendance: {student_name} is {status}"
-                    content = f"Your child {student_name} has been marked {status_upper} for {attendance_date}.{remarks_suffix}"
-                    try:
-                        c.execute("""
-                               INSERT INTO messages (sender_id, receiver_id, subject, content, timestamp, is_read)
-                               VALUES (?, ?, ?, ?, ?, FALSE)
-                            """, (sender_id, pid, subject, content, created_at))
-                        parent_notified += 1
-                    except Exception as notify_err:
-                        notify_error_count += 1
-                        logger.warning(f"Parent attendance notification failed for {pid}: {notify_err}")
-            
-        conn.commit()
         return {
             "success": True,
             "date": attendance_date,
@@ -13085,11 +14224,16 @@ async def send_internal_email(req: EmailSendRequest,
 
         # Scope by school unless super admin
         if not is_super_admin and sender_school_id:
+            school_of = {}
+            for chunk in chunked(recipients):
+                for r in cursor.execute(
+                    f"SELECT id, school_id FROM students WHERE id IN ({sql_placeholders(len(chunk))})", list(chunk)
+                ).fetchall():
+                    school_of[r["id"]] = r["school_id"]
             scoped = []
             for rid in recipients:
-                r = cursor.execute("SELECT id, school_id FROM students WHERE id = ?", (rid,)).fetchone()
-                if r and r["school_id"] == sender_school_id:
-                    scoped.append(r["id"])
+                if rid in school_of and school_of[rid] == sender_school_id:
+                    scoped.append(rid)
                 elif "@" in rid:
                     # allow external email addresses (send only)
                     scoped.append(rid)
@@ -13099,15 +14243,14 @@ async def send_internal_email(req: EmailSendRequest,
             raise HTTPException(status_code=404, detail="No valid recipients found.")
 
         ts = datetime.now().isoformat()
-        for rid in recipients:
-            cursor.execute("""
-                INSERT INTO emails (sender_id, recipient_email, subject, body, sent_at, is_read)
-                VALUES (?, ?, ?, ?, ?, FALSE)
-            """, (x_user_id, rid, req.subject, req.body, ts))
-
-            # If recipient looks like an email, try SMTP send
-            if "@" in rid:
-                send_email(rid, req.subject, req.body)
+        insert_rows(
+            cursor, "emails", ("sender_id", "recipient_email", "subject", "body", "sent_at", "is_read"),
+            [(x_user_id, rid, req.subject, req.body, ts, False) for rid in recipients],
+        )
+        # Recipients that look like email addresses also get a real email, sent by the outbox dispatcher
+        external = [rid for rid in recipients if "@" in rid]
+        if external:
+            enqueue_notifications(cursor, CHANNEL_EMAIL, [(x_user_id, rid, req.subject, req.body) for rid in external])
 
         conn.commit()
         return {"success": True, "sent": len(recipients)}
@@ -13335,15 +14478,14 @@ async def update_leave_status(leave_id: int, update: LeaveStatusUpdate, x_user_r
 
 @app.get("/api/notifications/inbox")
 async def get_notifications(x_user_id: str = Header(..., alias="X-User-Id")):
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        msgs = cursor.execute("""
-            SELECT id, sender_id, subject, content, timestamp, is_read 
-            FROM messages 
-            WHERE receiver_id = ? 
-            ORDER BY timestamp DESC
-        """, (x_user_id,)).fetchall()
+        async with async_db_connection() as conn:
+            msgs = await conn.fetchall("""
+                SELECT id, sender_id, subject, content, timestamp, is_read 
+                FROM messages 
+                WHERE receiver_id = ? 
+                ORDER BY timestamp DESC
+            """, (x_user_id,))
         
         result = []
         for row in msgs:
@@ -13359,26 +14501,21 @@ async def get_notifications(x_user_id: str = Header(..., alias="X-User-Id")):
     except Exception as e:
         print(f"Error fetching notifications: {e}")
         return []
-    finally:
-        conn.close()
 
 @app.put("/api/notifications/{msg_id}/read")
 async def mark_notification_read(msg_id: int, x_user_id: str = Header(..., alias="X-User-Id")):
-    conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute("UPDATE messages SET is_read = 1 WHERE id = ? AND receiver_id = ?", (msg_id, x_user_id))
-        if cursor.rowcount == 0:
-            raise HTTPException(status_code=404, detail="Notification not found.")
-        conn.commit()
+        async with async_db_connection() as conn:
+            cursor = await conn.execute("UPDATE messages SET is_read = 1 WHERE id = ? AND receiver_id = ?", (msg_id, x_user_id))
+            if cursor.rowcount == 0:
+                raise HTTPException(status_code=404, detail="Notification not found.")
+            await conn.commit()
         return {"success": True}
     except HTTPException:
         raise
     except Exception as e:
         print(f"Error marking notification read: {e}")
         raise HTTPException(status_code=500, detail="Failed to update notification")
-    finally:
-        conn.close()
 
 
 # --- PROGRESS CARD ENDPOINTS ---
@@ -13789,7 +14926,7 @@ async def get_student_exams(x_user_id: str = Header(None, alias="X-User-Id")):
 
 if __name__ == "__main__":
     try:
-        initialize_db()
+        initialize_db(apply_migrations=DB_MIGRATE_ON_STARTUP)
         print("Database initialized successfully.")
     except Exception as e:
         print(f"Error initializing database: {e}")
@@ -0,0 +1,192 @@
+"""Batch grading of short answers.
+
+``/api/ai/grade/short-answer`` grades one answer per request, so a class set
+(30 students x 10 questions) meant 300 serial LLM calls. ``BatchGrader``
+grades a whole set:
+
+* identical answers to the same question (after ``normalize_answer``) are
+  graded once and the verdict is copied to every item that gave them;
+* verdicts are cached per (question hash, normalised answer), where the
+  question hash covers the question and its reference answer;
+* the remaining answers are packed ``batch_size`` to a prompt, with at most
+  ``concurrency`` prompts in flight;
+* ``grade`` yields each item's result as soon as its batch returns.
+
+An answer the model leaves out of a batch reply is retried on its own once;
+if that fails too the item gets an error result, which is not cached.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import unicodedata
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from backend.ttl_cache import TTLCache
+except Exception:
+    from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+Messages = List[Dict[str, str]]
+
+GRADING_SYSTEM_PROMPT = (
+    "You are a strictly academic AI Assistant grading students' short answer responses. "
+    "Score each answer from 0 to 100 based on accuracy and completeness, using the reference answer when one is given. "
+    "You receive a JSON list of items with 'id', 'question', 'reference' and 'answer'. "
+    "Reply with a JSON object {\"results\": [{\"id\": ..., \"score\": integer 0-100, \"feedback\": 1-2 sentences}]} "
+    "containing one entry per item id. Grade every item independently. Do not output anything else."
+)
+
+
+def normalize_answer(text: str) -> str:
+    """Lowercase, unify unicode forms, collapse whitespace and drop a trailing full stop.
+
+    Signs, operators and other punctuation are kept: ``-3`` / ``3`` and
+    ``x > 5`` / ``x < 5`` are different answers.
+    """
+    text = " ".join(unicodedata.normalize("NFKC", text or "").lower().split())
+    if text.endswith(".") and not text.endswith(".."):
+        text = text[:-1].rstrip()
+    return text
+
+
+def question_hash(question: str, reference: Optional[str] = None) -> str:
+    digest = hashlib.sha256()
+    for part in (question or "", reference or ""):
+        digest.update(" ".join(part.split()).encode("utf-8", "replace"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()[:16]
+
+
+@dataclass
+class GradingItem:
+    id: Any
+    question: str
+    student_answer: str
+    reference: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        return question_hash(self.question, self.reference), normalize_answer(self.student_answer)
+
+
+def _clamp_score(value: Any) -> int:
+    return max(0, min(100, int(round(float(value)))))
+
+
+class BatchGrader:
+    def __init__(
+        self,
+        complete: Callable[[Messages], Awaitable[str]],
+        batch_size: int = 8,
+        concurrency: int = 4,
+        cache_size: int = 20000,
+        cache_ttl: float = 24 * 3600,
+    ):
+        self._complete = complete
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self._verdicts = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self._stats = {"items": 0, "cache_hits": 0, "deduped": 0, "graded": 0, "llm_calls": 0, "retries": 0, "errors": 0}
+
+    @staticmethod
+    def _messages(batch: Sequence[GradingItem]) -> Messages:
+        payload = [
+            {"id": i, "question": item.question, "reference": item.reference or "", "answer": item.student_answer}
+            for i, item in enumerate(batch)
+        ]
+        return [
+            {"role": "system", "content": GRADING_SYSTEM_PROMPT},
+            {"role": "user", "content": json.dumps(payload, ensure_ascii=False)},
+        ]
+
+    @staticmethod
+    def _parse(content: str, size: int) -> Dict[int, Dict[str, Any]]:
+        """Verdicts by position in the batch; entries that don't parse are left out."""
+        data = json.loads(content)
+        entries = data.get("results") if isinstance(data, dict) else data
+        if entries is None and size == 1 and isinstance(data, dict) and "score" in data:
+            entries = [{**data, "id": 0}]
+        verdicts: Dict[int, Dict[str, Any]] = {}
+        for entry in entries or []:
+            try:
+                position = int(entry["id"])
+                verdict = {"score": _clamp_score(entry["score"]), "feedback": str(entry.get("feedback") or "")}
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 0 <= position < size:
+                verdicts[position] = verdict
+        return verdicts
+
+    async def _call(self, batch: Sequence[GradingItem]) -> Dict[int, Dict[str, Any]]:
+        self._stats["llm_calls"] += 1
+        try:
+            return self._parse(await self._complete(self._messages(batch)), len(batch))
+        except Exception as e:
+            logger.warning(f"[Grading] Batch of {len(batch)} failed: {e}")
+            return {}
+
+    async def _grade_batch(self, batch: List[GradingItem], slots: asyncio.Semaphore) -> List[Tuple[GradingItem, Optional[Dict[str, Any]]]]:
+        async with slots:
+            verdicts = await self._call(batch)
+            missing = [i for i in range(len(batch)) if i not in verdicts]
+            if len(batch) > 1:
+                for i in missing:
+                    self._stats["retries"] += 1
+                    single = await self._call([batch[i]])
+                    if 0 in single:
+                        verdicts[i] = single[0]
+        results = []
+        for i, item in enumerate(batch):
+            verdict = verdicts.get(i)
+            if verdict is not None:
+                self._verdicts.set(item.key, verdict)
+                self._stats["graded"] += 1
+            results.append((item, verdict))
+        return results
+
+    async def grade(self, items: Sequence[GradingItem]) -> AsyncIterator[Dict[str, Any]]:
+        """Yield ``{id, score, feedback, cached}`` (or ``{id, error}``) per item, in completion order."""
+        self._stats["items"] += len(items)
+        pending: Dict[Tuple[str, str], List[GradingItem]] = {}
+        for item in items:
+            key = item.key
+            verdict = self._verdicts.get(key)
+            if verdict is not None:
+                self._stats["cache_hits"] += 1
+                yield {"id": item.id, **verdict, "cached": True}
+            elif key in pending:
+                self._stats["deduped"] += 1
+                pending[key].append(item)
+            else:
+                pending[key] = [item]
+
+        unique = [group[0] for group in pending.values()]
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = [
+            asyncio.ensure_future(self._grade_batch(unique[start:start + self.batch_size], slots))
+            for start in range(0, len(unique), self.batch_size)
+        ]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                for graded, verdict in await finished:
+                    for item in pending[graded.key]:
+                        if verdict is None:
+                            self._stats["errors"] += 1
+                            yield {"id": item.id, "score": None, "feedback": "Error during AI grading.", "error": True}
+                        else:
+                            yield {"id": item.id, **verdict, "cached": False}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def clear(self) -> None:
+        self._verdicts.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        cache = self._verdicts.stats()
+        return {**self._stats, "batch_size": self.batch_size, "concurrency": self.concurrency,
+                "cached_verdicts": cache["size"], "cache_ttl": cache["ttl"]}
@@ -0,0 +1,145 @@
+"""
+Benchmark: concurrent-request throughput with blocking vs. offloaded DB access.
+
+Runs entirely in-process against a throwaway SQLite database. Each query is
+slowed down by --latency-ms to mimic the round-trip to the remote Supabase
+pooler. Two routes serve the same notification inbox query:
+
+  before  - the query runs inline on the event loop (how handlers used to work)
+  after   - the real /api/notifications/inbox route (awaits async_db_connection)
+
+Besides throughput, it samples event-loop lag with a 5 ms heartbeat; that lag is
+what the /ws/whiteboard websocket sees while requests are in flight.
+
+Usage:
+    python bench_async_db.py --requests 200 --concurrency 50 --latency-ms 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DB = os.path.join(tempfile.mkdtemp(prefix="cb_bench_"), "bench.db")
+os.environ["DATABASE_URL"] = BENCH_DB
+os.environ["USE_POSTGRES"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+from fastapi import Header  # noqa: E402
+
+import backend  # noqa: E402
+
+
+class SlowConnection:
+    """Delegates to a real connection but sleeps on every execute (network RTT)."""
+
+    def __init__(self, conn, latency_s):
+        self._conn = conn
+        self._latency_s = latency_s
+
+    def execute(self, *args, **kwargs):
+        time.sleep(self._latency_s)
+        return self._conn.execute(*args, **kwargs)
+
+    def cursor(self):
+        return SlowCursor(self._conn.cursor(), self._latency_s)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class SlowCursor(SlowConnection):
+    def cursor(self):
+        return self
+
+
+def seed(user_id: str, n_messages: int = 50):
+    conn = backend.get_db_connection()
+    conn.execute("INSERT OR IGNORE INTO schools (id, name) VALUES (1, 'Bench School')")
+    conn.execute("INSERT OR IGNORE INTO students (id, name, role, school_id) VALUES (?, 'Bench', 'Student', 1)", (user_id,))
+    for i in range(n_messages):
+        conn.execute(
+            "INSERT INTO messages (sender_id, receiver_id, subject, content, timestamp, is_read) VALUES (?, ?, ?, ?, ?, FALSE)",
+            (user_id, user_id, f"Subject {i}", "Body", f"2026-01-01T00:00:{i:02d}"),
+        )
+    conn.commit()
+    conn.close()
+
+
+async def inline_inbox(x_user_id: str = Header(..., alias="X-User-Id")):
+    # The pre-change shape of get_notifications: sync driver calls on the loop.
+    conn = backend.get_db_connection()
+    try:
+        rows = conn.cursor().execute(
+            "SELECT id, sender_id, subject, content, timestamp, is_read FROM messages WHERE receiver_id = ? ORDER BY timestamp DESC",
+            (x_user_id,),
+        ).fetchall()
+        return [{"id": r[0], "subject": r[2]} for r in rows]
+    finally:
+        conn.close()
+
+
+async def heartbeat(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - t0 - interval)
+
+
+async def run_case(client, path, user_id, total, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with sem:
+            t0 = time.perf_counter()
+            r = await client.get(path, headers={"X-User-Id": user_id})
+            r.raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+
+    stop, lags = asyncio.Event(), []
+    hb = asyncio.create_task(heartbeat(stop, lags))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(total)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await hb
+    latencies.sort()
+    return {
+        "rps": total / wall,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "max_loop_lag_ms": (max(lags) if lags else 0.0) * 1000,
+    }
+
+
+async def main(args):
+    backend.initialize_db()
+    user_id = "bench_user"
+    seed(user_id)
+
+    real_get_conn = backend.get_db_connection
+    latency_s = args.latency_ms / 1000.0
+    backend.get_db_connection = lambda: SlowConnection(real_get_conn(), latency_s)
+    backend.app.add_api_route("/bench/inline-inbox", inline_inbox, methods=["GET"])
+
+    transport = httpx.ASGITransport(app=backend.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        cases = [("before (inline)", "/bench/inline-inbox"), ("after (run_db)", "/api/notifications/inbox")]
+        print(f"{args.requests} requests, concurrency {args.concurrency}, simulated DB latency {args.latency_ms} ms, "
+              f"DB workers {backend.DB_EXECUTOR.max_workers}")
+        print(f"{'case':<18}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'max loop lag ms':>18}")
+        for label, path in cases:
+            res = await run_case(client, path, user_id, args.requests, args.concurrency)
+            print(f"{label:<18}{res['rps']:>10.1f}{res['p50_ms']:>10.1f}{res['p95_ms']:>10.1f}{res['max_loop_lag_ms']:>18.1f}")
+    backend.DB_EXECUTOR.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,141 @@
+"""
+Benchmark: AI chat endpoints with a blocking LLM client vs. the async gateway.
+
+Runs entirely offline: LLM_PROVIDER=stub makes every completion take
+--llm-latency-ms plus a token-rate delay instead of calling Groq. Three cases:
+
+  before  - a route that makes the completion with a blocking call, as the
+            synchronous Groq client used to
+  after   - the real /api/ai/grade-helper route (await LLM.complete)
+  stream  - the real /api/ai/grade-helper/.../stream route; reports time to the
+            first SSE event as well as to the end of the stream
+
+Event-loop lag is sampled with a 5 ms heartbeat, as in bench_async_db.py.
+Requests beyond LLM_MAX_CONCURRENCY queue inside the gateway.
+
+Usage:
+    python bench_llm_gateway.py --requests 100 --concurrency 50 --llm-latency-ms 300
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DB = os.path.join(tempfile.mkdtemp(prefix="cb_bench_"), "bench.db")
+os.environ["DATABASE_URL"] = BENCH_DB
+os.environ["USE_POSTGRES"] = "false"
+os.environ["LLM_PROVIDER"] = "stub"
+# Every case must reach the LLM: with the answer cache on, the later cases would
+# replay what the earlier ones cached instead of measuring the gateway.
+os.environ["AI_RESPONSE_CACHE_TTL"] = "0"
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    parser.add_argument("--max-concurrency", type=int, default=32, help="LLM_MAX_CONCURRENCY for the gateway")
+    return parser.parse_args()
+
+
+ARGS = _parse_args()
+os.environ["LLM_STUB_LATENCY_MS"] = str(ARGS.llm_latency_ms)
+os.environ["LLM_MAX_CONCURRENCY"] = str(ARGS.max_concurrency)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+
+import backend  # noqa: E402
+
+USER_ID = "bench_user"
+
+
+def seed():
+    conn = backend.get_db_connection()
+    conn.execute("INSERT OR IGNORE INTO schools (id, name) VALUES (1, 'Bench School')")
+    conn.execute("INSERT OR IGNORE INTO students (id, name, role, grade, school_id) VALUES (?, 'Bench', 'Student', 7, 1)", (USER_ID,))
+    conn.commit()
+    conn.close()
+
+
+async def blocking_grade_helper(student_id: str, request: backend.AIChatRequest):
+    # The pre-change shape: a synchronous client call inside the async handler.
+    messages = backend._grade_helper_messages(student_id, request.prompt)
+    time.sleep(ARGS.llm_latency_ms / 1000.0)
+    return {"reply": f"[blocking] {messages[-1]['content']}"}
+
+
+async def heartbeat(stop: asyncio.Event, lags: list, interval: float = 0.005):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - t0 - interval)
+
+
+async def run_case(client, path, total, concurrency, stream=False):
+    sem = asyncio.Semaphore(concurrency)
+    latencies, first_bytes = [], []
+
+    async def one(i):
+        async with sem:
+            t0 = time.perf_counter()
+            body = {"prompt": f"Explain fractions, question {i}"}
+            if stream:
+                first = None
+                async with client.stream("POST", path, json=body) as r:
+                    r.raise_for_status()
+                    async for line in r.aiter_lines():
+                        if first is None and line.startswith("data:"):
+                            first = time.perf_counter() - t0
+                first_bytes.append(first)
+            else:
+                r = await client.post(path, json=body)
+                r.raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+
+    stop, lags = asyncio.Event(), []
+    hb = asyncio.create_task(heartbeat(stop, lags))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    wall = time.perf_counter() - t0
+    stop.set()
+    await hb
+    latencies.sort()
+    first_bytes.sort()
+    return {
+        "rps": total / wall,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "first_p50_ms": first_bytes[len(first_bytes) // 2] * 1000 if first_bytes else None,
+        "max_loop_lag_ms": (max(lags) if lags else 0.0) * 1000,
+    }
+
+
+async def main(args):
+    backend.initialize_db()
+    seed()
+    backend.app.add_api_route("/bench/blocking-grade-helper/{student_id}", blocking_grade_helper, methods=["POST"])
+
+    transport = httpx.ASGITransport(app=backend.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        cases = [
+            ("before (blocking)", f"/bench/blocking-grade-helper/{USER_ID}", False),
+            ("after (gateway)", f"/api/ai/grade-helper/{USER_ID}", False),
+            ("after (SSE stream)", f"/api/ai/grade-helper/{USER_ID}/stream", True),
+        ]
+        print(f"{args.requests} requests, concurrency {args.concurrency}, stub LLM latency {args.llm_latency_ms} ms, "
+              f"gateway limit {backend.LLM.max_concurrency}")
+        print(f"{'case':<20}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'first ms':>10}{'max loop lag ms':>18}")
+        for label, path, stream in cases:
+            res = await run_case(client, path, args.requests, args.concurrency, stream)
+            first = f"{res['first_p50_ms']:.1f}" if res["first_p50_ms"] is not None else "-"
+            print(f"{label:<20}{res['rps']:>8.1f}{res['p50_ms']:>10.1f}{res['p95_ms']:>10.1f}{first:>10}{res['max_loop_lag_ms']:>18.1f}")
+    print("gateway stats:", {k: v for k, v in backend.LLM.stats().items() if k != "providers"})
+    backend.DB_EXECUTOR.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(ARGS))
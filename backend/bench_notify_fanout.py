@@ -0,0 +1,143 @@
+"""
+Benchmark: exam-schedule notification fan-out for a whole grade.
+
+Seeds a throwaway SQLite database with --students students in one grade, each
+with two guardian rows of which one maps to a parent account, and a teacher
+on the timetable. Every statement is slowed down by --latency-ms to mimic the
+round-trip to the remote Supabase pooler. Two implementations notify the grade:
+
+  before  - the per-student / per-guardian loop _notify_exam_schedule used to run,
+            with one messages INSERT per parent
+  after   - the real _notify_exam_schedule (one recipient query, one multi-row
+            outbox insert); the dispatcher's batched delivery is timed separately
+
+Usage:
+    python bench_notify_fanout.py --students 1000 --latency-ms 2
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DB = os.path.join(tempfile.mkdtemp(prefix="cb_bench_"), "bench.db")
+os.environ["DATABASE_URL"] = BENCH_DB
+os.environ["USE_POSTGRES"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import backend  # noqa: E402
+
+
+class CountingConnection:
+    """Delegates to a real connection; sleeps and counts on every execute."""
+
+    def __init__(self, conn, latency_s, counter):
+        self._conn = conn
+        self._latency_s = latency_s
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        time.sleep(self._latency_s)
+        return self._conn.execute(*args, **kwargs)
+
+    def cursor(self):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+SCHEDULE = {
+    "school_id": 1, "grade_level": 7, "section_id": None, "title": "Midterm", "subject": "Math",
+    "exam_date": "2026-11-02", "start_time": "09:00", "end_time": "11:00", "venue": "Hall A",
+}
+
+
+def seed(n_students: int):
+    conn = backend.get_db_connection()
+    conn.execute("INSERT OR IGNORE INTO schools (id, name) VALUES (1, 'Bench School')")
+    conn.execute("INSERT OR IGNORE INTO students (id, name, role, school_id) VALUES ('bench_teacher', 'Teacher', 'Teacher', 1)")
+    conn.execute(
+        "INSERT INTO timetables (class_grade, section, subject, teacher_id) VALUES (7, 'A', 'Math', 'bench_teacher')"
+    )
+    for i in range(n_students):
+        sid, pid = f"bench_s{i}", f"parent{i}@bench.test"
+        conn.execute("INSERT INTO students (id, name, role, school_id, grade) VALUES (?, ?, 'Student', 1, 7)", (sid, f"Student {i}"))
+        conn.execute("INSERT INTO students (id, name, role, school_id) VALUES (?, ?, 'Parent', 1)", (pid, f"Parent {i}"))
+        conn.execute("INSERT INTO guardians (student_id, name, email) VALUES (?, ?, ?)", (sid, f"Parent {i}", pid))
+        conn.execute("INSERT INTO guardians (student_id, name, email) VALUES (?, ?, ?)", (sid, "Other", f"nobody{i}@bench.test"))
+    conn.commit()
+    conn.close()
+
+
+def legacy_notify_exam_schedule(conn, schedule, sender_id):
+    # The pre-change shape: N+1 guardian/parent lookups and one INSERT per recipient.
+    def send(ids, content):
+        ts = datetime.now().isoformat()
+        for rid in sorted(set(ids)):
+            conn.execute(
+                "INSERT INTO messages (sender_id, receiver_id, subject, content, timestamp, is_read) VALUES (?, ?, ?, ?, ?, FALSE)",
+                (sender_id, rid, "Exam Schedule Update", content, ts),
+            )
+        return len(set(ids))
+
+    counts = {"students": 0, "parents": 0, "teachers": 0}
+    students = conn.execute(
+        "SELECT id, name FROM students WHERE role = 'Student' AND school_id = ? AND grade = ?",
+        (schedule["school_id"], schedule["grade_level"]),
+    ).fetchall()
+    counts["students"] = send([s["id"] for s in students], backend._build_exam_message(schedule, "student"))
+    for s in students:
+        for g in conn.execute("SELECT email, name FROM guardians WHERE student_id = ?", (s["id"],)).fetchall():
+            parent = conn.execute(
+                "SELECT id FROM students WHERE id = ? AND role IN ('Parent', 'Parent_Guardian') AND school_id = ?",
+                (g["email"], schedule["school_id"]),
+            ).fetchone()
+            if parent:
+                counts["parents"] += send([parent["id"]], backend._build_exam_message(schedule, "parent", student_name=s["name"]))
+    t_rows = conn.execute(
+        """SELECT DISTINCT tt.teacher_id FROM timetables tt JOIN students s ON s.id = tt.teacher_id
+           WHERE tt.class_grade = ? AND tt.subject = ? AND s.school_id = ? AND s.role = 'Teacher'""",
+        (schedule["grade_level"], schedule["subject"], schedule["school_id"]),
+    ).fetchall()
+    counts["teachers"] = send([r["teacher_id"] for r in t_rows], backend._build_exam_message(schedule, "teacher"))
+    return counts
+
+
+def run(label, fn, latency_s):
+    counter = [0]
+    conn = CountingConnection(backend.get_db_connection(), latency_s, counter)
+    t0 = time.perf_counter()
+    counts = fn(conn, SCHEDULE, "bench_teacher")
+    conn.commit()
+    wall = time.perf_counter() - t0
+    conn.close()
+    print(f"{label:<22}{counter[0]:>12}{wall * 1000:>12.0f}   {counts}")
+
+
+def main(args):
+    backend.initialize_db()
+    seed(args.students)
+    latency_s = args.latency_ms / 1000.0
+    print(f"{args.students} students, simulated DB latency {args.latency_ms} ms")
+    print(f"{'case':<22}{'statements':>12}{'ms':>12}   recipients")
+    run("before (per guardian)", legacy_notify_exam_schedule, latency_s)
+    run("after (set-based)", backend._notify_exam_schedule, latency_s)
+
+    # Background delivery of what "after" queued, in dispatcher batches.
+    real_get_conn = backend.get_db_connection
+    counter = [0]
+    backend.get_db_connection = lambda: CountingConnection(real_get_conn(), latency_s, counter)
+    t0 = time.perf_counter()
+    while backend.OUTBOX_DISPATCHER.dispatch_once():
+        pass
+    print(f"{'  outbox delivery':<22}{counter[0]:>12}{(time.perf_counter() - t0) * 1000:>12.0f}   (off the request path)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--students", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    main(parser.parse_args())
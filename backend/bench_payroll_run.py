@@ -0,0 +1,140 @@
+"""
+Benchmark: payroll run generation for a large staff.
+
+Seeds a throwaway SQLite database with --employees active employees, each with
+an active salary structure, and generates one payroll run per implementation.
+Every statement is slowed down by --latency-ms to mimic the round-trip to the
+remote Supabase pooler:
+
+  before  - the loop generate_payroll_run used to run: one payroll_lines
+            INSERT per salary structure, totals summed in Python
+  after   - _generate_payroll_lines: one INSERT ... SELECT for the lines and
+            one UPDATE for the run totals
+
+Both runs must end with the same totals.
+
+Usage:
+    python bench_payroll_run.py --employees 5000 --latency-ms 2
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DB = os.path.join(tempfile.mkdtemp(prefix="cb_bench_"), "bench.db")
+os.environ["DATABASE_URL"] = BENCH_DB
+os.environ["USE_POSTGRES"] = "false"
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import backend  # noqa: E402
+
+
+class CountingConnection:
+    """Delegates to a real connection; sleeps and counts on every execute."""
+
+    def __init__(self, conn, latency_s, counter):
+        self._conn = conn
+        self._latency_s = latency_s
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter[0] += 1
+        time.sleep(self._latency_s)
+        return self._conn.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def seed(n_employees: int):
+    rng = random.Random(7)
+    now = datetime.now().isoformat()
+    conn = backend.get_db_connection()
+    conn.execute("INSERT OR IGNORE INTO schools (id, name) VALUES (1, 'Bench School')")
+    conn.executemany(
+        "INSERT INTO employees (id, school_id, employee_code, name, status, created_at, updated_at) VALUES (?, 1, ?, ?, 'Active', ?, ?)",
+        [(i, f"EMP-{i:05d}", f"Employee {i}", now, now) for i in range(1, n_employees + 1)],
+    )
+    conn.executemany(
+        "INSERT INTO salary_structures (school_id, employee_id, effective_from, basic_salary, allowances, deductions, tax_amount, status, created_at, updated_at) "
+        "VALUES (1, ?, '2026-01-01', ?, ?, ?, ?, 'Active', ?, ?)",
+        [(i, round(rng.uniform(1500, 6000), 2), round(rng.uniform(0, 800), 2), round(rng.uniform(0, 300), 2),
+          round(rng.uniform(100, 900), 2), now, now) for i in range(1, n_employees + 1)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def new_run(conn, run_code: str) -> int:
+    now = datetime.now().isoformat()
+    cur = conn.execute(
+        "INSERT INTO payroll_runs (school_id, run_code, period_label, period_start, period_end, status, created_at, updated_at) "
+        "VALUES (1, ?, '2026-10', '2026-10-01', '2026-10-31', 'Draft', ?, ?)",
+        (run_code, now, now),
+    )
+    return cur.lastrowid
+
+
+def legacy_generate(conn, school_id, run_id, now):
+    # The pre-change shape: one INSERT per salary structure, totals summed in Python.
+    structs = conn.execute(
+        "SELECT ss.*, e.id AS employee_id FROM salary_structures ss JOIN employees e ON e.id = ss.employee_id "
+        "WHERE ss.school_id = ? AND ss.status = 'Active' AND e.status = 'Active'",
+        (school_id,),
+    ).fetchall()
+    gross_total = ded_total = tax_total = net_total = 0.0
+    for s in structs:
+        basic = float(s["basic_salary"] or 0); allow = float(s["allowances"] or 0); ded = float(s["deductions"] or 0); tax = float(s["tax_amount"] or 0)
+        net = round((basic + allow) - (ded + tax), 2); gross = round(basic + allow, 2)
+        conn.execute(
+            "INSERT INTO payroll_lines (payroll_run_id, employee_id, basic_salary, allowances, deductions, tax_amount, net_pay, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, 'Generated', ?, ?)",
+            (run_id, s["employee_id"], basic, allow, ded, tax, net, now, now),
+        )
+        gross_total += gross; ded_total += ded; tax_total += tax; net_total += net
+    conn.execute(
+        "UPDATE payroll_runs SET total_gross = ?, total_deductions = ?, total_tax = ?, total_net = ?, updated_at = ? WHERE id = ?",
+        (round(gross_total, 2), round(ded_total, 2), round(tax_total, 2), round(net_total, 2), now, run_id),
+    )
+    return len(structs)
+
+
+def run(label, run_code, fn, latency_s):
+    counter = [0]
+    conn = CountingConnection(backend.get_db_connection(), latency_s, counter)
+    run_id = new_run(conn, run_code)
+    counter[0] = 0
+    t0 = time.perf_counter()
+    lines = fn(conn, 1, run_id, datetime.now().isoformat())
+    conn.commit()
+    wall = time.perf_counter() - t0
+    totals = conn.execute(
+        "SELECT total_gross, total_deductions, total_tax, total_net FROM payroll_runs WHERE id = ?", (run_id,)
+    ).fetchone()
+    conn.close()
+    print(f"{label:<22}{lines:>8}{counter[0]:>12}{wall * 1000:>12.0f}   {tuple(totals)}")
+    return tuple(totals)
+
+
+def main(args):
+    backend.initialize_db()
+    seed(args.employees)
+    latency_s = args.latency_ms / 1000.0
+    print(f"{args.employees} employees, simulated DB latency {args.latency_ms} ms")
+    print(f"{'case':<22}{'lines':>8}{'statements':>12}{'ms':>12}   totals (gross, deductions, tax, net)")
+    before = run("before (per line)", "PR-BEFORE", legacy_generate, latency_s)
+    after = run("after (set-based)", "PR-AFTER", backend._generate_payroll_lines, latency_s)
+    if before != after:
+        print("Totals differ!")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--employees", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=2.0)
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,220 @@
+"""Chunked BM25 retrieval over LMS module text.
+
+``chat_with_course`` used to paste every module's ``searchable_text`` into the
+system prompt (cut off at 20,000 characters). Instead:
+
+* ``add_module`` splits the text into overlapping word windows (``chunk_text``)
+  and stores them in ``lms_module_chunks``;
+* ``CourseRetriever`` keeps one in-memory ``BM25Index`` per course, built from
+  those rows on first use and then only extended: ``add_module`` calls
+  ``refresh`` and each search first picks up rows with a higher id (e.g. saved
+  by another worker) with one indexed query;
+* a question is answered from the ``top_k`` best-scoring chunks only.
+
+Indexes for courses not searched recently are dropped once ``max_courses``
+is reached.
+"""
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+CHUNK_COLUMNS = ("module_id", "course_id", "chunk_index", "title", "text")
+
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "been", "being", "am", "of", "to", "in", "on",
+    "at", "by", "for", "with", "from", "as", "and", "or", "but", "not", "no", "if", "then", "than",
+    "so", "it", "its", "this", "that", "these", "those", "there", "here", "what", "which", "who",
+    "whom", "how", "why", "when", "where", "do", "does", "did", "can", "could", "would", "should",
+    "will", "shall", "may", "might", "must", "i", "me", "my", "we", "our", "you", "your", "he", "she",
+    "they", "them", "their", "his", "her", "about", "into", "also", "just", "tell", "explain", "please",
+}
+
+
+def chunks_ddl(pk_def: str) -> List[str]:
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS lms_module_chunks (
+            id {pk_def},
+            module_id INTEGER NOT NULL,
+            course_id INTEGER NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            title TEXT,
+            text TEXT NOT NULL,
+            FOREIGN KEY (module_id) REFERENCES lms_course_modules(id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_lms_module_chunks_course_id ON lms_module_chunks (course_id, id)",
+    ]
+
+
+def _stem(word: str) -> str:
+    for suffix in ("ing", "ed", "es", "s"):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix) and not word.endswith("ss"):
+            return word[:-len(suffix)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return [_stem(w) for w in re.findall(r"\w+", text) if w not in _STOPWORDS]
+
+
+def chunk_text(text: str, max_words: int = 180, overlap: int = 30) -> List[str]:
+    """Split ``text`` into windows of ``max_words`` words, each sharing ``overlap`` words with the previous one."""
+    words = (text or "").split()
+    if not words:
+        return []
+    step = max(1, max_words - overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + max_words]))
+        if start + max_words >= len(words):
+            break
+    return chunks
+
+
+def module_chunk_rows(module_id: int, course_id: int, title: str, text: str, max_words: int = 180, overlap: int = 30) -> List[tuple]:
+    """``lms_module_chunks`` rows (in ``CHUNK_COLUMNS`` order) for one module."""
+    return [
+        (module_id, course_id, i, title, chunk)
+        for i, chunk in enumerate(chunk_text(text, max_words, overlap))
+    ]
+
+
+class BM25Index:
+    """Okapi BM25 over an append-only set of documents."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: List[Dict[str, Any]] = []
+        self._postings: Dict[str, List[tuple]] = {}  # term -> [(doc position, term frequency)]
+        self._lengths: List[int] = []
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def add(self, doc: Dict[str, Any], text: str) -> None:
+        terms = Counter(tokenize(text))
+        position = len(self._docs)
+        self._docs.append(doc)
+        length = sum(terms.values())
+        self._lengths.append(length)
+        self._total_length += length
+        for term, tf in terms.items():
+            self._postings.setdefault(term, []).append((position, tf))
+
+    def search(self, query: str, k: int) -> List[Dict[str, Any]]:
+        """The ``k`` best-matching documents, each with a ``score``; empty if no query term occurs."""
+        n = len(self._docs)
+        if not n:
+            return []
+        avg_length = self._total_length / n or 1.0
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[position] / avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [{**self._docs[position], "score": round(score, 4)} for position, score in best]
+
+    def first(self, k: int) -> List[Dict[str, Any]]:
+        return self._docs[:k]
+
+
+class _CourseIndex:
+    def __init__(self, k1: float, b: float):
+        self.bm25 = BM25Index(k1, b)
+        self.last_id = 0
+        self.lock = threading.Lock()
+
+    def add_rows(self, rows: Iterable[Any]) -> None:
+        for row in rows:
+            if row["id"] <= self.last_id:
+                continue
+            self.bm25.add(
+                {"id": row["id"], "module_id": row["module_id"], "title": row["title"], "text": row["text"]},
+                f"{row['title'] or ''} {row['text']}",
+            )
+            self.last_id = row["id"]
+
+
+class CourseRetriever:
+    """Per-course BM25 indexes over ``lms_module_chunks``.
+
+    ``load_chunks(course_id, after_id)`` returns the course's chunk rows with
+    ``id > after_id`` in id order, as mappings with the ``lms_module_chunks``
+    columns.
+    """
+
+    def __init__(
+        self,
+        load_chunks: Callable[[int, int], Sequence[Any]],
+        top_k: int = 6,
+        max_courses: int = 256,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self._load_chunks = load_chunks
+        self.top_k = top_k
+        self.max_courses = max_courses
+        self.k1 = k1
+        self.b = b
+        self._indexes: "OrderedDict[int, _CourseIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"searches": 0, "builds": 0, "chunks_loaded": 0, "empty_matches": 0}
+
+    def _index(self, course_id: int) -> _CourseIndex:
+        with self._lock:
+            index = self._indexes.get(course_id)
+            if index is None:
+                index = self._indexes[course_id] = _CourseIndex(self.k1, self.b)
+                self._stats["builds"] += 1
+            self._indexes.move_to_end(course_id)
+            while len(self._indexes) > self.max_courses:
+                self._indexes.popitem(last=False)
+            return index
+
+    def _catch_up(self, course_id: int, index: _CourseIndex) -> None:
+        rows = self._load_chunks(course_id, index.last_id)
+        self._stats["chunks_loaded"] += len(rows)
+        index.add_rows(rows)
+
+    def refresh(self, course_id: int) -> None:
+        """Index newly stored chunks now; a no-op if the course is not loaded yet."""
+        with self._lock:
+            index = self._indexes.get(course_id)
+        if index is not None:
+            with index.lock:
+                self._catch_up(course_id, index)
+
+    def search(self, course_id: int, query: str, k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Top-``k`` chunks for ``query``; the course's first chunks if nothing matches."""
+        k = k or self.top_k
+        index = self._index(course_id)
+        with index.lock:
+            self._catch_up(course_id, index)
+            self._stats["searches"] += 1
+            hits = index.bm25.search(query, k)
+            if not hits:
+                self._stats["empty_matches"] += 1
+                hits = index.bm25.first(k)
+            return hits
+
+    def clear(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            courses = len(self._indexes)
+            chunks = sum(len(index.bm25) for index in self._indexes.values())
+        return {**self._stats, "courses": courses, "chunks": chunks, "max_courses": self.max_courses, "top_k": self.top_k}
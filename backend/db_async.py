@@ -0,0 +1,92 @@
+"""Awaitable access to the blocking sqlite3/psycopg2 drivers.
+
+All route handlers are ``async def`` and run on the event loop, so a blocking
+query there stalls every other request on the worker (including websockets).
+This module moves the blocking work onto a bounded thread pool:
+
+    rows = await run_db(some_sync_function, arg)
+
+    async with async_db_connection() as conn:
+        rows = await conn.fetchall("SELECT ...", (x,))
+        await conn.execute("UPDATE ...", (y,))
+        await conn.commit()
+
+The pool is sized to the DB connection pool so threads never queue up behind
+a connection checkout they cannot get.
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DBExecutor:
+    """Dedicated worker threads for blocking database calls."""
+
+    def __init__(self, max_workers: int = 10, thread_name_prefix: str = "db"):
+        self.max_workers = max_workers
+        self._thread_name_prefix = thread_name_prefix
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self._thread_name_prefix)
+        return self._executor
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+class AsyncConnection:
+    """Awaitable facade over a sync connection from get_db_connection().
+
+    Each method runs one complete driver operation (execute + fetch) on the DB
+    executor. The connection is only ever used by one coroutine at a time, so
+    it is safe for consecutive calls to land on different worker threads.
+    """
+
+    def __init__(self, conn, executor: DBExecutor):
+        self.conn = conn
+        self._executor = executor
+
+    @staticmethod
+    def _fetch(conn, sql, params, mode):
+        cur = conn.cursor()
+        cur.execute(sql, params or ())
+        if mode == "one":
+            return cur.fetchone()
+        if mode == "all":
+            return cur.fetchall()
+        return cur
+
+    async def execute(self, sql: str, params=None):
+        """Run a statement; returns the cursor (rowcount / lastrowid)."""
+        return await self._executor.run(self._fetch, self.conn, sql, params, None)
+
+    async def fetchone(self, sql: str, params=None):
+        return await self._executor.run(self._fetch, self.conn, sql, params, "one")
+
+    async def fetchall(self, sql: str, params=None) -> List[Any]:
+        return await self._executor.run(self._fetch, self.conn, sql, params, "all")
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run ``fn(conn, *args)`` on a worker thread for multi-statement blocks."""
+        return await self._executor.run(fn, self.conn, *args, **kwargs)
+
+    async def commit(self) -> None:
+        await self._executor.run(self.conn.commit)
+
+    async def rollback(self) -> None:
+        await self._executor.run(self.conn.rollback)
+
+    async def close(self) -> None:
+        await self._executor.run(self.conn.close)
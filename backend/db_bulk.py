@@ -0,0 +1,51 @@
+"""Set-based write helpers shared by the bulk endpoints.
+
+``insert_rows`` turns N single-row INSERTs into ceil(N / chunk_size)
+multi-row ``INSERT ... VALUES (...), (...)`` statements. It is written with
+``?`` placeholders, so it works for both sqlite3 and the Postgres wrapper.
+Chunking keeps each statement under SQLite's bound-parameter limit.
+"""
+from typing import Any, Iterator, List, Sequence, TypeVar
+
+T = TypeVar("T")
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def chunked(items: Sequence[T], size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Sequence[T]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def sql_placeholders(count: int) -> str:
+    """``?, ?, ?`` for an ``IN (...)`` list of ``count`` values."""
+    return ", ".join("?" for _ in range(count))
+
+
+def insert_rows(
+    cursor,
+    table: str,
+    columns: Sequence[str],
+    rows: Sequence[Sequence[Any]],
+    suffix: str = "",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> int:
+    """Insert ``rows`` with one statement per chunk. Returns the number of rows sent.
+
+    ``suffix`` is appended verbatim to every statement, e.g. an
+    ``ON CONFLICT (...) DO UPDATE SET ...`` clause.
+    """
+    if not rows:
+        return 0
+    row_sql = f"({sql_placeholders(len(columns))})"
+    sent = 0
+    for chunk in chunked(rows, chunk_size):
+        params: List[Any] = []
+        for row in chunk:
+            params.extend(row)
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([row_sql] * len(chunk))}"
+        if suffix:
+            sql = f"{sql} {suffix}"
+        cursor.execute(sql, params)
+        sent += len(chunk)
+    return sent
@@ -0,0 +1,170 @@
+"""Declarative index catalogue for the hot query paths.
+
+Every entry names the table/columns it covers and the endpoints that rely on
+it, so the catalogue doubles as documentation. ``ensure_indexes`` creates the
+whole set idempotently (``CREATE INDEX IF NOT EXISTS`` works on both SQLite
+and Postgres, including the expression indexes on LOWER(...)). Schema
+migrations do not use it: a new index is added to the catalogue and created by
+its own migration via ``index_by_name(name).create_sql()``.
+
+Print the endpoint report with:
+    python db_indexes.py
+"""
+import logging
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    name: str
+    table: str
+    columns: Tuple[str, ...]  # plain columns or expressions such as "LOWER(email)"
+    serves: Tuple[str, ...]   # endpoints / helpers whose lookups use this index
+    unique: bool = False
+
+    def create_sql(self) -> str:
+        kind = "UNIQUE INDEX" if self.unique else "INDEX"
+        return f"CREATE {kind} IF NOT EXISTS {self.name} ON {self.table} ({', '.join(self.columns)})"
+
+
+INDEX_CATALOGUE: List[IndexSpec] = [
+    # --- Identity / login ---
+    IndexSpec("ix_students_lower_id", "students", ("LOWER(id)",), (
+        "POST /api/auth/login", "POST /api/auth/register", "POST /api/attendance/bulk",
+        "root admin student/school management",
+    )),
+    IndexSpec("ix_students_school_role_grade", "students", ("school_id", "role", "grade"), (
+        "GET /api/teacher/overview", "_get_school_broadcast_recipients", "_notify_exam_schedule",
+        "GET /api/attendance/class/{grade}", "AI teacher context (student counts)",
+    )),
+    IndexSpec("ix_auth_logs_user_event", "auth_logs", ("user_id", "event_type"), (
+        "POST /api/auth/logout (update_user_logout)", "GET /api/admin/audit-logs",
+    )),
+    # user_roles(user_id) lookups in verify_permission are already served by the
+    # PRIMARY KEY (user_id, role_id); only the reverse direction needs an index.
+    IndexSpec("ix_user_roles_role", "user_roles", ("role_id",), (
+        "DELETE /api/admin/roles/{role_id} (ON DELETE CASCADE)", "POST /api/auth/login (role permissions join)",
+    )),
+
+    # --- Guardians / parents ---
+    IndexSpec("ix_guardians_student", "guardians", ("student_id",), (
+        "GET /api/students/{student_id}/guardians", "POST /api/attendance/bulk",
+        "_notify_exam_schedule", "_get_school_broadcast_recipients",
+    )),
+    IndexSpec("ix_guardians_email", "guardians", ("email",), (
+        "GET /api/finance/fees/child", "_get_school_broadcast_recipients (p.id = g.email)",
+    )),
+    IndexSpec("ix_guardians_lower_email", "guardians", ("LOWER(email)",), (
+        "POST /api/auth/login (parent child lookup)", "POST /api/auth/verify-2fa",
+        "GET /api/attendance/student/my", "GET /api/timetable/student/my (parent view)",
+    )),
+
+    # --- Messaging ---
+    IndexSpec("ix_messages_receiver_ts", "messages", ("receiver_id", "timestamp"), (
+        "GET /api/notifications/inbox", "PUT /api/notifications/{msg_id}/read",
+        "GET /api/communication/messages",
+    )),
+    IndexSpec("ix_messages_sender", "messages", ("sender_id",), (
+        "GET /api/communication/messages (sent side of the OR)",
+    )),
+
+    # --- Learning activity ---
+    IndexSpec("ix_activities_student_date", "activities", ("student_id", "date"), (
+        "GET /api/students/{student_id}/data", "get_recommendation", "POST /api/ai/chat/{student_id}",
+        "GET /api/teacher/overview",
+    )),
+    # Also the conflict target of the bulk attendance upsert (schema migration 4).
+    IndexSpec("ux_student_attendance_student_date", "student_attendance", ("student_id", "date"), (
+        "POST /api/attendance/bulk", "GET /api/attendance/student/my", "GET /api/attendance/class/{grade}",
+    ), unique=True),
+    IndexSpec("ix_quiz_attempts_student_quiz", "quiz_attempts", ("student_id", "quiz_id"), (
+        "GET /api/students/{student_id}/quiz-results", "POST /api/quizzes/{quiz_id}/submit",
+    )),
+    IndexSpec("ix_quiz_attempts_quiz", "quiz_attempts", ("quiz_id",), (
+        "GET /api/quizzes/{quiz_id}/results",
+    )),
+    IndexSpec("ix_student_marks_student", "student_marks", ("student_id", "exam_name"), (
+        "GET /api/progress-card/{student_id}", "POST /api/progress/marks/bulk",
+    )),
+    IndexSpec("ix_group_members_student", "group_members", ("student_id",), (
+        "GET /api/students/{student_id}/groups", "GET /api/students/{student_id}/assignments", "quiz targeting subquery",
+    )),
+    IndexSpec("ix_lms_sections_course", "lms_course_sections", ("course_id",), (
+        "GET /api/lms/courses/{course_id}/full", "POST /api/ai/chat/course/{course_id}",
+    )),
+    IndexSpec("ix_lms_modules_section", "lms_course_modules", ("section_id",), (
+        "GET /api/lms/courses/{course_id}/full", "POST /api/ai/chat/course/{course_id}",
+    )),
+    IndexSpec("ix_resources_school_uploaded", "resources", ("school_id", "uploaded_at"), (
+        "GET /api/resources", "POST /api/ai/chat/{student_id} (resource context)",
+    )),
+
+    # --- General ledger ---
+    IndexSpec("ix_journal_lines_entry", "journal_lines", ("journal_entry_id",), (
+        "POST /api/finance/gl/journals/{journal_id}/post", "POST /api/finance/gl/journals/{journal_id}/reverse",
+        "GL trial balance / P&L / balance sheet joins",
+    )),
+    IndexSpec("ix_journal_lines_account", "journal_lines", ("account_id",), (
+        "GET /api/finance/gl/reports/trial-balance", "GET /api/finance/gl/reports/profit-loss",
+        "GET /api/finance/gl/reports/balance-sheet",
+    )),
+    IndexSpec("ix_journal_entries_school_status_date", "journal_entries", ("school_id", "status", "entry_date"), (
+        "GL reports (posted entries in date range)", "GET /api/finance/reconciliation/check",
+    )),
+
+    # --- Fixed assets ---
+    IndexSpec("ix_depreciation_schedule_period", "depreciation_schedule", ("school_id", "period_label", "asset_id"), (
+        "POST /api/finance/assets/depreciation/run-period (assets already charged for the period)",
+    )),
+
+    # --- Payroll ---
+    IndexSpec("ix_payroll_lines_run_employee", "payroll_lines", ("payroll_run_id", "employee_id"), (
+        "POST /api/finance/payroll/runs/generate (run totals)", "GET /api/finance/payroll/payslip/{employee_id}",
+    )),
+    IndexSpec("ix_salary_structures_school_status", "salary_structures", ("school_id", "status"), (
+        "POST /api/finance/payroll/runs/generate",
+    )),
+]
+
+
+def index_by_name(name: str, specs: Sequence[IndexSpec] = INDEX_CATALOGUE) -> IndexSpec:
+    for spec in specs:
+        if spec.name == name:
+            return spec
+    raise KeyError(name)
+
+
+def ensure_indexes(conn, specs: Sequence[IndexSpec] = INDEX_CATALOGUE) -> Dict[str, str]:
+    """Create every index in ``specs`` if missing. Returns {index_name: "ok" | error}.
+
+    Each statement is committed on its own so one failure (e.g. a table that
+    does not exist yet on an old database) does not abort the rest.
+    """
+    results: Dict[str, str] = {}
+    for spec in specs:
+        try:
+            conn.execute(spec.create_sql())
+            conn.commit()
+            results[spec.name] = "ok"
+        except Exception as e:
+            conn.rollback()
+            results[spec.name] = str(e)
+            logger.warning(f"Index {spec.name} on {spec.table} not created: {e}")
+    return results
+
+
+def index_report(specs: Sequence[IndexSpec] = INDEX_CATALOGUE) -> str:
+    """Markdown table: index -> table/columns -> endpoints served."""
+    lines = ["| Index | Table (columns) | Serves |", "| --- | --- | --- |"]
+    for spec in specs:
+        cols = ", ".join(spec.columns)
+        unique = " UNIQUE" if spec.unique else ""
+        lines.append(f"| `{spec.name}`{unique} | `{spec.table}({cols})` | {'<br>'.join(spec.serves)} |")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    print(index_report())
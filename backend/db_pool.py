@@ -0,0 +1,301 @@
+"""Process-wide database connection pool used by get_db_connection().
+
+The pool is driver-agnostic: it is given a ``connect`` callable that returns a
+raw DB-API connection, and it hands those connections out and takes them back.
+Connections are health-checked on checkout, transactions are reset on check-in
+and broken connections are discarded and replaced transparently.
+"""
+import logging
+import socket
+from collections import deque
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(RuntimeError):
+    """Raised when no connection becomes available within the checkout timeout."""
+
+
+# --- DNS CACHE ---
+# libpq would otherwise resolve the pooler hostname on every connect; we pin an
+# IPv4 address (Render cannot reach Supabase over IPv6) and refresh it on a TTL.
+_DNS_CACHE: Dict[Tuple[str, int], Tuple[str, float]] = {}
+_DNS_LOCK = threading.Lock()
+
+
+def resolve_ipv4(hostname: str, port: int = 5432, ttl: float = 300.0) -> Optional[str]:
+    """Resolve ``hostname`` to an IPv4 address, caching the answer for ``ttl`` seconds."""
+    if not hostname:
+        return None
+    key = (hostname, port)
+    now = time.monotonic()
+    with _DNS_LOCK:
+        cached = _DNS_CACHE.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+    try:
+        info = socket.getaddrinfo(hostname, port, family=socket.AF_INET, proto=socket.IPPROTO_TCP)
+    except Exception as e:
+        logger.warning(f"Failed to resolve IPv4 for {hostname}: {e}")
+        # Keep serving a stale answer rather than failing the connect outright.
+        return cached[0] if cached else None
+    if not info:
+        return None
+    ip_address = info[0][4][0]
+    with _DNS_LOCK:
+        _DNS_CACHE[key] = (ip_address, now + ttl)
+    return ip_address
+
+
+def clear_dns_cache() -> None:
+    with _DNS_LOCK:
+        _DNS_CACHE.clear()
+
+
+def default_is_alive(raw_conn) -> bool:
+    """Cheap liveness probe: the driver flag plus a round-trip ``SELECT 1``."""
+    if getattr(raw_conn, "closed", 0):
+        return False
+    cur = raw_conn.cursor()
+    try:
+        cur.execute("SELECT 1")
+        cur.fetchone()
+    finally:
+        cur.close()
+    # End the implicit transaction the probe opened.
+    raw_conn.rollback()
+    return True
+
+
+def default_reset(raw_conn) -> None:
+    """Discard any uncommitted work so the next borrower starts clean."""
+    raw_conn.rollback()
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of DB-API connections.
+
+    ``minconn`` connections are opened eagerly, up to ``maxconn`` are opened on
+    demand. Idle connections older than ``healthcheck_after`` seconds are probed
+    with ``is_alive`` before being handed out, and connections older than
+    ``max_lifetime`` seconds are recycled.
+
+    Connections leaked by a dropped wrapper come back through ``return_leaked``,
+    which only queues them: it runs from a GC finalizer, possibly on a thread
+    that already holds the pool lock. The queue is drained on the next
+    checkout or check-in.
+    """
+
+    # How often a checkout blocked on a full pool looks for leaked connections,
+    # which are queued without waking it.
+    leak_poll_interval = 0.5
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        minconn: int = 1,
+        maxconn: int = 10,
+        timeout: float = 30.0,
+        healthcheck_after: float = 30.0,
+        max_lifetime: float = 1800.0,
+        is_alive: Callable[[Any], bool] = default_is_alive,
+        reset: Callable[[Any], None] = default_reset,
+    ):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Invalid pool size: min={minconn} max={maxconn}")
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self.max_lifetime = max_lifetime
+        self._is_alive = is_alive
+        self._reset = reset
+
+        self._cond = threading.Condition(threading.Lock())
+        # Idle entries are (raw_conn, created_at, last_used_at); LIFO keeps hot
+        # connections hot and lets rarely used ones age out.
+        self._idle: List[Tuple[Any, float, float]] = []
+        self._created_at: Dict[int, float] = {}
+        self._leaked: deque = deque()
+        self._in_use = 0
+        self._closed = False
+        self._stats = {"checkouts": 0, "opened": 0, "discarded": 0, "waits": 0, "timeouts": 0, "leaked": 0}
+
+        for _ in range(minconn):
+            try:
+                raw = self._open()
+            except Exception as e:
+                logger.warning(f"[DB POOL] Could not pre-open connection: {e}")
+                break
+            with self._cond:
+                self._idle.append((raw, self._created_at[id(raw)], time.monotonic()))
+
+    # -- internals -------------------------------------------------------
+    def _open(self):
+        raw = self._connect()
+        with self._cond:
+            self._created_at[id(raw)] = time.monotonic()
+            self._stats["opened"] += 1
+        return raw
+
+    def _forget(self, raw) -> None:
+        """Drop the bookkeeping of a connection about to be closed. Caller holds ``_cond``."""
+        self._created_at.pop(id(raw), None)
+        self._stats["discarded"] += 1
+
+    @staticmethod
+    def _close_quietly(raw) -> None:
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def _drain_leaked(self) -> None:
+        while self._leaked:
+            try:
+                raw = self._leaked.popleft()
+            except IndexError:
+                return
+            logger.warning("[DB POOL] Connection garbage-collected without close(); returning it to the pool")
+            with self._cond:
+                self._stats["leaked"] += 1
+            self._checkin(raw)
+
+    def _usable(self, raw, created_at: float, last_used: float) -> bool:
+        now = time.monotonic()
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return False
+        if getattr(raw, "closed", 0):
+            return False
+        if self.healthcheck_after is not None and now - last_used >= self.healthcheck_after:
+            try:
+                return bool(self._is_alive(raw))
+            except Exception as e:
+                logger.info(f"[DB POOL] Health check failed, replacing connection: {e}")
+                return False
+        return True
+
+    # -- public API ------------------------------------------------------
+    def getconn(self, timeout: Optional[float] = None):
+        """Borrow a connection, blocking up to ``timeout`` seconds (default: the pool's) when exhausted."""
+        limit = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + limit
+        waited = False
+        while True:
+            self._drain_leaked()
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                entry = None
+                while not self._idle and self._in_use >= self.maxconn and not self._leaked:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(f"No database connection available within {limit}s (max={self.maxconn})")
+                    if not waited:
+                        self._stats["waits"] += 1
+                        waited = True
+                    self._cond.wait(min(remaining, self.leak_poll_interval))
+                if not self._idle and self._in_use >= self.maxconn:
+                    continue  # a leaked connection is queued: drain it first
+                if self._idle:
+                    entry = self._idle.pop()
+                # Reserve the slot before doing any I/O outside the lock.
+                self._in_use += 1
+
+            if entry is None:
+                try:
+                    raw = self._open()
+                except Exception:
+                    self._release_slot()
+                    raise
+                self._count_checkout()
+                return raw
+
+            raw, created_at, last_used = entry
+            if self._usable(raw, created_at, last_used):
+                self._count_checkout()
+                return raw
+            # Stale or broken: drop it and retry (will open a fresh one).
+            with self._cond:
+                self._forget(raw)
+            self._close_quietly(raw)
+            self._release_slot()
+
+    def _count_checkout(self) -> None:
+        with self._cond:
+            self._stats["checkouts"] += 1
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def putconn(self, raw, discard: bool = False) -> None:
+        """Return a borrowed connection. Broken connections are closed instead of pooled."""
+        self._checkin(raw, discard)
+        self._drain_leaked()
+
+    def _checkin(self, raw, discard: bool = False) -> None:
+        if not discard:
+            try:
+                self._reset(raw)
+            except Exception:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or self._closed or getattr(raw, "closed", 0):
+                self._forget(raw)
+            else:
+                created_at = self._created_at.get(id(raw), time.monotonic())
+                self._idle.append((raw, created_at, time.monotonic()))
+                raw = None
+            self._cond.notify()
+        if raw is not None:
+            self._close_quietly(raw)
+
+    def return_leaked(self, raw) -> None:
+        """Queue a connection whose wrapper was garbage-collected without close().
+
+        Takes no lock and does no I/O, so it is safe from a finalizer; the
+        connection is rolled back and returned by the next getconn/putconn.
+        """
+        self._leaked.append(raw)
+
+    @contextmanager
+    def connection(self):
+        """``with pool.connection() as raw:`` — always returns the connection."""
+        raw = self.getconn()
+        try:
+            yield raw
+        except Exception:
+            self.putconn(raw)
+            raise
+        else:
+            self.putconn(raw)
+
+    def closeall(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            for raw, _, _ in idle:
+                self._forget(raw)
+            self._cond.notify_all()
+        for raw, _, _ in idle:
+            self._close_quietly(raw)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "leak_queue": len(self._leaked),
+                **self._stats,
+            }
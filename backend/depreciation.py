@@ -0,0 +1,184 @@
+"""Period-level depreciation runs.
+
+``/api/finance/assets/depreciation/run`` charges one asset per request, each
+with its own asset read, account lookups, journal and idempotency check, so
+month-end for a few hundred assets meant a few hundred requests.
+``compute_charges`` works out the charge of every active asset of a school in
+one pass (numpy over the asset register): straight-line
+``(cost - residual) / useful life`` per month, capped at the amount left to
+depreciate, for assets capitalised by the end of the period and not yet
+charged for it.
+
+``post_charges`` posts them as one summarised journal, or as one journal per
+``journal_size`` assets. Each journal has one debit line per expense account
+and one credit line per accumulated-depreciation account. Its schedule rows,
+asset movements and the register update go in set-based statements in the
+same transaction, and each batch is committed and timed on its own. Assets
+already carrying a Posted schedule row for the period are skipped, so
+re-running a period only charges what is missing. Every batch also records a
+``finance_posting_events`` row keyed by the period and asset-id range, so two
+concurrent runs of the same period cannot both post a batch.
+"""
+import json
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+try:
+    from backend import gl_balances
+    from backend.db_bulk import chunked, insert_rows
+except Exception:
+    import gl_balances
+    from db_bulk import chunked, insert_rows
+
+
+@dataclass
+class DepreciationCharge:
+    asset_id: int
+    asset_code: str
+    amount: float
+    expense_account_id: int
+    accumulated_account_id: int
+
+
+def compute_charges(
+    assets: Sequence[Any],
+    period_end: str,
+    already_charged: Set[int],
+    expense_account_id: Callable[[Any], int],
+    accumulated_account_id: Callable[[Any], int],
+) -> Dict[str, Any]:
+    """``{"charges": [...], "skipped": {reason: count}}`` for the asset rows.
+
+    ``assets`` need id, asset_code, status, capitalization_date, cost,
+    residual_value, useful_life_months and accumulated_depreciation; the two
+    callables return an asset's accounts.
+    """
+    skipped = {"already_charged": 0, "not_active": 0, "not_capitalized": 0, "fully_depreciated": 0}
+    if not assets:
+        return {"charges": [], "skipped": skipped}
+    cost = np.array([float(a["cost"] or 0) for a in assets])
+    residual = np.array([float(a["residual_value"] or 0) for a in assets])
+    life = np.array([max(int(a["useful_life_months"] or 60), 1) for a in assets])
+    accumulated = np.array([float(a["accumulated_depreciation"] or 0) for a in assets])
+    monthly = np.round(np.maximum((cost - residual) / life, 0), 2)
+    charge = np.round(np.minimum(monthly, np.maximum(cost - residual - accumulated, 0)), 2)
+
+    charged = np.array([int(a["id"]) in already_charged for a in assets])
+    active = np.array([(a["status"] or "Active") == "Active" for a in assets])
+    capitalized = np.array([str(a["capitalization_date"] or "")[:10] <= period_end for a in assets])
+    skipped["already_charged"] = int(charged.sum())
+    skipped["not_active"] = int((~charged & ~active).sum())
+    skipped["not_capitalized"] = int((~charged & active & ~capitalized).sum())
+    eligible = ~charged & active & capitalized
+    skipped["fully_depreciated"] = int((eligible & (charge <= 0)).sum())
+
+    charges = [
+        DepreciationCharge(int(assets[i]["id"]), assets[i]["asset_code"], float(charge[i]),
+                           expense_account_id(assets[i]), accumulated_account_id(assets[i]))
+        for i in np.flatnonzero(eligible & (charge > 0))
+    ]
+    return {"charges": charges, "skipped": skipped}
+
+
+def _post_batch(conn, school_id: int, user_id: Optional[str], period: Dict[str, str], batch: Sequence[DepreciationCharge],
+                number: str, posting_date: str, now: str) -> Dict[str, Any]:
+    total = round(sum(c.amount for c in batch), 2)
+    ref = f"DEP:{period['period_label']}:{batch[0].asset_id}-{batch[-1].asset_id}"
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT INTO journal_entries (
+            school_id, journal_number, entry_date, description, reference, status,
+            total_debit, total_credit, posted_at, posted_by, created_by, created_at, updated_at
+        ) VALUES (?, ?, ?, ?, ?, 'Posted', ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (school_id, number, posting_date, f"Depreciation {period['period_label']} ({len(batch)} assets)", ref,
+         total, total, now, user_id, user_id, now, now),
+    )
+    journal_id = cur.lastrowid
+    debits: Dict[int, float] = {}
+    credits: Dict[int, float] = {}
+    for c in batch:
+        debits[c.expense_account_id] = debits.get(c.expense_account_id, 0.0) + c.amount
+        credits[c.accumulated_account_id] = credits.get(c.accumulated_account_id, 0.0) + c.amount
+    lines = [(account, round(amount, 2), 0) for account, amount in debits.items()]
+    lines += [(account, 0, round(amount, 2)) for account, amount in credits.items()]
+    insert_rows(cur, "journal_lines", ("journal_entry_id", "line_no", "account_id", "description", "debit", "credit"), [
+        (journal_id, n, account, f"Depreciation {period['period_label']}", debit, credit)
+        for n, (account, debit, credit) in enumerate(lines, start=1)
+    ])
+    cur.execute(
+        """
+        INSERT INTO finance_posting_events (
+            school_id, module, transaction_type, source_ref, idempotency_key, amount, status, journal_entry_id, event_payload, created_by, created_at
+        ) VALUES (?, 'assets', 'ASSET_DEPRECIATION_RUN', ?, ?, ?, 'Posted', ?, ?, ?, ?)
+        """,
+        (school_id, ref, f"asset_dep_{period['period_label']}:{batch[0].asset_id}-{batch[-1].asset_id}", total, journal_id,
+         json.dumps({"assets": len(batch)}), user_id, now),
+    )
+    insert_rows(cur, "depreciation_schedule", (
+        "school_id", "asset_id", "period_label", "period_start", "period_end", "depreciation_amount",
+        "status", "gl_journal_id", "posted_at", "posted_by", "created_at",
+    ), [
+        (school_id, c.asset_id, period["period_label"], period["period_start"], period["period_end"], c.amount,
+         "Posted", journal_id, now, user_id, now)
+        for c in batch
+    ])
+    insert_rows(cur, "asset_movements", (
+        "school_id", "asset_id", "movement_type", "movement_date", "amount", "reference", "gl_journal_id", "created_by", "created_at",
+    ), [
+        (school_id, c.asset_id, "depreciation", period["period_end"], c.amount, period["period_label"], journal_id, user_id, now)
+        for c in batch
+    ])
+    # Both SET expressions see the pre-update accumulated_depreciation.
+    charge_sql = "(SELECT ds.depreciation_amount FROM depreciation_schedule ds WHERE ds.gl_journal_id = ? AND ds.asset_id = fixed_assets.id)"
+    cur.execute(
+        f"""
+        UPDATE fixed_assets
+        SET accumulated_depreciation = COALESCE(accumulated_depreciation, 0) + {charge_sql},
+            carrying_amount = cost - COALESCE(accumulated_depreciation, 0) - {charge_sql},
+            updated_at = ?
+        WHERE id IN (SELECT asset_id FROM depreciation_schedule WHERE gl_journal_id = ?)
+        """,
+        (journal_id, journal_id, now, journal_id),
+    )
+    gl_balances.apply_journal(conn, journal_id, 1)
+    return {"journal_id": journal_id, "journal_number": number, "assets": len(batch), "amount": total}
+
+
+def post_charges(
+    conn,
+    school_id: int,
+    user_id: Optional[str],
+    period: Dict[str, str],
+    charges: Sequence[DepreciationCharge],
+    numbers: Callable[[Any, int], List[str]],
+    journal_size: int = 0,
+    posting_date: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Post ``charges`` in batches of ``journal_size`` assets (0 = one journal), committing each batch.
+
+    ``period`` holds period_label, period_start and period_end;
+    ``numbers(conn, count)`` returns new journal numbers.
+    """
+    batches: List[Dict[str, Any]] = []
+    errors: List[Dict[str, Any]] = []
+    ordered = sorted(charges, key=lambda c: c.asset_id)
+    for batch in chunked(ordered, journal_size if journal_size > 0 else max(len(ordered), 1)):
+        started = time.perf_counter()
+        try:
+            now = datetime.now().isoformat()
+            number = numbers(conn, 1)[0]
+            posted = _post_batch(conn, school_id, user_id, period, batch, number, posting_date or period["period_end"], now)
+            conn.commit()
+            posted["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            batches.append(posted)
+        except Exception as e:
+            conn.rollback()
+            errors.append({"asset_ids": [batch[0].asset_id, batch[-1].asset_id], "assets": len(batch),
+                           "error": str(e)[:300], "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)})
+    return {"batches": batches, "errors": errors}
@@ -0,0 +1,117 @@
+"""Document and journal number sequences.
+
+Journal, invoice, bill, stock-move and payroll numbers were found by reading
+the highest existing number (``LIKE 'prefix%' ORDER BY ... DESC LIMIT 1``)
+and adding one in Python: a scan per posting, and two concurrent postings
+could read the same "last" number and collide on the unique constraint.
+
+``SequenceAllocator`` keeps one counter row per (school, prefix, period) in
+``doc_sequences`` and increments it with an upsert, so two writers can never
+get the same value:
+
+* with ``block_size == 1`` the increment runs in the caller's transaction,
+  so a rolled-back posting also gives its number back;
+* with ``block_size > 1`` a block of numbers is reserved and committed on a
+  separate short connection and handed out from memory, so postings don't
+  wait on each other's row lock. Numbers left in a block when the process
+  exits are skipped (gaps).
+
+A counter that does not exist yet is started from the highest number already
+in use (the caller's ``seed`` scan), once.
+"""
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Key = Tuple[int, str, str]
+
+
+def sequences_ddl(pk_def: str) -> List[str]:
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS doc_sequences (
+            id {pk_def},
+            school_id INTEGER NOT NULL,
+            prefix TEXT NOT NULL,
+            period TEXT NOT NULL DEFAULT '',
+            last_value INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_doc_sequences_key ON doc_sequences (school_id, prefix, period)",
+    ]
+
+
+class SequenceAllocator:
+    def __init__(self, connect: Callable[[], Any], block_size: int = 1):
+        self._connect = connect
+        self.block_size = max(1, block_size)
+        self._lock = threading.Lock()
+        self._blocks: Dict[Key, Tuple[int, int]] = {}  # key -> (next value, last value reserved)
+        self._stats = {"allocated": 0, "reserved_blocks": 0, "seeded": 0}
+
+    def _reserve(self, conn, key: Key, count: int, seed: Optional[Callable[[Any], int]]) -> int:
+        """Increment the counter by ``count``; returns its new value."""
+        school_id, prefix, period = key
+        now = datetime.now().isoformat()
+        exists = conn.execute(
+            "SELECT 1 FROM doc_sequences WHERE school_id = ? AND prefix = ? AND period = ?", key
+        ).fetchone()
+        if not exists:
+            start = int(seed(conn) or 0) if seed else 0
+            conn.execute(
+                "INSERT INTO doc_sequences (school_id, prefix, period, last_value, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (school_id, prefix, period) DO NOTHING",
+                (school_id, prefix, period, start, now),
+            )
+            self._stats["seeded"] += 1
+        conn.execute(
+            "INSERT INTO doc_sequences (school_id, prefix, period, last_value, updated_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (school_id, prefix, period) DO UPDATE SET "
+            "last_value = doc_sequences.last_value + excluded.last_value, updated_at = excluded.updated_at",
+            (school_id, prefix, period, count, now),
+        )
+        # The upsert holds the row lock until commit, so this reads our own increment.
+        row = conn.execute(
+            "SELECT last_value FROM doc_sequences WHERE school_id = ? AND prefix = ? AND period = ?", key
+        ).fetchone()
+        return int(row["last_value"])
+
+    def next(self, conn, school_id: int, prefix: str, period: str = "", seed: Optional[Callable[[Any], int]] = None) -> int:
+        """The next value of the (school, prefix, period) sequence.
+
+        ``seed(conn)`` returns the highest value already used; it only runs
+        when the counter is created.
+        """
+        key = (int(school_id), prefix, period or "")
+        if self.block_size == 1:
+            self._stats["allocated"] += 1
+            return self._reserve(conn, key, 1, seed)
+        with self._lock:
+            value, last = self._blocks.get(key, (1, 0))
+            if value > last:
+                block_conn = self._connect()
+                try:
+                    last = self._reserve(block_conn, key, self.block_size, seed)
+                    block_conn.commit()
+                except Exception:
+                    block_conn.rollback()
+                    raise
+                finally:
+                    block_conn.close()
+                value = last - self.block_size + 1
+                self._stats["reserved_blocks"] += 1
+            self._blocks[key] = (value + 1, last)
+            self._stats["allocated"] += 1
+            return value
+
+    def reserve(self, conn, school_id: int, prefix: str, count: int, period: str = "",
+                seed: Optional[Callable[[Any], int]] = None) -> int:
+        """Take ``count`` consecutive values in the caller's transaction; returns the first."""
+        self._stats["allocated"] += count
+        return self._reserve(conn, (int(school_id), prefix, period or ""), count, seed) - count + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            open_blocks = len(self._blocks)
+        return {**self._stats, "block_size": self.block_size, "open_blocks": open_blocks}
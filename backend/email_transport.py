@@ -0,0 +1,189 @@
+"""Long-lived email transport for the notification dispatcher.
+
+``send_email()`` in backend.py opens a fresh HTTPS or SMTP session for every
+message, which is fine for a one-off OTP but not for fan-out. This transport
+keeps one ``requests.Session`` to the Resend API and one authenticated SMTP
+connection open across sends, reconnecting only when the server drops it, and
+paces each provider with its own token bucket.
+"""
+import logging
+import smtplib
+import threading
+import time
+from dataclasses import dataclass
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+RESEND_URL = "https://api.resend.com/emails"
+
+
+class PermanentDeliveryError(Exception):
+    """The message can never be delivered as-is (bad address, no provider configured)."""
+
+
+class TokenBucket:
+    """Blocking rate limiter: ``rate`` tokens per second, bursts up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+@dataclass
+class EmailSettings:
+    smtp_email: str
+    smtp_password: str
+    smtp_server: str
+    smtp_port: int
+    resend_api_key: str = ""
+    resend_from: str = ""
+    sender_name: str = "ClassBridge"
+
+    @property
+    def resend_enabled(self) -> bool:
+        return bool(self.resend_api_key) and self.resend_api_key != "your-resend-api-key"
+
+    @property
+    def smtp_enabled(self) -> bool:
+        return bool(self.smtp_password) and "your-app-password" not in self.smtp_password
+
+
+class EmailTransport:
+    """Sends HTML email over reused connections: Resend first, SMTP as fallback."""
+
+    def __init__(self, settings: EmailSettings, resend_rate: float = 2.0, smtp_rate: float = 1.0):
+        self.settings = settings
+        self._resend_limit = TokenBucket(resend_rate)
+        self._smtp_limit = TokenBucket(smtp_rate)
+        self._session = None
+        self._smtp: Optional[smtplib.SMTP] = None
+
+    # -- providers -------------------------------------------------------
+    def _resend_session(self):
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+            self._session.headers.update({
+                "Authorization": f"Bearer {self.settings.resend_api_key}",
+                "Content-Type": "application/json",
+            })
+        return self._session
+
+    def _send_resend(self, to_email: str, subject: str, html: str) -> None:
+        self._resend_limit.acquire()
+        resp = self._resend_session().post(
+            RESEND_URL,
+            json={
+                "from": f"{self.settings.sender_name} <{self.settings.resend_from or self.settings.smtp_email}>",
+                "to": [to_email],
+                "subject": subject,
+                "html": html,
+            },
+            timeout=15,
+        )
+        if resp.status_code in (200, 201):
+            return
+        if resp.status_code in (400, 403, 422):
+            raise PermanentDeliveryError(f"Resend rejected message ({resp.status_code}): {resp.text[:200]}")
+        raise RuntimeError(f"Resend API error {resp.status_code}: {resp.text[:200]}")
+
+    def _smtp_connection(self) -> smtplib.SMTP:
+        if self._smtp is not None:
+            try:
+                if self._smtp.noop()[0] == 250:
+                    return self._smtp
+            except Exception:
+                pass
+            self._close_smtp()
+        s = self.settings
+        server = None
+        try:
+            server = smtplib.SMTP(s.smtp_server, s.smtp_port, timeout=20)
+            server.ehlo()
+            server.starttls()
+            server.ehlo()
+            server.login(s.smtp_email, s.smtp_password)
+        except Exception as starttls_err:
+            logger.warning(f"[OUTBOX] STARTTLS port {s.smtp_port} failed: {starttls_err}. Retrying SSL port 465...")
+            if server is not None:
+                try:
+                    server.close()
+                except Exception:
+                    pass
+            server = smtplib.SMTP_SSL(s.smtp_server, 465, timeout=20)
+            server.ehlo()
+            server.login(s.smtp_email, s.smtp_password)
+        self._smtp = server
+        return server
+
+    def _send_smtp(self, to_email: str, subject: str, html: str) -> None:
+        self._smtp_limit.acquire()
+        msg = MIMEMultipart("alternative")
+        msg["From"] = self.settings.smtp_email
+        msg["To"] = to_email
+        msg["Subject"] = subject
+        msg.attach(MIMEText(html, "html"))
+        try:
+            self._smtp_connection().send_message(msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            raise PermanentDeliveryError(f"Recipient refused: {e}")
+        except Exception:
+            self._close_smtp()
+            raise
+
+    # -- public API ------------------------------------------------------
+    def send(self, to_email: str, subject: str, html: str) -> None:
+        """Deliver one message or raise (PermanentDeliveryError = do not retry)."""
+        s = self.settings
+        if not s.smtp_email or "your-email" in s.smtp_email:
+            raise PermanentDeliveryError("SMTP_EMAIL not configured")
+        if "example.com" in to_email:
+            raise PermanentDeliveryError("Simulation mode (example.com address)")
+        if s.resend_enabled:
+            try:
+                self._send_resend(to_email, subject, html)
+                return
+            except Exception as e:
+                # A Resend 4xx is often the account (e.g. an unverified domain, 403),
+                # not the message: it is only final when there is no SMTP to try.
+                if not s.smtp_enabled:
+                    raise
+                logger.warning(f"[OUTBOX] Resend failed for {to_email}: {e}. Falling back to SMTP...")
+        if not s.smtp_enabled:
+            raise PermanentDeliveryError("SMTP_PASSWORD not configured")
+        self._send_smtp(to_email, subject, html)
+
+    def _close_smtp(self) -> None:
+        server, self._smtp = self._smtp, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        self._close_smtp()
+        session, self._session = self._session, None
+        if session is not None:
+            session.close()
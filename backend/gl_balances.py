@@ -0,0 +1,176 @@
+"""Materialized general-ledger balances.
+
+The trial balance, P&L, balance sheet and reconciliation check summed
+``journal_lines`` for every posted journal of the school on each request, so
+they got slower as the ledger grew. ``gl_account_balances`` keeps the posted
+debit / credit totals per (school, account, period, entry date):
+
+* ``apply_journal(conn, journal_id, +1)`` when a journal becomes Posted and
+  ``-1`` when it stops being Posted (reversal), in the same transaction;
+* reports read ``account_totals``, which sums the (much fewer) buckets. The
+  entry-date component keeps ``date_from`` / ``date_to`` filters exact;
+* ``rebuild`` recomputes a school (or everything) from the raw lines, and
+  ``check`` lists the buckets that disagree with them.
+
+Journals without a period are stored under ``period_id = 0``. Buckets whose
+journals were all reversed keep ``line_count = 0`` and are skipped by
+``account_totals``, matching the old queries, which only listed accounts with
+posted lines.
+"""
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    from backend.db_bulk import chunked, sql_placeholders
+except Exception:
+    from db_bulk import chunked, sql_placeholders
+
+TOLERANCE = 0.005
+
+_BUCKET_COLUMNS = "school_id, account_id, period_id, entry_date"
+
+_POSTED_TOTALS = """
+    SELECT je.school_id, jl.account_id, COALESCE(je.period_id, 0) AS period_id, je.entry_date,
+           COALESCE(SUM(jl.debit), 0) AS debit, COALESCE(SUM(jl.credit), 0) AS credit, COUNT(*) AS line_count
+    FROM journal_lines jl
+    JOIN journal_entries je ON je.id = jl.journal_entry_id
+    WHERE {where}
+    GROUP BY je.school_id, jl.account_id, COALESCE(je.period_id, 0), je.entry_date
+"""
+
+
+def balances_ddl(pk_def: str) -> List[str]:
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS gl_account_balances (
+            id {pk_def},
+            school_id INTEGER NOT NULL,
+            account_id INTEGER NOT NULL,
+            period_id INTEGER NOT NULL DEFAULT 0,
+            entry_date TEXT NOT NULL,
+            debit REAL DEFAULT 0,
+            credit REAL DEFAULT 0,
+            line_count INTEGER DEFAULT 0,
+            FOREIGN KEY (school_id) REFERENCES schools(id) ON DELETE CASCADE,
+            FOREIGN KEY (account_id) REFERENCES accounts(id) ON DELETE CASCADE
+        )
+        """,
+        f"CREATE UNIQUE INDEX IF NOT EXISTS ux_gl_account_balances_bucket ON gl_account_balances ({_BUCKET_COLUMNS})",
+    ]
+
+
+def apply_journals(conn, journal_ids: Sequence[int], sign: int = 1) -> None:
+    """Add (sign=1) or remove (sign=-1) the lines of ``journal_ids``. Does not commit."""
+    for chunk in chunked(list(journal_ids)):
+        conn.execute(
+            f"""
+            INSERT INTO gl_account_balances ({_BUCKET_COLUMNS}, debit, credit, line_count)
+            SELECT school_id, account_id, period_id, entry_date, debit * ?, credit * ?, line_count * ?
+            FROM ({_POSTED_TOTALS.format(where=f"je.id IN ({sql_placeholders(len(chunk))})")}) t
+            WHERE TRUE
+            ON CONFLICT ({_BUCKET_COLUMNS}) DO UPDATE SET
+                debit = gl_account_balances.debit + excluded.debit,
+                credit = gl_account_balances.credit + excluded.credit,
+                line_count = gl_account_balances.line_count + excluded.line_count
+            """,
+            (sign, sign, sign, *chunk),
+        )
+
+
+def apply_journal(conn, journal_id: int, sign: int = 1) -> None:
+    apply_journals(conn, [journal_id], sign)
+
+
+def rebuild(conn, school_id: Optional[int] = None) -> int:
+    """Recompute the balances of one school (or all) from posted lines. Does not commit."""
+    where = "je.status = 'Posted'"
+    params: List[Any] = []
+    if school_id is not None:
+        where += " AND je.school_id = ?"
+        params.append(school_id)
+        conn.execute("DELETE FROM gl_account_balances WHERE school_id = ?", (school_id,))
+    else:
+        conn.execute("DELETE FROM gl_account_balances")
+    conn.execute(
+        f"""
+        INSERT INTO gl_account_balances ({_BUCKET_COLUMNS}, debit, credit, line_count)
+        SELECT school_id, account_id, period_id, entry_date, debit, credit, line_count
+        FROM ({_POSTED_TOTALS.format(where=where)}) t
+        """,
+        params,
+    )
+    count_sql = "SELECT COUNT(*) AS n FROM gl_account_balances"
+    row = conn.execute(count_sql + (" WHERE school_id = ?" if school_id is not None else ""), params).fetchone()
+    return int(row["n"] or 0)
+
+
+def check(conn, school_id: int) -> List[Dict[str, Any]]:
+    """Buckets where the stored balance differs from the raw posted lines."""
+    expected = {
+        (r["account_id"], r["period_id"], r["entry_date"]): r
+        for r in conn.execute(
+            _POSTED_TOTALS.format(where="je.status = 'Posted' AND je.school_id = ?"), (school_id,)
+        ).fetchall()
+    }
+    stored = {
+        (r["account_id"], r["period_id"], r["entry_date"]): r
+        for r in conn.execute(
+            "SELECT account_id, period_id, entry_date, debit, credit, line_count FROM gl_account_balances WHERE school_id = ?",
+            (school_id,),
+        ).fetchall()
+    }
+    mismatches = []
+    for key in sorted(set(expected) | set(stored), key=lambda k: (k[0], k[1], str(k[2]))):
+        want, have = expected.get(key), stored.get(key)
+        want_debit, want_credit, want_lines = (float(want["debit"]), float(want["credit"]), int(want["line_count"])) if want else (0.0, 0.0, 0)
+        have_debit, have_credit, have_lines = (float(have["debit"] or 0), float(have["credit"] or 0), int(have["line_count"] or 0)) if have else (0.0, 0.0, 0)
+        if (abs(want_debit - have_debit) > TOLERANCE or abs(want_credit - have_credit) > TOLERANCE
+                or want_lines != have_lines):
+            mismatches.append({
+                "account_id": key[0], "period_id": key[1] or None, "entry_date": key[2],
+                "expected": {"debit": round(want_debit, 2), "credit": round(want_credit, 2), "lines": want_lines},
+                "stored": {"debit": round(have_debit, 2), "credit": round(have_credit, 2), "lines": have_lines},
+            })
+    return mismatches
+
+
+def account_totals(
+    conn,
+    school_id: int,
+    period_id: Optional[int] = None,
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    account_types: Optional[Sequence[str]] = None,
+    account_codes: Optional[Sequence[str]] = None,
+) -> List[Any]:
+    """Posted debit / credit per account (``account_id, code, name, account_type, total_debit, total_credit``), by code."""
+    clauses = ["b.school_id = ?"]
+    params: List[Any] = [school_id]
+    if period_id:
+        clauses.append("b.period_id = ?")
+        params.append(period_id)
+    if date_from:
+        clauses.append("b.entry_date >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append("b.entry_date <= ?")
+        params.append(date_to)
+    if account_types:
+        clauses.append(f"a.account_type IN ({sql_placeholders(len(account_types))})")
+        params.extend(account_types)
+    if account_codes:
+        clauses.append(f"a.code IN ({sql_placeholders(len(account_codes))})")
+        params.extend(account_codes)
+    return conn.execute(
+        f"""
+        SELECT a.id AS account_id, a.code, a.name, a.account_type,
+               COALESCE(SUM(b.debit), 0) AS total_debit,
+               COALESCE(SUM(b.credit), 0) AS total_credit
+        FROM gl_account_balances b
+        JOIN accounts a ON a.id = b.account_id
+        WHERE {' AND '.join(clauses)}
+        GROUP BY a.id, a.code, a.name, a.account_type
+        HAVING SUM(b.line_count) > 0
+        ORDER BY a.code
+        """,
+        params,
+    ).fetchall()
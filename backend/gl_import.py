@@ -0,0 +1,319 @@
+"""Bulk journal import for the general ledger.
+
+``create_gl_journal`` takes one journal per request and resolves each line's
+account with its own query, so loading opening balances or a term of fee
+postings meant thousands of requests. ``/api/finance/gl/journals/import``
+takes a whole file instead:
+
+* CSV with a header row, or JSON lines. Every row is one journal line, and
+  rows with the same ``journal_ref`` form one journal. A JSON line may also
+  be a whole journal with a ``lines`` list;
+* every account is resolved from one query over the school's active accounts;
+* amounts are checked with numpy over the whole file (bad numbers, negative
+  amounts, lines with both or neither side set, and per-journal balance via
+  ``bincount``);
+* valid journals are written ``chunk_size`` at a time: one multi-row INSERT
+  for the entries and one for their lines, committed per chunk. A chunk the
+  database rejects is retried one journal at a time, so a bad journal only
+  fails itself.
+
+Errors are reported per source row (1-based, header excluded). A journal with
+any bad row is skipped as a whole; the other journals are still imported.
+"""
+import csv
+import io
+import json
+import math
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+try:
+    from backend import gl_balances
+    from backend.db_bulk import chunked, insert_rows, sql_placeholders
+except Exception:
+    import gl_balances
+    from db_bulk import chunked, insert_rows, sql_placeholders
+
+ENTRY_COLUMNS = (
+    "school_id", "journal_number", "entry_date", "description", "reference", "period_id", "status",
+    "total_debit", "total_credit", "posted_at", "posted_by", "created_by", "created_at", "updated_at",
+)
+LINE_COLUMNS = (
+    "journal_entry_id", "line_no", "account_id", "description", "debit", "credit", "cost_center_id", "tax_code_id", "party_id",
+)
+
+
+@dataclass
+class ImportRow:
+    row: int
+    values: Dict[str, Any]
+
+    def get(self, name: str) -> Any:
+        value = self.values.get(name)
+        if isinstance(value, str):
+            value = value.strip()
+        return None if value in ("", None) else value
+
+
+@dataclass
+class PreparedJournal:
+    ref: str
+    rows: List[ImportRow]
+    entry_date: str = ""
+    description: Optional[str] = None
+    reference: Optional[str] = None
+    period_id: Optional[int] = None
+    lines: List[Tuple] = field(default_factory=list)  # LINE_COLUMNS without journal_entry_id
+    total: float = 0.0
+
+
+@dataclass
+class ImportResult:
+    journals: List[Dict[str, Any]] = field(default_factory=list)
+    errors: List[Dict[str, Any]] = field(default_factory=list)
+    lines_created: int = 0
+
+    def error(self, rows: Sequence[ImportRow], ref: Optional[str], message: str) -> None:
+        for r in rows:
+            self.errors.append({"row": r.row, "journal_ref": ref, "error": message})
+
+    def to_dict(self) -> Dict[str, Any]:
+        failed = {e["journal_ref"] for e in self.errors if e["journal_ref"] is not None}
+        return {
+            "journals_created": len(self.journals),
+            "lines_created": self.lines_created,
+            "journals_failed": len(failed),
+            "journals": self.journals,
+            "errors": sorted(self.errors, key=lambda e: e["row"]),
+        }
+
+
+# -- parsing -------------------------------------------------------------------
+def parse_csv(text: str) -> List[ImportRow]:
+    reader = csv.DictReader(io.StringIO(text))
+    if reader.fieldnames:
+        reader.fieldnames = [(name or "").strip().lower() for name in reader.fieldnames]
+    return [ImportRow(n, dict(values)) for n, values in enumerate(reader, start=1)]
+
+
+def parse_jsonl(text: str, result: ImportResult) -> List[ImportRow]:
+    rows: List[ImportRow] = []
+    for n, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            result.errors.append({"row": n, "journal_ref": None, "error": f"Invalid JSON: {e}"})
+            continue
+        lines = data.pop("lines", None)
+        if isinstance(lines, list):
+            for line_values in lines:
+                values = {**data, **(line_values if isinstance(line_values, dict) else {})}
+                if "description" in (line_values or {}):
+                    values["line_description"] = line_values["description"]
+                    values["description"] = data.get("description")
+                rows.append(ImportRow(n, values))
+        else:
+            rows.append(ImportRow(n, data))
+    return rows
+
+
+def parse_upload(data: bytes, filename: Optional[str], result: ImportResult) -> List[ImportRow]:
+    text = data.decode("utf-8-sig", errors="replace")
+    name = (filename or "").lower()
+    if name.endswith((".jsonl", ".ndjson", ".json")) or (not name.endswith(".csv") and text.lstrip().startswith("{")):
+        return parse_jsonl(text, result)
+    return parse_csv(text)
+
+
+def _number(value: Any) -> float:
+    if value in (None, ""):
+        return 0.0
+    try:
+        number = float(str(value).replace(",", ""))
+    except ValueError:
+        return math.nan
+    return number if math.isfinite(number) else math.nan
+
+
+def _int_or_none(value: Any) -> Optional[int]:
+    return None if value in (None, "") else int(value)
+
+
+# -- validation ----------------------------------------------------------------
+def prepare(
+    rows: Sequence[ImportRow],
+    accounts: Sequence[Any],
+    periods: Dict[int, str],
+    result: ImportResult,
+) -> List[PreparedJournal]:
+    """Group rows into journals and validate them; invalid journals go to ``result.errors``.
+
+    ``accounts`` are the school's active ``(id, code)`` rows and ``periods``
+    maps period id to status.
+    """
+    ids = {int(a["id"]) for a in accounts}
+    by_code = {str(a["code"]): int(a["id"]) for a in accounts}
+
+    journals: Dict[str, PreparedJournal] = {}
+    for r in rows:
+        ref = r.get("journal_ref")
+        if ref is None:
+            result.error([r], None, "journal_ref is required.")
+            continue
+        journals.setdefault(str(ref), PreparedJournal(str(ref), [])).rows.append(r)
+    ordered = list(journals.values())
+    if not ordered:
+        return []
+
+    flat = [r for j in ordered for r in j.rows]
+    group = np.repeat(np.arange(len(ordered)), [len(j.rows) for j in ordered])
+    debit = np.array([_number(r.get("debit")) for r in flat])
+    credit = np.array([_number(r.get("credit")) for r in flat])
+    not_numeric = np.isnan(debit) | np.isnan(credit)
+    debit, credit = np.nan_to_num(debit), np.nan_to_num(credit)
+    negative = (debit < 0) | (credit < 0)
+    one_sided = (debit > 0) ^ (credit > 0)
+    line_counts = np.bincount(group, minlength=len(ordered))
+    total_debit = np.bincount(group, weights=debit, minlength=len(ordered))
+    total_credit = np.bincount(group, weights=credit, minlength=len(ordered))
+    unbalanced = np.abs(total_debit - total_credit) > 0.0001
+
+    row_errors: Dict[int, str] = {}
+    for i in np.flatnonzero(not_numeric):
+        row_errors[int(i)] = "debit/credit must be numbers."
+    for i in np.flatnonzero(negative & ~not_numeric):
+        row_errors[int(i)] = "debit/credit cannot be negative."
+    for i in np.flatnonzero(~one_sided & ~negative & ~not_numeric):
+        row_errors[int(i)] = "Provide either debit or credit."
+
+    prepared: List[PreparedJournal] = []
+    offset = 0
+    for j, journal in enumerate(ordered):
+        first = journal.rows[0]
+        message = None
+        lines = []
+        for k, r in enumerate(journal.rows):
+            i = offset + k
+            if i in row_errors:
+                result.error([r], journal.ref, row_errors[i])
+                message = message or "Journal has invalid lines."
+                continue
+            account_id = r.get("account_id")
+            resolved = None
+            try:
+                if account_id is not None and int(account_id) in ids:
+                    resolved = int(account_id)
+            except ValueError:
+                pass
+            if resolved is None and r.get("account_code") is not None:
+                resolved = by_code.get(str(r.get("account_code")))
+            if resolved is None:
+                result.error([r], journal.ref, "Line must reference an active account via account_id or account_code.")
+                message = message or "Journal has invalid lines."
+                continue
+            try:
+                lines.append((k + 1, resolved, r.get("line_description"), float(debit[i]), float(credit[i]),
+                              _int_or_none(r.get("cost_center_id")), _int_or_none(r.get("tax_code_id")),
+                              _int_or_none(r.get("party_id"))))
+            except ValueError:
+                result.error([r], journal.ref, "cost_center_id, tax_code_id and party_id must be integers.")
+                message = message or "Journal has invalid lines."
+        offset += len(journal.rows)
+        if message:
+            continue
+
+        entry_date = first.get("entry_date")
+        try:
+            journal.entry_date = date.fromisoformat(str(entry_date)).isoformat()
+        except (TypeError, ValueError):
+            result.error(journal.rows, journal.ref, "entry_date must be an ISO date (YYYY-MM-DD).")
+            continue
+        if any(r.get("entry_date") not in (None, entry_date) for r in journal.rows):
+            result.error(journal.rows, journal.ref, "All rows of a journal must share one entry_date.")
+            continue
+        if line_counts[j] < 2:
+            result.error(journal.rows, journal.ref, "At least two journal lines are required.")
+            continue
+        if unbalanced[j]:
+            result.error(journal.rows, journal.ref, "Journal is not balanced. Debit total must equal credit total.")
+            continue
+        try:
+            journal.period_id = _int_or_none(first.get("period_id"))
+        except ValueError:
+            result.error(journal.rows, journal.ref, "period_id must be an integer.")
+            continue
+        if journal.period_id is not None:
+            status = periods.get(journal.period_id)
+            if status is None:
+                result.error(journal.rows, journal.ref, "Invalid period_id for this school.")
+                continue
+            if (status or "").lower() == "closed":
+                result.error(journal.rows, journal.ref, "Accounting period is closed. Posting is not allowed.")
+                continue
+        journal.description = first.get("description")
+        journal.reference = first.get("reference") or journal.ref
+        journal.lines = lines
+        journal.total = round(float(total_debit[j]), 2)
+        prepared.append(journal)
+    return prepared
+
+
+# -- writing -------------------------------------------------------------------
+def _write(conn, school_id: int, user_id: Optional[str], journals: Sequence[PreparedJournal],
+           numbers: Callable[[Any, int], List[str]], post: bool) -> List[Dict[str, Any]]:
+    now = datetime.now().isoformat()
+    status = "Posted" if post else "Draft"
+    journal_numbers = numbers(conn, len(journals))
+    insert_rows(conn, "journal_entries", ENTRY_COLUMNS, [
+        (school_id, number, j.entry_date, j.description, j.reference, j.period_id, status, j.total, j.total,
+         now if post else None, user_id if post else None, user_id, now, now)
+        for j, number in zip(journals, journal_numbers)
+    ])
+    ids: Dict[str, int] = {}
+    for chunk in chunked(journal_numbers):
+        for row in conn.execute(
+            f"SELECT id, journal_number FROM journal_entries WHERE school_id = ? AND journal_number IN ({sql_placeholders(len(chunk))})",
+            (school_id, *chunk),
+        ).fetchall():
+            ids[row["journal_number"]] = int(row["id"])
+    insert_rows(conn, "journal_lines", LINE_COLUMNS, [
+        (ids[number], *line) for j, number in zip(journals, journal_numbers) for line in j.lines
+    ])
+    if post:
+        gl_balances.apply_journals(conn, [ids[n] for n in journal_numbers], 1)
+    return [
+        {"journal_ref": j.ref, "journal_id": ids[number], "journal_number": number, "lines": len(j.lines)}
+        for j, number in zip(journals, journal_numbers)
+    ]
+
+
+def write_journals(conn, school_id: int, user_id: Optional[str], journals: Sequence[PreparedJournal],
+                   numbers: Callable[[Any, int], List[str]], result: ImportResult,
+                   post: bool = False, chunk_size: int = 200) -> None:
+    """Insert ``journals`` ``chunk_size`` at a time, committing each chunk.
+
+    ``numbers(conn, count)`` returns ``count`` new journal numbers.
+    """
+    for chunk in chunked(list(journals), max(1, chunk_size)):
+        try:
+            created = _write(conn, school_id, user_id, chunk, numbers, post)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            created = []
+            for journal in chunk:
+                try:
+                    created.extend(_write(conn, school_id, user_id, [journal], numbers, post))
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    result.error(journal.rows, journal.ref, f"Could not save journal: {str(e)[:200]}")
+        result.journals.extend(created)
+        result.lines_created += sum(c["lines"] for c in created)
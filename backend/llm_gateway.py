@@ -0,0 +1,289 @@
+"""Single async entry point for every LLM call the API makes.
+
+Route handlers used to call the synchronous Groq client directly, which
+blocked the event loop for the whole completion. ``LLMGateway`` instead:
+
+* talks to providers through async clients (``GroqProvider`` wraps
+  ``groq.AsyncGroq``; ``StubProvider`` answers locally for offline load tests);
+* caps the number of in-flight calls per worker and rejects callers that wait
+  in the queue longer than ``queue_timeout`` with ``LLMUnavailable``;
+* bounds each call with ``timeout`` (for streams: the gap between chunks);
+* can stream tokens, which ``sse_events`` turns into Server-Sent Events.
+
+Providers are registered under names ("default", "grade_helper", ...) so call
+sites that used separate API keys keep doing so. Each call names its
+``endpoint``; ``stats()["endpoints"]`` reports calls, prompt / completion
+tokens and mean latency per endpoint (streams and providers that report no
+usage are counted with ``prompt_budget.count_tokens``).
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+try:
+    from backend.prompt_budget import count_message_tokens, count_tokens
+except Exception:
+    from prompt_budget import count_message_tokens, count_tokens
+
+logger = logging.getLogger(__name__)
+
+Messages = List[Dict[str, str]]
+
+
+class LLMError(Exception):
+    """The completion could not be produced."""
+
+
+class LLMTimeout(LLMError):
+    pass
+
+
+class LLMUnavailable(LLMError):
+    """No provider configured, or the worker is at its concurrency limit."""
+
+
+@dataclass
+class ChatResult:
+    content: str
+    model: str
+    provider: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency_ms: float = 0.0
+
+
+class GroqProvider:
+    name = "groq"
+
+    def __init__(self, api_key: str, timeout: float = 30.0, max_retries: int = 1):
+        from groq import AsyncGroq
+
+        self._client = AsyncGroq(api_key=api_key, timeout=timeout, max_retries=max_retries)
+
+    async def complete(self, messages: Messages, model: str, **params) -> ChatResult:
+        completion = await self._client.chat.completions.create(messages=messages, model=model, **params)
+        usage = getattr(completion, "usage", None)
+        return ChatResult(
+            content=completion.choices[0].message.content or "",
+            model=model,
+            provider=self.name,
+            prompt_tokens=getattr(usage, "prompt_tokens", 0) or 0,
+            completion_tokens=getattr(usage, "completion_tokens", 0) or 0,
+        )
+
+    async def stream(self, messages: Messages, model: str, **params) -> AsyncIterator[str]:
+        params.pop("response_format", None)
+        chunks = await self._client.chat.completions.create(messages=messages, model=model, stream=True, **params)
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class StubProvider:
+    """Offline provider: fixed latency, then a canned reply at ``tokens_per_second``.
+
+    JSON-mode requests get ``{"mode": "EDUCATION", "content": ...}`` so the chat
+    endpoints that parse structured replies work unchanged.
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = 0.2, tokens_per_second: float = 200.0, reply: Optional[Callable[[Messages], str]] = None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self._reply = reply
+
+    def _text(self, messages: Messages) -> str:
+        if self._reply:
+            return self._reply(messages)
+        prompt = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        return f"[stub reply] {' '.join(prompt.split()[:40])}"
+
+    def _body(self, messages: Messages, params: Dict[str, Any]) -> str:
+        text = self._text(messages)
+        if (params.get("response_format") or {}).get("type") == "json_object":
+            return json.dumps({"mode": "EDUCATION", "content": text, "query": None, "score": 0, "feedback": text})
+        return text
+
+    async def complete(self, messages: Messages, model: str, **params) -> ChatResult:
+        body = self._body(messages, params)
+        words = body.split()
+        await asyncio.sleep(self.latency + (len(words) / self.tokens_per_second if self.tokens_per_second > 0 else 0))
+        prompt_words = sum(len(m.get("content", "").split()) for m in messages)
+        return ChatResult(content=body, model=model, provider=self.name, prompt_tokens=prompt_words, completion_tokens=len(words))
+
+    async def stream(self, messages: Messages, model: str, **params) -> AsyncIterator[str]:
+        params.pop("response_format", None)
+        await asyncio.sleep(self.latency)
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for i, word in enumerate(self._body(messages, params).split(" ")):
+            await asyncio.sleep(delay)
+            yield word if i == 0 else f" {word}"
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        providers: Dict[str, Any],
+        default_model: str,
+        max_concurrency: int = 8,
+        timeout: float = 30.0,
+        queue_timeout: float = 10.0,
+    ):
+        self._providers = {name: p for name, p in providers.items() if p is not None}
+        self.default_model = default_model
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+
+        # asyncio primitives belong to one loop; recreate if the loop changes (tests).
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop = None
+        self._in_flight = 0
+        self._waiting = 0
+        self._latencies: "deque[float]" = deque(maxlen=500)
+        self._stats = {"requests": 0, "streams": 0, "errors": 0, "timeouts": 0, "rejected": 0,
+                       "prompt_tokens": 0, "completion_tokens": 0}
+        self._endpoints: Dict[str, Dict[str, float]] = {}
+
+    def available(self, provider: str = "default") -> bool:
+        return provider in self._providers
+
+    def _provider(self, name: str):
+        provider = self._providers.get(name) or self._providers.get("default")
+        if provider is None:
+            raise LLMUnavailable(f"No LLM provider configured for '{name}'")
+        return provider
+
+    def _slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _acquire(self) -> asyncio.Semaphore:
+        slots = self._slots()
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._stats["rejected"] += 1
+            raise LLMUnavailable(f"LLM gateway busy ({self.max_concurrency} calls in flight)")
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        return slots
+
+    def _release(self, slots: asyncio.Semaphore) -> None:
+        self._in_flight -= 1
+        slots.release()
+
+    def _record(self, endpoint: str, prompt_tokens: int, completion_tokens: int, latency_ms: float) -> None:
+        self._stats["prompt_tokens"] += prompt_tokens
+        self._stats["completion_tokens"] += completion_tokens
+        entry = self._endpoints.setdefault(endpoint, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "latency_ms": 0.0})
+        entry["calls"] += 1
+        entry["prompt_tokens"] += prompt_tokens
+        entry["completion_tokens"] += completion_tokens
+        entry["latency_ms"] += latency_ms
+
+    async def complete(self, messages: Messages, model: Optional[str] = None, provider: str = "default",
+                       endpoint: str = "other", **params) -> ChatResult:
+        """Run one chat completion. Raises LLMError (LLMTimeout / LLMUnavailable) on failure."""
+        target = self._provider(provider)
+        model = model or self.default_model
+        slots = await self._acquire()
+        started = time.perf_counter()
+        self._stats["requests"] += 1
+        try:
+            result = await asyncio.wait_for(target.complete(messages, model, **params), self.timeout)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise LLMTimeout(f"LLM call to {model} timed out after {self.timeout:g}s")
+        except LLMError:
+            self._stats["errors"] += 1
+            raise
+        except Exception as e:
+            self._stats["errors"] += 1
+            raise LLMError(str(e)) from e
+        finally:
+            self._release(slots)
+        result.latency_ms = (time.perf_counter() - started) * 1000
+        self._latencies.append(result.latency_ms)
+        self._record(
+            endpoint,
+            result.prompt_tokens or count_message_tokens(messages),
+            result.completion_tokens or count_tokens(result.content),
+            result.latency_ms,
+        )
+        return result
+
+    async def stream(self, messages: Messages, model: Optional[str] = None, provider: str = "default",
+                     endpoint: str = "other", **params) -> AsyncIterator[str]:
+        """Yield the reply as text deltas. The concurrency slot is held until the stream ends."""
+        target = self._provider(provider)
+        model = model or self.default_model
+        slots = await self._acquire()
+        started = time.perf_counter()
+        self._stats["streams"] += 1
+        chunks = target.stream(messages, model, **params).__aiter__()
+        parts: List[str] = []
+        try:
+            while True:
+                try:
+                    delta = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    self._stats["timeouts"] += 1
+                    raise LLMTimeout(f"LLM stream from {model} stalled for {self.timeout:g}s")
+                except Exception as e:
+                    self._stats["errors"] += 1
+                    raise LLMError(str(e)) from e
+                parts.append(delta)
+                yield delta
+            latency_ms = (time.perf_counter() - started) * 1000
+            self._latencies.append(latency_ms)
+            self._record(endpoint, count_message_tokens(messages), count_tokens("".join(parts)), latency_ms)
+        finally:
+            self._release(slots)
+            await chunks.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))] if latencies else None
+        return {
+            **self._stats,
+            "providers": {name: p.name for name, p in self._providers.items()},
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "max_concurrency": self.max_concurrency,
+            "latency_p95_ms": round(p95, 1) if p95 is not None else None,
+            "endpoints": {
+                name: {
+                    "calls": int(e["calls"]),
+                    "prompt_tokens": int(e["prompt_tokens"]),
+                    "completion_tokens": int(e["completion_tokens"]),
+                    "avg_prompt_tokens": round(e["prompt_tokens"] / e["calls"]),
+                    "avg_latency_ms": round(e["latency_ms"] / e["calls"], 1),
+                }
+                for name, e in self._endpoints.items()
+            },
+        }
+
+
+async def sse_events(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Format text deltas as Server-Sent Events, ending with a ``done`` or ``error`` event."""
+    try:
+        async for delta in chunks:
+            yield f"data: {json.dumps({'delta': delta})}\n\n"
+    except LLMError as e:
+        logger.error(f"[LLM] Stream failed: {e}")
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        return
+    yield "event: done\ndata: {}\n\n"
@@ -0,0 +1,62 @@
+"""Apply pending schema migrations outside the web process.
+
+Run this before starting a deploy with DB_MIGRATE_ON_STARTUP=false so that
+workers boot with a single version check instead of DDL.
+
+Usage:
+    python migrate.py             # apply everything pending
+    python migrate.py --status    # list steps and when each was applied
+    python migrate.py --target 2  # stop after version 2
+    python migrate.py --rebuild-gl-balances      # recompute gl_account_balances
+    python migrate.py --rebuild-gl-balances 3    # ... for school 3 only
+"""
+import argparse
+import os
+import sys
+
+# Add the current directory to sys.path so we can import backend
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from backend import SCHEMA_MIGRATIONS, get_db_connection, gl_balances
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true", help="show migration status and exit")
+    parser.add_argument("--target", type=int, default=None, help="highest version to apply")
+    parser.add_argument("--rebuild-gl-balances", nargs="?", type=int, const=0, default=None, metavar="SCHOOL_ID",
+                        help="recompute materialized GL balances from posted journal lines and exit")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        if args.status:
+            current = SCHEMA_MIGRATIONS.current_version(conn)
+            print(f"Current version: {current} (head: {SCHEMA_MIGRATIONS.head})")
+            for step in SCHEMA_MIGRATIONS.status(conn):
+                applied = step["applied_at"] or "pending"
+                print(f"  {step['version']:>4}  {step['name']:<32} {applied}")
+            return 0
+
+        if args.rebuild_gl_balances is not None:
+            buckets = gl_balances.rebuild(conn, args.rebuild_gl_balances or None)
+            conn.commit()
+            print(f"Rebuilt GL balances: {buckets} bucket(s).")
+            return 0
+
+        before = SCHEMA_MIGRATIONS.current_version(conn)
+        applied = SCHEMA_MIGRATIONS.migrate(conn, target=args.target)
+        if not applied:
+            print(f"Nothing to apply; schema is at version {before}.")
+        for step in applied:
+            print(f"Applied {step.version}: {step.name}")
+        return 0
+    except Exception as e:
+        print(f"Migration failed: {e}")
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""Versioned schema migrations.
+
+Steps are registered in order with a monotonically increasing version and
+recorded in a ``schema_version`` table once applied. When the database is
+already at head, bringing it up to date costs a single ``SELECT MAX(version)``.
+
+    SCHEMA_MIGRATIONS = MigrationRegistry()
+
+    @SCHEMA_MIGRATIONS.register(4, "add widgets table")
+    def _add_widgets(conn):
+        conn.execute("CREATE TABLE IF NOT EXISTS widgets (...)")
+        conn.commit()
+
+Steps must be idempotent (IF NOT EXISTS, ON CONFLICT DO NOTHING, ...): two
+workers booting at once may both run a pending step before either records it.
+"""
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    applied_at TEXT,
+    duration_ms INTEGER
+)
+"""
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[Any], None]
+
+
+class MigrationRegistry:
+    def __init__(self):
+        self._migrations: Dict[int, Migration] = {}
+
+    def register(self, version: int, name: str):
+        def decorator(fn: Callable[[Any], None]):
+            if version in self._migrations:
+                raise ValueError(f"Duplicate migration version {version}: {name}")
+            self._migrations[version] = Migration(version, name, fn)
+            return fn
+        return decorator
+
+    @property
+    def migrations(self) -> List[Migration]:
+        return [self._migrations[v] for v in sorted(self._migrations)]
+
+    @property
+    def head(self) -> int:
+        return max(self._migrations) if self._migrations else 0
+
+    def current_version(self, conn) -> int:
+        """Highest applied version, or 0 on a database that predates the runner."""
+        try:
+            row = conn.execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+        except Exception:
+            conn.rollback()  # Postgres aborts the transaction on a missing table
+            return 0
+        if row is None:
+            return 0
+        value = row["version"] if hasattr(row, "keys") else row[0]
+        return int(value or 0)
+
+    def pending(self, conn) -> List[Migration]:
+        current = self.current_version(conn)
+        return [m for m in self.migrations if m.version > current]
+
+    def migrate(self, conn, target: Optional[int] = None) -> List[Migration]:
+        """Apply pending steps up to ``target`` (default: head). Returns the steps applied."""
+        conn.execute(SCHEMA_VERSION_DDL)
+        conn.commit()
+        applied = []
+        for migration in self.pending(conn):
+            if target is not None and migration.version > target:
+                break
+            logger.info(f"[MIGRATE] Applying {migration.version}: {migration.name}")
+            started = time.perf_counter()
+            try:
+                migration.apply(conn)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                logger.exception(f"[MIGRATE] Step {migration.version} ({migration.name}) failed")
+                raise
+            duration_ms = int((time.perf_counter() - started) * 1000)
+            try:
+                conn.execute(
+                    "INSERT INTO schema_version (version, name, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                    (migration.version, migration.name, datetime.now().isoformat(), duration_ms),
+                )
+                conn.commit()
+            except Exception as e:
+                # Another worker recorded it first; the step itself is idempotent.
+                conn.rollback()
+                logger.info(f"[MIGRATE] Version {migration.version} already recorded: {e}")
+            applied.append(migration)
+            logger.info(f"[MIGRATE] Applied {migration.version} in {duration_ms} ms")
+        return applied
+
+    def status(self, conn) -> List[Dict[str, Any]]:
+        """Every registered step with its applied_at (None when pending)."""
+        try:
+            rows = conn.execute("SELECT version, applied_at, duration_ms FROM schema_version").fetchall()
+            recorded = {int(r[0]): (r[1], r[2]) for r in rows}
+        except Exception:
+            conn.rollback()
+            recorded = {}
+        return [
+            {
+                "version": m.version,
+                "name": m.name,
+                "applied_at": recorded.get(m.version, (None, None))[0],
+                "duration_ms": recorded.get(m.version, (None, None))[1],
+            }
+            for m in self.migrations
+        ]
@@ -0,0 +1,257 @@
+"""Durable notification outbox and its background dispatcher.
+
+Request handlers call ``enqueue`` inside their own transaction, so a
+notification is recorded if and only if the business change commits, and then
+return. A ``OutboxDispatcher`` thread per worker claims due rows in batches,
+hands each channel's batch to its handler (in-app messages, email, ...) and
+records the outcome:
+
+    pending --claim--> sending --ok--> sent
+                          |--error--> pending (next_attempt_at = now + backoff)
+                          '--permanent error / max attempts--> failed
+
+Handlers of ``external_channels`` (email) are called with no connection: the
+claim is committed and the connection returned before they start, and their
+results are recorded on a fresh connection, so a slow, rate-limited SMTP
+batch holds neither a pooled connection nor an open transaction.
+
+Claims are made with a per-batch token, so several worker processes can run
+dispatchers against the same table. A claim left behind by a crashed worker is
+released after ``lease_seconds``. Delivery is at-least-once.
+"""
+import logging
+import random
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from backend.db_bulk import chunked, insert_rows, sql_placeholders
+except Exception:
+    from db_bulk import chunked, insert_rows, sql_placeholders
+
+logger = logging.getLogger(__name__)
+
+CHANNEL_MESSAGE = "message"  # in-app inbox row in the messages table
+CHANNEL_EMAIL = "email"      # external email via the email transport
+
+OUTBOX_COLUMNS = ("channel", "sender_id", "recipient", "subject", "body", "status", "attempts", "next_attempt_at", "created_at")
+
+
+class UndeliverableError(Exception):
+    """Never retry this row (e.g. no handler for its channel)."""
+
+
+def outbox_ddl(pk_def: str) -> List[str]:
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id {pk_def},
+            channel TEXT NOT NULL,
+            sender_id TEXT,
+            recipient TEXT NOT NULL,
+            subject TEXT,
+            body TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TEXT,
+            claimed_by TEXT,
+            claimed_at TEXT,
+            last_error TEXT,
+            created_at TEXT,
+            sent_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_notification_outbox_due ON notification_outbox (status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS ix_notification_outbox_claim ON notification_outbox (claimed_by)",
+    ]
+
+
+def enqueue(cursor, channel: str, rows: Sequence[Tuple[Optional[str], str, str, str]]) -> int:
+    """Queue (sender_id, recipient, subject, body) rows on ``channel``. Does not commit."""
+    now = datetime.now().isoformat()
+    return insert_rows(
+        cursor, "notification_outbox", OUTBOX_COLUMNS,
+        [(channel, sender, recipient, subject, body, "pending", 0, now, now) for sender, recipient, subject, body in rows],
+    )
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with +/-20% jitter: base, 2*base, 4*base, ... capped at ``cap``."""
+    return min(cap, base * (2 ** max(0, attempt - 1))) * random.uniform(0.8, 1.2)
+
+
+# A channel handler receives a connection (None for external channels) and the
+# claimed rows, and returns {row_id: None | exception}.
+ChannelHandler = Callable[[Any, List[Any]], Dict[int, Optional[Exception]]]
+
+
+class OutboxDispatcher:
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        handlers: Dict[str, ChannelHandler],
+        batch_size: int = 100,
+        poll_interval: float = 2.0,
+        max_attempts: int = 6,
+        backoff_base: float = 30.0,
+        backoff_max: float = 3600.0,
+        lease_seconds: float = 300.0,
+        permanent_errors: Tuple[type, ...] = (),
+        on_stop: Optional[Callable[[], None]] = None,
+        external_channels: Sequence[str] = (),
+    ):
+        self._connect = connect
+        self._handlers = handlers
+        self.external_channels = frozenset(external_channels)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self._permanent_errors = (UndeliverableError,) + tuple(permanent_errors)
+        self._on_stop = on_stop
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._stats = {"sent": 0, "retried": 0, "failed": 0, "batches": 0}
+        self._last_error: Optional[str] = None
+
+    # -- one pass ----------------------------------------------------------
+    def _claim(self, conn, now: datetime) -> List[Any]:
+        now_iso = now.isoformat()
+        lease_cutoff = (now - timedelta(seconds=self.lease_seconds)).isoformat()
+        conn.execute(
+            "UPDATE notification_outbox SET status = 'pending', claimed_by = NULL WHERE status = 'sending' AND claimed_at < ?",
+            (lease_cutoff,),
+        )
+        due = conn.execute(
+            "SELECT id FROM notification_outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (now_iso, self.batch_size),
+        ).fetchall()
+        ids = [r["id"] for r in due]
+        if not ids:
+            conn.commit()
+            return []
+        token = uuid.uuid4().hex
+        conn.execute(
+            f"UPDATE notification_outbox SET status = 'sending', claimed_by = ?, claimed_at = ? "
+            f"WHERE status = 'pending' AND id IN ({sql_placeholders(len(ids))})",
+            [token, now_iso, *ids],
+        )
+        conn.commit()
+        return conn.execute(
+            "SELECT * FROM notification_outbox WHERE claimed_by = ? AND status = 'sending' ORDER BY id", (token,)
+        ).fetchall()
+
+    def _record(self, conn, items: List[Any], results: Dict[int, Optional[Exception]]) -> None:
+        now = datetime.now()
+        sent_ids = [i["id"] for i in items if i["id"] in results and results[i["id"]] is None]
+        for chunk in chunked(sent_ids):
+            conn.execute(
+                f"UPDATE notification_outbox SET status = 'sent', sent_at = ?, claimed_by = NULL, last_error = NULL "
+                f"WHERE id IN ({sql_placeholders(len(chunk))})",
+                [now.isoformat(), *chunk],
+            )
+        self._stats["sent"] += len(sent_ids)
+
+        sent = set(sent_ids)
+        for item in items:
+            if item["id"] in sent:
+                continue
+            err = results.get(item["id"]) or RuntimeError("handler returned no result")
+            attempts = int(item["attempts"] or 0) + 1
+            if isinstance(err, self._permanent_errors) or attempts >= self.max_attempts:
+                status, next_at = "failed", item["next_attempt_at"]
+                self._stats["failed"] += 1
+                logger.warning(f"[OUTBOX] Giving up on #{item['id']} ({item['channel']} to {item['recipient']}): {err}")
+            else:
+                status = "pending"
+                next_at = (now + timedelta(seconds=backoff_delay(attempts, self.backoff_base, self.backoff_max))).isoformat()
+                self._stats["retried"] += 1
+            conn.execute(
+                "UPDATE notification_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, claimed_by = NULL WHERE id = ?",
+                (status, attempts, next_at, str(err)[:500], item["id"]),
+            )
+        conn.commit()
+
+    def _deliver(self, conn, channel: str, items: List[Any]) -> Dict[int, Optional[Exception]]:
+        handler = self._handlers.get(channel)
+        if handler is None:
+            err = UndeliverableError(f"No handler for channel '{channel}'")
+            return {i["id"]: err for i in items}
+        try:
+            return handler(conn, items)
+        except Exception as e:
+            if conn is not None:
+                conn.rollback()
+            logger.warning(f"[OUTBOX] {channel} batch of {len(items)} failed: {e}")
+            return {i["id"]: e for i in items}
+
+    def dispatch_once(self) -> int:
+        """Claim and deliver one batch. Returns the number of rows processed."""
+        external: Dict[str, List[Any]] = {}
+        conn = self._connect()
+        try:
+            items = self._claim(conn, datetime.now())
+            if not items:
+                return 0
+            by_channel: Dict[str, List[Any]] = {}
+            for item in items:
+                target = external if item["channel"] in self.external_channels else by_channel
+                target.setdefault(item["channel"], []).append(item)
+            # Record each channel as soon as it is done.
+            for channel, channel_items in by_channel.items():
+                self._record(conn, channel_items, self._deliver(conn, channel, channel_items))
+        finally:
+            conn.close()
+
+        for channel, channel_items in external.items():
+            results = self._deliver(None, channel, channel_items)
+            conn = self._connect()
+            try:
+                self._record(conn, channel_items, results)
+            finally:
+                conn.close()
+        self._stats["batches"] += 1
+        return len(items)
+
+    # -- background thread -------------------------------------------------
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.clear()
+            processed = 0
+            try:
+                processed = self.dispatch_once()
+                self._last_error = None
+            except Exception as e:
+                self._last_error = str(e)
+                logger.error(f"[OUTBOX] Dispatch failed: {e}")
+            if processed < self.batch_size:
+                self._wake.wait(self.poll_interval)
+        if self._on_stop:
+            self._on_stop()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "running": bool(self._thread and self._thread.is_alive()),
+            "last_error": self._last_error,
+        }
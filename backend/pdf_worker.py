@@ -0,0 +1,40 @@
+"""PDF text extraction run inside ``TextExtractionService`` worker processes.
+
+Kept apart from ``text_extraction`` and free of app imports so that a worker
+(and the forkserver it is forked from) only loads this module and pypdf.
+"""
+import time
+from typing import List, Tuple
+
+
+def _extract_pdf(data: bytes, max_pages: int, timeout: float, max_chars: int) -> Tuple[str, int, bool]:
+    """Runs in a worker process: (text, pages read, truncated)."""
+    from io import BytesIO
+
+    from pypdf import PdfReader
+
+    deadline = time.monotonic() + timeout
+    reader = PdfReader(BytesIO(data))
+    total = len(reader.pages)
+    parts: List[str] = []
+    size = 0
+    read = 0
+    for page in reader.pages[:max_pages]:
+        if time.monotonic() > deadline or size >= max_chars:
+            break
+        text = page.extract_text() or ""
+        parts.append(text)
+        size += len(text) + 1
+        read += 1
+    text = "\n".join(parts)
+    return text[:max_chars], read, read < total or len(text) > max_chars
+
+
+def extract_pdf_worker(conn, data: bytes, max_pages: int, timeout: float, max_chars: int) -> None:
+    """Worker process entry point: sends ("ok", result) or ("error", message) back over ``conn``."""
+    try:
+        conn.send(("ok", _extract_pdf(data, max_pages, timeout, max_chars)))
+    except Exception as e:
+        conn.send(("error", str(e) or type(e).__name__))
+    finally:
+        conn.close()
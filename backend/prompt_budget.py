@@ -0,0 +1,170 @@
+"""Token-budgeted system prompts.
+
+The tutor and teacher co-pilot prompts were f-strings that pasted in the
+schema, the whole instruction block, the library list, activity history and
+resource excerpts, so their size was unbounded and never measured.
+``PromptAssembler`` builds them from:
+
+* a ``StaticPrefix`` -- the invariant instructions (modes, schema, output
+  format), rendered once at import. It is always the first part of the
+  prompt, byte-for-byte identical between requests, so provider-side prompt
+  caching can reuse it, and its token count is computed once;
+* ``PromptSection``\\ s for the per-request context, each optionally capped at
+  ``max_tokens``. When the total is still over the budget, sections are
+  trimmed lowest ``priority`` first (and dropped if nothing fits), cutting
+  from the end of the section by default, at line boundaries where possible.
+
+``count_tokens`` uses tiktoken's cl100k_base encoding when it is installed and
+otherwise an estimate (one token per word, one per four characters of long
+words, one per punctuation mark), which is close enough for budgeting.
+"""
+import math
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _ENCODING = None
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+TRIM_MARKER = "[... trimmed to fit the prompt budget]"
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return sum(max(1, math.ceil(len(piece) / 4)) for piece in _PIECE_RE.findall(text))
+
+
+def count_message_tokens(messages: Sequence[Dict[str, str]]) -> int:
+    # ~4 tokens of chat-format overhead per message.
+    return sum(count_tokens(m.get("content") or "") + 4 for m in messages)
+
+
+def trim_to_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """Cut ``text`` to about ``max_tokens`` at line boundaries.
+
+    ``keep="head"`` keeps the first lines (e.g. newest-first history),
+    ``keep="tail"`` the last ones.
+    """
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    budget = max_tokens - count_tokens(TRIM_MARKER)
+    lines = text.splitlines()
+    if keep == "tail":
+        lines.reverse()
+    kept: List[str] = []
+    used = 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            # Keep as many words of the line that doesn't fit as the budget allows.
+            words = line.split()
+            if keep == "tail":
+                words.reverse()
+            lo, hi = 0, len(words)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if count_tokens(" ".join(words[:mid])) + 1 <= budget - used:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            if lo:
+                part = words[:lo]
+                if keep == "tail":
+                    part.reverse()
+                kept.append(" ".join(part))
+            break
+        kept.append(line)
+        used += cost
+    if keep == "tail":
+        kept.reverse()
+        return "\n".join([TRIM_MARKER] + kept)
+    return "\n".join(kept + [TRIM_MARKER])
+
+
+class StaticPrefix:
+    """Invariant instructions shared by every request of one prompt kind."""
+
+    def __init__(self, text: str):
+        self.text = text.strip()
+        self.tokens = count_tokens(self.text)
+
+
+@dataclass
+class PromptSection:
+    name: str
+    text: str
+    priority: int = 0                 # trimmed later than sections with a lower priority
+    max_tokens: Optional[int] = None  # cap applied before the overall budget
+    keep: str = "head"
+
+
+@dataclass
+class AssembledPrompt:
+    text: str
+    tokens: int
+    sections: Dict[str, int] = field(default_factory=dict)  # tokens per section after trimming
+    trimmed: List[str] = field(default_factory=list)
+
+
+class PromptAssembler:
+    def __init__(self, budget: int = 6000):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._stats = {"assembled": 0, "over_budget": 0, "trimmed_sections": 0, "dropped_sections": 0, "tokens": 0}
+
+    def assemble(self, prefix: StaticPrefix, sections: Sequence[PromptSection]) -> AssembledPrompt:
+        texts: Dict[str, str] = {}
+        sizes: Dict[str, int] = {}
+        trimmed: List[str] = []
+        for section in sections:
+            text = (section.text or "").strip()
+            if section.max_tokens is not None and count_tokens(text) > section.max_tokens:
+                text = trim_to_tokens(text, section.max_tokens, section.keep)
+                trimmed.append(section.name)
+            texts[section.name] = text
+            sizes[section.name] = count_tokens(text)
+
+        overflow = prefix.tokens + sum(sizes.values()) - self.budget
+        over_budget = overflow > 0
+        for section in sorted(sections, key=lambda s: s.priority):
+            if overflow <= 0:
+                break
+            size = sizes[section.name]
+            if not size:
+                continue
+            target = size - overflow
+            text = trim_to_tokens(texts[section.name], target, section.keep) if target > count_tokens(TRIM_MARKER) else ""
+            if section.name not in trimmed:
+                trimmed.append(section.name)
+            texts[section.name] = text
+            sizes[section.name] = count_tokens(text)
+            overflow -= size - sizes[section.name]
+
+        body = "\n\n".join(texts[s.name] for s in sections if texts[s.name])
+        text = f"{prefix.text}\n\n{body}" if body else prefix.text
+        tokens = prefix.tokens + sum(sizes.values())
+        with self._lock:
+            self._stats["assembled"] += 1
+            self._stats["over_budget"] += over_budget
+            self._stats["trimmed_sections"] += len(trimmed)
+            self._stats["dropped_sections"] += sum(1 for s in sections if s.text and not texts[s.name])
+            self._stats["tokens"] += tokens
+        return AssembledPrompt(text, tokens, sizes, trimmed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        assembled = stats.pop("tokens")
+        return {**stats, "avg_tokens": round(assembled / stats["assembled"]) if stats["assembled"] else None,
+                "budget": self.budget, "tokenizer": "cl100k_base" if _ENCODING is not None else "estimate"}
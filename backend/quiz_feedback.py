@@ -0,0 +1,284 @@
+"""Background AI feedback for quiz attempts.
+
+``submit_quiz`` used to wait for an LLM "assessment" before it saved the
+attempt, so students waited on the model and a hung call lost the
+submission. Now the attempt is scored and committed straight away, together
+with a ``quiz_feedback_jobs`` row (``enqueue``, same transaction), and a
+``QuizFeedbackWorker`` task on the API's event loop fills in
+``quiz_attempts.ai_feedback`` / ``activities.ai_feedback`` afterwards:
+
+    pending --claim--> running --ok--> done
+                          |--error--> pending (next_attempt_at = now + backoff)
+                          '--max attempts--> failed (the deterministic feedback stays)
+
+Claims use a per-batch token and a lease like the notification outbox, so
+several workers can share the table and a claim left by a crashed worker is
+picked up again after ``lease_seconds``. A pass claims at most ``per_school``
+jobs of each school (up to ``batch_size`` in all, schools interleaved), so one
+school grading a large class cannot fill the batch; its remaining jobs are
+claimed by the following passes, which run back to back while work is due.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+try:
+    from backend.db_bulk import sql_placeholders
+    from backend.outbox import backoff_delay
+except Exception:
+    from db_bulk import sql_placeholders
+    from outbox import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+def feedback_jobs_ddl(pk_def: str) -> List[str]:
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS quiz_feedback_jobs (
+            id {pk_def},
+            attempt_id INTEGER NOT NULL,
+            activity_id INTEGER,
+            student_id TEXT,
+            school_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TEXT,
+            claimed_by TEXT,
+            claimed_at TEXT,
+            last_error TEXT,
+            created_at TEXT,
+            finished_at TEXT,
+            FOREIGN KEY (attempt_id) REFERENCES quiz_attempts(id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_quiz_feedback_jobs_due ON quiz_feedback_jobs (status, next_attempt_at)",
+        "CREATE INDEX IF NOT EXISTS ix_quiz_feedback_jobs_attempt ON quiz_feedback_jobs (attempt_id)",
+    ]
+
+
+def enqueue(cursor, attempt_id: int, activity_id: Optional[int], student_id: Optional[str], school_id: Optional[int]) -> None:
+    """Queue feedback for one attempt. Does not commit."""
+    now = datetime.now().isoformat()
+    cursor.execute(
+        "INSERT INTO quiz_feedback_jobs (attempt_id, activity_id, student_id, school_id, status, attempts, next_attempt_at, created_at) "
+        "VALUES (?, ?, ?, ?, ?, 0, ?, ?)",
+        (attempt_id, activity_id, student_id, school_id, STATUS_PENDING, now, now),
+    )
+
+
+class QuizFeedbackWorker:
+    """Claims due jobs and generates their feedback.
+
+    ``build_messages(conn, job)`` returns the chat messages for a job (or None
+    if its attempt is gone) and ``complete(messages)`` the model's text. Both
+    database steps run through ``run_blocking`` so the event loop never waits
+    on the database. ``on_saved(job)`` runs after feedback is written.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        build_messages: Callable[[Any, Any], Optional[List[Dict[str, str]]]],
+        complete: Callable[[List[Dict[str, str]]], Awaitable[str]],
+        run_blocking: Callable[..., Awaitable[Any]],
+        on_saved: Optional[Callable[[Any], None]] = None,
+        batch_size: int = 20,
+        per_school: int = 2,
+        poll_interval: float = 5.0,
+        max_attempts: int = 3,
+        backoff_base: float = 30.0,
+        backoff_max: float = 900.0,
+        lease_seconds: float = 300.0,
+    ):
+        self._connect = connect
+        self._build_messages = build_messages
+        self._complete = complete
+        self._run_blocking = run_blocking
+        self._on_saved = on_saved
+        self.batch_size = batch_size
+        self.per_school = max(1, per_school)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self._school_slots: Dict[Any, asyncio.Semaphore] = {}
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"done": 0, "retried": 0, "failed": 0, "batches": 0}
+        self._last_error: Optional[str] = None
+
+    # -- database steps (run_blocking) --------------------------------------
+    def _claim(self) -> List[Any]:
+        now = datetime.now()
+        now_iso = now.isoformat()
+        lease_cutoff = (now - timedelta(seconds=self.lease_seconds)).isoformat()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE quiz_feedback_jobs SET status = 'pending', claimed_by = NULL WHERE status = 'running' AND claimed_at < ?",
+                (lease_cutoff,),
+            )
+            # At most per_school jobs of each school, schools interleaved, so a
+            # large class cannot fill the batch and leave the others waiting.
+            due = conn.execute(
+                "SELECT id FROM ("
+                " SELECT id, ROW_NUMBER() OVER (PARTITION BY school_id ORDER BY id) AS school_rank"
+                " FROM quiz_feedback_jobs WHERE status = 'pending' AND next_attempt_at <= ?"
+                ") due WHERE school_rank <= ? ORDER BY school_rank, id LIMIT ?",
+                (now_iso, self.per_school, self.batch_size),
+            ).fetchall()
+            ids = [r["id"] for r in due]
+            if not ids:
+                conn.commit()
+                return []
+            token = uuid.uuid4().hex
+            conn.execute(
+                f"UPDATE quiz_feedback_jobs SET status = 'running', claimed_by = ?, claimed_at = ? "
+                f"WHERE status = 'pending' AND id IN ({sql_placeholders(len(ids))})",
+                [token, now_iso, *ids],
+            )
+            conn.commit()
+            return conn.execute(
+                "SELECT * FROM quiz_feedback_jobs WHERE claimed_by = ? AND status = 'running' ORDER BY id", (token,)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def _messages(self, job) -> Optional[List[Dict[str, str]]]:
+        conn = self._connect()
+        try:
+            return self._build_messages(conn, job)
+        finally:
+            conn.close()
+
+    def _save(self, job, feedback: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE quiz_attempts SET ai_feedback = ? WHERE id = ?", (feedback, job["attempt_id"]))
+            if job["activity_id"]:
+                conn.execute("UPDATE activities SET ai_feedback = ? WHERE id = ?", (feedback, job["activity_id"]))
+            conn.execute(
+                "UPDATE quiz_feedback_jobs SET status = ?, attempts = ?, claimed_by = NULL, last_error = NULL, finished_at = ? WHERE id = ?",
+                (STATUS_DONE, int(job["attempts"] or 0) + 1, datetime.now().isoformat(), job["id"]),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _record_failure(self, job, error: Exception, permanent: bool = False) -> None:
+        attempts = int(job["attempts"] or 0) + 1
+        now = datetime.now()
+        if permanent or attempts >= self.max_attempts:
+            status, next_at, finished_at = STATUS_FAILED, job["next_attempt_at"], now.isoformat()
+            self._stats["failed"] += 1
+            logger.warning(f"[QuizFeedback] Giving up on attempt #{job['attempt_id']}: {error}")
+        else:
+            status, finished_at = STATUS_PENDING, None
+            next_at = (now + timedelta(seconds=backoff_delay(attempts, self.backoff_base, self.backoff_max))).isoformat()
+            self._stats["retried"] += 1
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE quiz_feedback_jobs SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, "
+                "claimed_by = NULL, finished_at = ? WHERE id = ?",
+                (status, attempts, next_at, str(error)[:500], finished_at, job["id"]),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    # -- async side ----------------------------------------------------------
+    def _slots(self, school_id) -> asyncio.Semaphore:
+        slots = self._school_slots.get(school_id)
+        if slots is None:
+            slots = self._school_slots[school_id] = asyncio.Semaphore(self.per_school)
+        return slots
+
+    async def _process(self, job) -> None:
+        try:
+            messages = await self._run_blocking(self._messages, job)
+            if messages is None:
+                await self._run_blocking(self._record_failure, job, LookupError("attempt no longer exists"), True)
+                return
+            async with self._slots(job["school_id"]):
+                feedback = (await self._complete(messages) or "").strip()
+            if not feedback:
+                raise ValueError("empty feedback")
+            await self._run_blocking(self._save, job, feedback)
+            self._stats["done"] += 1
+        except Exception as e:
+            logger.warning(f"[QuizFeedback] Attempt #{job['attempt_id']} failed: {e}")
+            try:
+                await self._run_blocking(self._record_failure, job, e)
+            except Exception as record_error:
+                logger.error(f"[QuizFeedback] Could not record failure for job #{job['id']}: {record_error}")
+            return
+        if self._on_saved:
+            try:
+                self._on_saved(job)
+            except Exception as e:
+                logger.warning(f"[QuizFeedback] on_saved failed for attempt #{job['attempt_id']}: {e}")
+
+    async def run_once(self) -> int:
+        """Claim and process one batch. Returns the number of jobs processed."""
+        jobs = await self._run_blocking(self._claim)
+        if jobs:
+            await asyncio.gather(*(self._process(job) for job in jobs))
+            self._stats["batches"] += 1
+        return len(jobs)
+
+    async def _run(self) -> None:
+        while True:
+            self._wake.clear()
+            processed = 0
+            try:
+                processed = await self.run_once()
+                self._last_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._last_error = str(e)
+                logger.error(f"[QuizFeedback] Worker pass failed: {e}")
+            if not processed:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def wake(self) -> None:
+        if self._wake is not None:
+            self._wake.set()
+
+    def start(self) -> None:
+        """Start the worker on the running event loop."""
+        if self._task is not None and not self._task.done():
+            return
+        self._wake = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="quiz-feedback-worker")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "running": bool(self._task and not self._task.done()),
+            "per_school": self.per_school,
+            "last_error": self._last_error,
+        }
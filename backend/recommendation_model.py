@@ -0,0 +1,377 @@
+"""Lifecycle for the difficulty-recommendation model.
+
+The model used to be refitted over the whole activities table on every
+dashboard request. Instead it is now:
+
+* trained on a background thread, every ``interval`` seconds or as soon as
+  ``retrain_after`` new activities have been reported via ``notify_new_activities``;
+* persisted to ``path`` together with a version number and a data watermark
+  (the highest activities.id it was trained on), written atomically so other
+  workers can pick it up;
+* loaded lazily on first use, so startup never waits on training;
+* retried with exponential backoff (``retry_base`` doubling up to
+  ``retry_max``) when training raises; without a model the state is then
+  ``failed`` rather than ``training``, with the error in ``status()``;
+* served from a compiled copy of the forest (flat numpy arrays traversed for
+  all trees at once), which predicts one row well under a millisecond and a
+  whole class roster in a single vectorised call.
+"""
+import logging
+import os
+import threading
+import time
+import warnings
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+try:
+    from backend.outbox import backoff_delay
+except Exception:
+    from outbox import backoff_delay
+
+logger = logging.getLogger(__name__)
+
+FEATURES = ("score", "time_spent_min")
+MODEL_FORMAT = 1
+
+
+class CompiledForest:
+    """A fitted RandomForestClassifier flattened into numpy arrays.
+
+    Produces the same predictions as ``clf.predict`` (mean of per-tree class
+    probabilities, argmax over ``classes_``) without sklearn's per-call overhead.
+    """
+
+    def __init__(self, clf):
+        import numpy as np
+
+        features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+        offset, depth = 0, 0
+        for est in clf.estimators_:
+            tree = est.tree_
+            n = tree.node_count
+            left = tree.children_left.astype(np.int64)
+            right = tree.children_right.astype(np.int64)
+            roots.append(offset)
+            lefts.append(np.where(left >= 0, left + offset, -1))
+            rights.append(np.where(right >= 0, right + offset, -1))
+            features.append(np.maximum(tree.feature, 0))
+            thresholds.append(tree.threshold)
+            value = tree.value[:, 0, :].astype(np.float64)
+            totals = value.sum(axis=1, keepdims=True)
+            totals[totals == 0] = 1.0
+            values.append(value / totals)
+            depth = max(depth, tree.max_depth)
+            offset += n
+
+        self.feature = np.concatenate(features)
+        self.threshold = np.concatenate(thresholds)
+        self.left = np.concatenate(lefts)
+        self.right = np.concatenate(rights)
+        self.value = np.concatenate(values)
+        self.roots = np.asarray(roots, dtype=np.int64)
+        self.max_depth = depth
+        self.classes = np.asarray(clf.classes_)
+
+    def predict_proba(self, X):
+        import numpy as np
+
+        X = np.asarray(X, dtype=np.float32)  # sklearn compares in float32
+        n = X.shape[0]
+        node = np.tile(self.roots, (n, 1))
+        rows = np.arange(n)[:, None]
+        for _ in range(self.max_depth + 1):
+            left = self.left[node]
+            is_leaf = left < 0
+            if is_leaf.all():
+                break
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(is_leaf, node, np.where(go_left, left, self.right[node]))
+        return self.value[node].mean(axis=1)
+
+    def predict(self, X):
+        return self.classes[self.predict_proba(X).argmax(axis=1)]
+
+
+@dataclass
+class TrainedModel:
+    version: int
+    trained_at: str
+    watermark: int
+    n_samples: int
+    estimator: Any
+    forest: CompiledForest = field(repr=False, default=None)
+
+    def __post_init__(self):
+        if self.forest is None:
+            self.forest = CompiledForest(self.estimator)
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "trained_at": self.trained_at,
+            "watermark": self.watermark,
+            "n_samples": self.n_samples,
+        }
+
+
+class RecommendationModelManager:
+    """Owns the current model, its on-disk copy and the background trainer.
+
+    ``load_training_data()`` must return a DataFrame with columns id, score,
+    time_spent_min and difficulty. ``count_new_since(watermark)`` returns how
+    many activities have an id above ``watermark``.
+    """
+
+    def __init__(
+        self,
+        load_training_data: Callable[[], Any],
+        count_new_since: Callable[[int], int],
+        label_encoding: Dict[str, int],
+        path: str,
+        min_samples: int = 5,
+        retrain_after: int = 50,
+        interval: float = 3600.0,
+        n_estimators: int = 50,
+        retry_base: float = 30.0,
+        retry_max: Optional[float] = None,
+    ):
+        self._load_training_data = load_training_data
+        self._count_new_since = count_new_since
+        self._label_encoding = label_encoding
+        self.path = path
+        self.min_samples = min_samples
+        self.retrain_after = retrain_after
+        self.interval = interval
+        self.n_estimators = n_estimators
+        self.retry_base = retry_base
+        self.retry_max = interval if retry_max is None else retry_max
+
+        self._model: Optional[TrainedModel] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._train_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._new_activities = 0
+        self._last_error: Optional[str] = None
+        self._failures = 0  # consecutive failed fits
+        self._retry_at: Optional[float] = None  # time.monotonic() of the next attempt after a failure
+        self._too_few_samples: Optional[int] = None  # sample count of the last refused fit
+
+    # -- model access ----------------------------------------------------
+    @property
+    def model(self) -> Optional[TrainedModel]:
+        """Current model, loading the persisted copy on first access."""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._model = self._read_from_disk()
+                    self._loaded = True
+                    if self._model is None:
+                        self.request_retrain()
+        return self._model
+
+    @property
+    def state(self) -> str:
+        """``ready``, ``training`` (no model yet, first fit pending), ``insufficient_data`` or ``failed``."""
+        if self.model is not None:
+            return "ready"
+        return self._state_without_model()
+
+    def _state_without_model(self) -> str:
+        if self._too_few_samples is not None:
+            return "insufficient_data"
+        return "failed" if self._failures else "training"
+
+    def retry_in(self) -> Optional[float]:
+        """Seconds until training is retried after a failure, or None when it has not failed."""
+        retry_at = self._retry_at
+        return None if retry_at is None else max(0.0, retry_at - time.monotonic())
+
+    def predict(self, score: float, time_spent_min: float) -> Optional[int]:
+        preds = self.predict_batch([(score, time_spent_min)])
+        return preds[0] if preds else None
+
+    def predict_batch(self, rows: Sequence[Tuple[float, float]]) -> Optional[List[int]]:
+        """Encoded difficulty per (score, time_spent_min) row, or None when no model is ready."""
+        model = self.model
+        if model is None:
+            return None
+        if not rows:
+            return []
+        return [int(p) for p in model.forest.predict(rows)]
+
+    # -- training --------------------------------------------------------
+    def train_now(self) -> Optional[TrainedModel]:
+        """Fit on the full activities table, persist, and swap the model in.
+
+        A failure is recorded (``failed`` state, ``last_error``, next retry
+        time) and re-raised.
+        """
+        with self._train_lock:
+            try:
+                model = self._train()
+            except Exception as e:
+                with self._lock:
+                    self._too_few_samples = None
+                    self._failures += 1
+                    self._last_error = str(e) or type(e).__name__
+                    self._retry_at = time.monotonic() + backoff_delay(self._failures, self.retry_base, self.retry_max)
+                raise
+            with self._lock:
+                self._failures = 0
+                self._last_error = None
+                self._retry_at = None
+            return model
+
+    def _train(self) -> Optional[TrainedModel]:
+        df = self._load_training_data()
+        if df is not None:
+            df = df.dropna(subset=list(FEATURES))
+        if df is None or len(df) < self.min_samples:
+            self._too_few_samples = 0 if df is None else len(df)
+            logger.info(f"[RECOMMENDER] {0 if df is None else len(df)} activities; need {self.min_samples} to train.")
+            return None
+        from sklearn.ensemble import RandomForestClassifier
+
+        X = df[list(FEATURES)].astype(float).values
+        y = [self._label_encoding.get(d, 1) for d in df["difficulty"]]
+        started = time.perf_counter()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            clf = RandomForestClassifier(n_estimators=self.n_estimators, random_state=42)
+            clf.fit(X, y)
+
+        current = self._model or self._read_from_disk()
+        model = TrainedModel(
+            version=(current.version + 1) if current else 1,
+            trained_at=datetime.now().isoformat(),
+            watermark=int(df["id"].max()) if "id" in df and len(df) else 0,
+            n_samples=len(df),
+            estimator=clf,
+        )
+        self._write_to_disk(model)
+        with self._lock:
+            self._model = model
+            self._loaded = True
+            self._new_activities = 0
+            self._too_few_samples = None
+        logger.info(
+            f"[RECOMMENDER] Trained version {model.version} on {model.n_samples} activities "
+            f"(watermark {model.watermark}) in {(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+        return model
+
+    def notify_new_activities(self, count: int = 1) -> None:
+        """Record new activities; wakes the trainer once ``retrain_after`` accumulate.
+
+        Until a first model exists every new activity wakes it, so a school that
+        starts below ``min_samples`` gets a model as soon as it has enough data.
+        """
+        with self._lock:
+            self._new_activities += count
+            due = self._new_activities >= self.retrain_after or self._model is None
+        if due:
+            self.request_retrain()
+
+    def request_retrain(self) -> None:
+        self._wake.set()
+
+    # -- persistence -----------------------------------------------------
+    def _read_from_disk(self) -> Optional[TrainedModel]:
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            import joblib
+
+            payload = joblib.load(self.path)
+            if payload.get("format") != MODEL_FORMAT:
+                logger.info(f"[RECOMMENDER] Ignoring model at {self.path} (format {payload.get('format')})")
+                return None
+            meta = payload["metadata"]
+            return TrainedModel(estimator=payload["estimator"], **meta)
+        except Exception as e:
+            logger.warning(f"[RECOMMENDER] Could not load model from {self.path}: {e}")
+            return None
+
+    def _write_to_disk(self, model: TrainedModel) -> None:
+        if not self.path:
+            return
+        try:
+            import joblib
+
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            joblib.dump({"format": MODEL_FORMAT, "metadata": model.metadata(), "estimator": model.estimator}, tmp_path)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"[RECOMMENDER] Could not persist model to {self.path}: {e}")
+
+    def _refresh_from_disk(self) -> bool:
+        """Adopt a newer model written by another worker. Returns True if one was adopted."""
+        disk = self._read_from_disk()
+        current = self._model
+        if disk is not None and (current is None or disk.version > current.version):
+            with self._lock:
+                self._model = disk
+                self._loaded = True
+            return True
+        return False
+
+    # -- background trainer ----------------------------------------------
+    def _needs_training(self, threshold: int) -> bool:
+        model = self._model
+        if model is None:
+            return True
+        try:
+            return self._count_new_since(model.watermark) >= threshold
+        except Exception as e:
+            logger.warning(f"[RECOMMENDER] Could not check for new activities: {e}")
+            return False
+
+    def _run(self) -> None:
+        # Lazy load happens here, off the request path.
+        _ = self.model
+        scheduled = False
+        while not self._stop.is_set():
+            self._wake.clear()
+            try:
+                self._refresh_from_disk()
+                # On the schedule any new data is worth a refit; otherwise wait for a batch.
+                # After a failure, new activities do not cut the backoff short.
+                if not self.retry_in() and self._needs_training(1 if scheduled else self.retrain_after):
+                    self.train_now()
+                if not self._failures:
+                    self._last_error = None
+            except Exception as e:
+                self._last_error = str(e)
+                logger.error(f"[RECOMMENDER] Background training failed: {e}")
+            retry_in = self.retry_in()
+            scheduled = not self._wake.wait(self.interval if retry_in is None else min(retry_in, self.interval))
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="recommender-trainer", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+
+    def status(self) -> Dict[str, Any]:
+        model = self._model
+        return {
+            "loaded": model is not None,
+            "state": "ready" if model is not None else self._state_without_model(),
+            **(model.metadata() if model else {}),
+            "pending_activities": self._new_activities,
+            "trainer_running": bool(self._thread and self._thread.is_alive()),
+            "last_error": self._last_error,
+            "consecutive_failures": self._failures,
+            "retry_in": self.retry_in(),
+        }
@@ -0,0 +1,123 @@
+"""Full-text search over the resource library.
+
+The AI tutor used to load every resource row of the school, extracted text
+included, and look for resource titles inside the question in Python. The
+database now keeps a ranked full-text index over title, description and
+extracted_text:
+
+* SQLite: an external-content FTS5 table ``resources_fts`` kept in sync by
+  triggers on ``resources``, ranked with ``bm25()``, excerpts from ``snippet()``;
+* Postgres: a generated, weighted ``search_vector`` tsvector column with a GIN
+  index, ranked with ``ts_rank``, excerpts from ``ts_headline``.
+
+``search_resources`` returns only the best few matches and their excerpts.
+Title weighs most, then description, then extracted text.
+"""
+import logging
+import re
+from typing import Any, Dict, List
+
+logger = logging.getLogger(__name__)
+
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "of", "to", "in", "on", "at", "by", "for",
+    "with", "from", "and", "or", "not", "it", "this", "that", "what", "which", "who", "how", "why",
+    "when", "where", "do", "does", "did", "can", "could", "would", "should", "i", "me", "my", "we",
+    "you", "your", "about", "tell", "explain", "please", "give", "show", "find",
+}
+
+_SQLITE_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS resources_fts USING fts5(
+        title, description, extracted_text,
+        content='resources', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS resources_fts_ai AFTER INSERT ON resources BEGIN
+        INSERT INTO resources_fts (rowid, title, description, extracted_text)
+        VALUES (new.id, new.title, new.description, new.extracted_text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS resources_fts_ad AFTER DELETE ON resources BEGIN
+        INSERT INTO resources_fts (resources_fts, rowid, title, description, extracted_text)
+        VALUES ('delete', old.id, old.title, old.description, old.extracted_text);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS resources_fts_au AFTER UPDATE ON resources BEGIN
+        INSERT INTO resources_fts (resources_fts, rowid, title, description, extracted_text)
+        VALUES ('delete', old.id, old.title, old.description, old.extracted_text);
+        INSERT INTO resources_fts (rowid, title, description, extracted_text)
+        VALUES (new.id, new.title, new.description, new.extracted_text);
+    END
+    """,
+    "INSERT INTO resources_fts (resources_fts) VALUES ('rebuild')",
+]
+
+_POSTGRES_DDL = [
+    """
+    ALTER TABLE resources ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(extracted_text, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_resources_search_vector ON resources USING GIN (search_vector)",
+]
+
+
+def resource_search_ddl(is_postgres: bool) -> List[str]:
+    return _POSTGRES_DDL if is_postgres else _SQLITE_DDL
+
+
+def query_terms(text: str, max_terms: int = 12) -> List[str]:
+    """Distinct lowercase words of ``text`` worth searching for, safe to embed in a MATCH / tsquery string."""
+    terms: List[str] = []
+    for word in re.findall(r"[^\W_]+", (text or "").lower()):
+        if len(word) > 1 and word not in _STOPWORDS and word not in terms:
+            terms.append(word)
+    return terms[:max_terms]
+
+
+def search_resources(conn, school_id: int, query: str, is_postgres: bool, limit: int = 3) -> List[Dict[str, Any]]:
+    """Best ``limit`` resources of the school matching any term of ``query``: id, title, snippet."""
+    terms = query_terms(query)
+    if not terms:
+        return []
+    try:
+        if is_postgres:
+            rows = conn.execute(
+                """
+                SELECT id, title,
+                       ts_headline('english', COALESCE(NULLIF(extracted_text, ''), description, ''), q,
+                                   'MaxWords=60, MinWords=25, MaxFragments=3, StartSel="", StopSel=""') AS snippet
+                FROM (
+                    SELECT r.id, r.title, r.description, r.extracted_text, q, ts_rank(r.search_vector, q) AS rank
+                    FROM resources r, to_tsquery('english', ?) AS q
+                    WHERE r.school_id = ? AND r.search_vector @@ q
+                    ORDER BY rank DESC
+                    LIMIT ?
+                ) best
+                ORDER BY rank DESC
+                """,
+                (" | ".join(terms), school_id, limit),
+            ).fetchall()
+        else:
+            rows = conn.execute(
+                """
+                SELECT r.id, r.title,
+                       COALESCE(NULLIF(snippet(resources_fts, 2, '', '', ' ... ', 64), ''), r.description) AS snippet
+                FROM resources_fts
+                JOIN resources r ON r.id = resources_fts.rowid
+                WHERE resources_fts MATCH ? AND r.school_id = ?
+                ORDER BY bm25(resources_fts, 10.0, 3.0, 1.0)
+                LIMIT ?
+                """,
+                (" OR ".join(f'"{t}"' for t in terms), school_id, limit),
+            ).fetchall()
+    except Exception as e:
+        logger.warning(f"[ResourceSearch] Full-text query failed: {e}")
+        return []
+    return [{"id": r["id"], "title": r["title"], "snippet": r["snippet"] or ""} for r in rows]
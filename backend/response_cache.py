@@ -0,0 +1,193 @@
+"""Reuse AI answers for repeated questions.
+
+Entries are keyed on (school_id, context fingerprint, normalised prompt):
+
+* ``school_id`` keeps tenants apart: a lookup never sees another school's entries;
+* the fingerprint is a ``context_fingerprint`` of the endpoint and whatever
+  context shaped the answer (role, grade, library excerpts...), so a different
+  context is a different entry.
+
+Lookups try the exact normalised prompt first. With ``similarity_threshold`` > 0
+they then compare a hashed character-n-gram embedding of the prompt against
+recent prompts in the same scope and reuse the closest answer above the
+threshold ("what are fractions" vs "what is a fraction"), provided both
+prompts contain the same numbers and operators.
+Storage is a ``TTLCache``, so entries expire after ``ttl`` and the least
+recently used are evicted first.
+"""
+import hashlib
+import re
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+try:
+    from backend.ttl_cache import TTLCache
+except Exception:
+    from ttl_cache import TTLCache
+
+_COURTESY_WORDS = {"please", "pls", "plz", "kindly", "thanks", "thx"}
+
+
+# Numbers (with decimals), words, and the symbols that change what is asked:
+# signs, operators, comparisons, brackets and factorial. Sentence punctuation
+# (?, !, commas, quotes, full stops) is dropped.
+_PROMPT_TOKEN_RE = re.compile(r"\d+(?:\.\d+)?|\w+|!=|<=|>=|(?<=\d)!|[-+*/^=<>%()\[\]{}|×÷√≤≥≠±°]")
+# What must be identical for a reworded prompt to reuse an answer.
+_EXACT_PARTS_RE = re.compile(r"\d+(?:\.\d+)?|[^\w\s]+")
+
+
+def normalize_prompt(text: str) -> str:
+    """Lowercase, drop sentence punctuation and courtesy words, collapse whitespace.
+
+    Signs and operators are kept: "7+8", "7-8" and "7*8" are different prompts.
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return " ".join(w for w in _PROMPT_TOKEN_RE.findall(text) if w not in _COURTESY_WORDS)
+
+
+def context_fingerprint(*parts: Any) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8", "replace"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()[:16]
+
+
+# Words that change the phrasing of a question but not what is being asked.
+_FUNCTION_WORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "what", "whats", "how", "does", "do",
+    "can", "could", "would", "you", "me", "to", "of", "for", "in", "on", "about", "and", "or",
+    "tell", "give", "some", "this", "that", "it", "explain", "describe", "define", "simple", "words",
+}
+
+
+def _stem(word: str) -> str:
+    if len(word) > 4 and word.endswith("es") and not word.endswith("ses"):
+        return word[:-2] if word[-3] in "xz" or word.endswith(("ches", "shes")) else word[:-1]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+class HashingEmbedder:
+    """Content words (weight 3) and their character trigrams hashed into ``dim`` buckets, L2-normalised.
+
+    Whole words dominate so that "fraction" and "function" stay apart while
+    "fractions" / "what is a fraction" still land on the same vector.
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def __call__(self, text: str):
+        import numpy as np
+
+        vec = np.zeros(self.dim, dtype=np.float32)
+        words = [_stem(w) for w in text.split() if w not in _FUNCTION_WORDS] or text.split()
+        for word in words:
+            vec[zlib.crc32(word.encode()) % self.dim] += 3.0
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                vec[zlib.crc32(padded[i:i + 3].encode()) % self.dim] += 1.0
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else vec
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        maxsize: int = 2048,
+        ttl: float = 6 * 3600,
+        similarity_threshold: float = 0.0,
+        embed=None,
+        max_prompts_per_scope: int = 256,
+        max_scopes: int = 1024,
+    ):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.similarity_threshold = similarity_threshold
+        self._embed = embed or (HashingEmbedder() if similarity_threshold > 0 else None)
+        self.max_prompts_per_scope = max_prompts_per_scope
+        self.max_scopes = max_scopes
+        # scope -> {normalised prompt: embedding}, newest last
+        self._index: "OrderedDict[Hashable, OrderedDict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0}
+
+    def get(self, school_id: Optional[int], fingerprint: str, prompt: str) -> Optional[str]:
+        scope = (school_id, fingerprint)
+        norm = normalize_prompt(prompt)
+        if not norm:
+            return None
+        value = self._entries.get((scope, norm))
+        if value is not None:
+            self._stats["exact_hits"] += 1
+            return value
+        if self._embed is not None:
+            match = self._nearest(scope, norm)
+            if match is not None:
+                value = self._entries.get((scope, match))
+                if value is not None:
+                    self._stats["similar_hits"] += 1
+                    return value
+        self._stats["misses"] += 1
+        return None
+
+    def _nearest(self, scope: Tuple, norm: str) -> Optional[str]:
+        import numpy as np
+
+        with self._lock:
+            prompts = self._index.get(scope)
+            if not prompts:
+                return None
+            keys = list(prompts.keys())
+            matrix = np.stack(list(prompts.values()))
+        scores = matrix @ self._embed(norm)
+        best = int(scores.argmax())
+        if scores[best] < self.similarity_threshold:
+            return None
+        # "7 minus 8" and "8 minus 7" embed identically; numbers and operators must match in order.
+        if _EXACT_PARTS_RE.findall(keys[best]) != _EXACT_PARTS_RE.findall(norm):
+            return None
+        return keys[best]
+
+    def set(self, school_id: Optional[int], fingerprint: str, prompt: str, response: str) -> None:
+        scope = (school_id, fingerprint)
+        norm = normalize_prompt(prompt)
+        if not norm or not response:
+            return
+        self._entries.set((scope, norm), response)
+        self._stats["stores"] += 1
+        if self._embed is None:
+            return
+        vector = self._embed(norm)
+        with self._lock:
+            prompts = self._index.setdefault(scope, OrderedDict())
+            self._index.move_to_end(scope)
+            prompts[norm] = vector
+            prompts.move_to_end(norm)
+            while len(prompts) > self.max_prompts_per_scope:
+                prompts.popitem(last=False)
+            while len(self._index) > self.max_scopes:
+                self._index.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        with self._lock:
+            self._index.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self._stats["exact_hits"] + self._stats["similar_hits"] + self._stats["misses"]
+        hits = self._stats["exact_hits"] + self._stats["similar_hits"]
+        entries = self._entries.stats()
+        return {
+            **self._stats,
+            "hit_rate": round(hits / lookups, 3) if lookups else None,
+            "size": entries["size"],
+            "max_size": entries["max_size"],
+            "evictions": entries["evictions"],
+            "ttl": entries["ttl"],
+            "similarity_threshold": self.similarity_threshold,
+        }
@@ -0,0 +1,394 @@
+"""Guarded execution of AI-written SQL.
+
+In DATABASE mode the chat endpoints used to hand the model's SQL straight to
+``fetch_data_df``: any statement, any table, no row limit, no timeout. Here a
+query goes through ``guard_select`` and ``GuardedQueryExecutor.run``:
+
+* a tokenizer-level check accepts a single ``SELECT`` (optionally with a
+  ``WITH`` clause) and rejects write/DDL keywords, ``pg_*`` and file functions,
+  parameters, schema-qualified names, and any table that has no scope. Every
+  name in a FROM list or JOIN counts as a table, parenthesised ones included,
+  and a user CTE may not take the name of a scoped table;
+* each referenced table is shadowed by a CTE that only exposes the calling
+  school's rows (and only the columns listed in the scope), e.g.
+  ``students AS (SELECT id, name, ... FROM main.students WHERE school_id = 7)``;
+* the query is wrapped as ``SELECT * FROM (...) LIMIT max_rows + 1`` and run
+  on a read-only connection with a statement timeout (``open_readonly``);
+* rows are fetched ``page_size`` at a time and rendered straight to markdown,
+  stopping at ``max_rows``;
+* results are cached for ``cache_ttl`` seconds per (school_id, normalised SQL).
+"""
+import re
+import time
+from contextlib import AbstractContextManager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+try:
+    from backend.ttl_cache import TTLCache
+except Exception:
+    from ttl_cache import TTLCache
+
+
+class QueryRejected(ValueError):
+    """The statement is not a single, scoped, read-only SELECT."""
+
+
+class QueryTimeout(Exception):
+    """The statement ran longer than the executor's timeout."""
+
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<str>'(?:[^']|'')*')
+  | (?P<qid>"(?:[^"]|"")+")
+  | (?P<num>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<id>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>::|<=|>=|<>|!=|\|\||[(),.;*+\-/%<>=])
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+_WRITE_KEYWORDS = {
+    "insert", "update", "delete", "merge", "upsert", "drop", "alter", "create", "truncate", "grant",
+    "revoke", "copy", "attach", "detach", "pragma", "vacuum", "reindex", "call", "execute", "prepare",
+    "deallocate", "lock", "listen", "notify", "unlisten", "set", "reset", "begin", "commit",
+    "rollback", "savepoint", "release", "into", "load", "import", "do",
+}
+_FORBIDDEN_FUNCTIONS = {
+    "load_extension", "readfile", "writefile", "edit", "fts3_tokenizer", "lo_import", "lo_export",
+    "dblink", "dblink_exec", "set_config", "current_setting", "query_to_xml", "txid_current",
+    "randomblob", "zeroblob",
+}
+_CLAUSE_KEYWORDS = {
+    "where", "group", "order", "having", "limit", "offset", "fetch", "union", "intersect", "except",
+    "window", "returning", "select",
+}
+
+
+@dataclass
+class Token:
+    kind: str
+    value: str   # lowercased for identifiers, verbatim otherwise
+    start: int
+    end: int
+
+
+def tokenize_sql(sql: str) -> List[Token]:
+    tokens: List[Token] = []
+    pos = 0
+    while pos < len(sql):
+        match = _TOKEN_RE.match(sql, pos)
+        if not match:
+            raise QueryRejected(f"Unsupported character {sql[pos]!r} in query")
+        kind = match.lastgroup
+        text = match.group()
+        if kind == "qid":
+            tokens.append(Token("id", text[1:-1].replace('""', '"').lower(), match.start(), match.end()))
+        elif kind == "id":
+            tokens.append(Token("id", text.lower(), match.start(), match.end()))
+        elif kind not in ("ws", "comment"):
+            tokens.append(Token(kind, text, match.start(), match.end()))
+        pos = match.end()
+    return tokens
+
+
+def normalize_sql(tokens: Sequence[Token]) -> str:
+    return " ".join(t.value for t in tokens)
+
+
+@dataclass
+class GuardedQuery:
+    sql: str                    # the SQL actually executed
+    normalized: str             # cache key part: tokens joined, comments and case dropped
+    tables: Set[str] = field(default_factory=set)
+
+
+def _skip_parens(tokens: Sequence[Token], i: int) -> int:
+    """Index just past the parenthesis group opening at tokens[i]."""
+    depth = 0
+    for j in range(i, len(tokens)):
+        if tokens[j].value == "(":
+            depth += 1
+        elif tokens[j].value == ")":
+            depth -= 1
+            if depth == 0:
+                return j + 1
+    raise QueryRejected("Unbalanced parentheses")
+
+
+@dataclass
+class _Cte:
+    name: str
+    start: int   # token span of the CTE (name through closing parenthesis)
+    end: int
+
+
+def _split_with(tokens: Sequence[Token]) -> Tuple[bool, List[_Cte], int]:
+    """(recursive, the user's CTEs in order, index of the main query)."""
+    if tokens[0].value != "with":
+        return False, [], 0
+    i = 1
+    recursive = i < len(tokens) and tokens[i].value == "recursive"
+    if recursive:
+        i += 1
+    ctes: List[_Cte] = []
+    while True:
+        if i >= len(tokens) or tokens[i].kind != "id":
+            raise QueryRejected("Malformed WITH clause")
+        start = i
+        i += 1
+        if i < len(tokens) and tokens[i].value == "(":
+            i = _skip_parens(tokens, i)
+        if i >= len(tokens) or tokens[i].value != "as":
+            raise QueryRejected("Malformed WITH clause")
+        i += 1
+        while i < len(tokens) and tokens[i].value in ("not", "materialized"):
+            i += 1
+        if i >= len(tokens) or tokens[i].value != "(":
+            raise QueryRejected("Malformed WITH clause")
+        i = _skip_parens(tokens, i)
+        ctes.append(_Cte(tokens[start].value, start, i))
+        if i < len(tokens) and tokens[i].value == ",":
+            i += 1
+            continue
+        return recursive, ctes, i
+
+
+def _table_references(tokens: Sequence[Token]) -> List[Tuple[int, str]]:
+    """(token index, name) of every table named in a FROM list or JOIN of any (sub)query.
+
+    A "(" where a table is expected opens a nested FROM list, so
+    ``FROM (students)`` and ``JOIN (students s JOIN guardians g ON ...)``
+    are seen; a parenthesis level becomes a query as soon as it holds a
+    SELECT, wherever that appears in it.
+    """
+    tables: List[Tuple[int, str]] = []
+    # One frame per parenthesis level: [is a query, inside a FROM list, expecting a table name]
+    frames = [[True, False, False]]
+    for i, tok in enumerate(tokens):
+        frame = frames[-1]
+        nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+        if tok.value == "(" and tok.kind == "op":
+            in_from = frame[0] and frame[2] and not (nxt and nxt.value == "values")
+            frame[2] = False
+            frames.append([in_from or bool(nxt and nxt.value in ("select", "with")), in_from, in_from])
+            continue
+        if tok.value == ")" and tok.kind == "op":
+            if len(frames) > 1:
+                frames.pop()
+            continue
+        if tok.kind == "id" and tok.value == "select":
+            frame[0] = True
+        if not frame[0]:
+            continue
+        if tok.kind == "id" and tok.value in ("from", "join"):
+            frame[1] = tok.value == "from" or frame[1]
+            frame[2] = True
+            continue
+        if tok.kind == "id" and tok.value in ("on", "using"):
+            # A join condition ends at the next JOIN or top-level comma of the same FROM list.
+            frame[2] = False
+            continue
+        if tok.kind == "id" and tok.value in _CLAUSE_KEYWORDS:
+            frame[1] = frame[2] = False
+            continue
+        if tok.value == "," and frame[1]:
+            frame[2] = True
+            continue
+        if frame[2]:
+            if tok.kind == "id" and tok.value in ("lateral", "only"):
+                continue
+            frame[2] = False
+            if tok.kind != "id":
+                raise QueryRejected("Unsupported FROM clause")
+            if nxt is not None and nxt.value == ".":
+                raise QueryRejected("Schema-qualified table names are not allowed")
+            if nxt is not None and nxt.value == "(":
+                raise QueryRejected(f"Table function '{tok.value}' is not allowed")
+            tables.append((i, tok.value))
+    return tables
+
+
+def _visible_ctes(ctes: Sequence[_Cte], recursive: bool, index: int) -> Set[str]:
+    """CTE names a table reference at token ``index`` resolves to.
+
+    A CTE body only sees the CTEs defined before it (and itself, with
+    RECURSIVE); the main query sees them all. Anything else is a real table.
+    """
+    for n, cte in enumerate(ctes):
+        if cte.start <= index < cte.end:
+            return {c.name for c in ctes[:n + 1 if recursive else n]}
+    return {c.name for c in ctes}
+
+
+def guard_select(
+    sql: str,
+    scopes: Dict[str, str],
+    school_id: int,
+    max_rows: int,
+    schema: str = "main",
+    allowed: Optional[Iterable[str]] = None,
+) -> GuardedQuery:
+    """Validate ``sql`` and rewrite it into a school-scoped, row-limited statement.
+
+    ``scopes`` maps a table name to the SELECT that exposes it, written with
+    ``{schema}`` and ``{school_id}`` placeholders. ``allowed`` narrows the
+    usable tables to a subset of the scopes.
+    """
+    tokens = tokenize_sql(sql or "")
+    while tokens and tokens[-1].value == ";":
+        tokens.pop()
+    if not tokens:
+        raise QueryRejected("Empty query")
+    if tokens[0].value not in ("select", "with"):
+        raise QueryRejected("Only SELECT queries are allowed")
+    for i, tok in enumerate(tokens):
+        if tok.kind == "op" and tok.value == ";":
+            raise QueryRejected("Only a single statement is allowed")
+        if tok.kind != "id":
+            continue
+        if tok.value in _WRITE_KEYWORDS and sql[tok.start] != '"':
+            raise QueryRejected(f"'{tok.value.upper()}' is not allowed in a read-only query")
+        if tok.value == "table" and sql[tok.start] != '"':
+            # Postgres ``TABLE students`` reads a table without a FROM clause.
+            raise QueryRejected("'TABLE' queries are not allowed; use SELECT ... FROM")
+        is_call = i + 1 < len(tokens) and tokens[i + 1].value == "("
+        if is_call and (tok.value in _FORBIDDEN_FUNCTIONS or tok.value.startswith(("pg_", "sqlite_"))):
+            raise QueryRejected(f"Function '{tok.value}' is not allowed")
+        if tok.value.startswith(("pg_", "sqlite_")) or tok.value in ("information_schema", "sqlite_master"):
+            raise QueryRejected(f"System catalog '{tok.value}' is not available")
+
+    recursive, user_ctes, main_start = _split_with(tokens)
+    for cte in user_ctes:
+        if cte.name in scopes:
+            raise QueryRejected(f"CTE name '{cte.name}' is reserved for the table it would shadow")
+    usable = set(scopes) if allowed is None else set(allowed) & set(scopes)
+    referenced: Set[str] = set()
+    for index, name in _table_references(tokens):
+        if name in _visible_ctes(user_ctes, recursive, index):
+            continue
+        if name not in usable:
+            raise QueryRejected(f"Table '{name}' is not available for AI queries")
+        referenced.add(name)
+
+    ctes = [
+        f"{name} AS ({scopes[name].format(schema=schema, school_id=int(school_id))})"
+        for name in sorted(referenced)
+    ]
+    if user_ctes:
+        ctes.append(sql[tokens[user_ctes[0].start].start:tokens[main_start - 1].end])
+    main = sql[tokens[main_start].start:tokens[-1].end]
+    prefix = ("WITH RECURSIVE " if recursive else "WITH ") + ",\n".join(ctes) + "\n" if ctes else ""
+    wrapped = f"{prefix}SELECT * FROM (\n{main}\n) AS ai_query LIMIT {int(max_rows) + 1}"
+    return GuardedQuery(sql=wrapped, normalized=normalize_sql(tokens), tables=referenced)
+
+
+@dataclass
+class QueryResult:
+    columns: List[str]
+    markdown_rows: List[str]
+    truncated: bool = False
+    elapsed_ms: float = 0.0
+    cached: bool = False
+
+    @property
+    def row_count(self) -> int:
+        return len(self.markdown_rows)
+
+    def to_markdown(self) -> str:
+        if not self.markdown_rows:
+            return "No results found."
+        header = "| " + " | ".join(self.columns) + " |"
+        separator = "| " + " | ".join(["---"] * len(self.columns)) + " |"
+        table = f"\n{header}\n{separator}\n" + "\n".join(self.markdown_rows) + "\n"
+        if self.truncated:
+            table += f"\n_Showing the first {self.row_count} rows._\n"
+        return table
+
+
+def _cell(value: Any, max_chars: int) -> str:
+    text = "" if value is None else str(value)
+    text = text.replace("\n", " ").replace("|", "\\|")
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+class GuardedQueryExecutor:
+    """Runs guarded AI queries.
+
+    ``open_readonly(timeout_ms)`` returns a context manager yielding a DB-API
+    cursor on a read-only connection whose statements are cancelled after
+    ``timeout_ms`` (raising ``QueryTimeout``).
+    """
+
+    def __init__(
+        self,
+        open_readonly: Callable[[int], AbstractContextManager],
+        scopes: Dict[str, str],
+        schema: str = "main",
+        max_rows: int = 200,
+        page_size: int = 50,
+        timeout_ms: int = 3000,
+        max_cell_chars: int = 200,
+        cache_ttl: float = 60.0,
+        cache_size: int = 256,
+    ):
+        self._open_readonly = open_readonly
+        self.scopes = scopes
+        self.schema = schema
+        self.max_rows = max_rows
+        self.page_size = page_size
+        self.timeout_ms = timeout_ms
+        self.max_cell_chars = max_cell_chars
+        self._cache = TTLCache(maxsize=cache_size if cache_ttl > 0 else 0, ttl=cache_ttl)
+        self._stats = {"queries": 0, "rejected": 0, "timeouts": 0, "truncated": 0}
+
+    def run(self, sql: str, school_id: int, allowed: Optional[Iterable[str]] = None) -> QueryResult:
+        """Raises QueryRejected for statements outside the sandbox, QueryTimeout when cancelled."""
+        try:
+            guarded = guard_select(sql, self.scopes, school_id, self.max_rows, self.schema, allowed)
+        except QueryRejected:
+            self._stats["rejected"] += 1
+            raise
+        key = (int(school_id), guarded.normalized)
+        cached = self._cache.get(key)
+        if cached is not None:
+            return QueryResult(cached.columns, cached.markdown_rows, cached.truncated, 0.0, cached=True)
+
+        self._stats["queries"] += 1
+        started = time.perf_counter()
+        rows: List[str] = []
+        truncated = False
+        try:
+            with self._open_readonly(self.timeout_ms) as cursor:
+                cursor.execute(guarded.sql)
+                columns = [d[0] for d in cursor.description or []]
+                while not truncated:
+                    page = cursor.fetchmany(self.page_size)
+                    if not page:
+                        break
+                    for row in page:
+                        if len(rows) == self.max_rows:
+                            truncated = True
+                            break
+                        rows.append("| " + " | ".join(_cell(v, self.max_cell_chars) for v in row) + " |")
+        except QueryTimeout:
+            self._stats["timeouts"] += 1
+            raise
+        if truncated:
+            self._stats["truncated"] += 1
+        result = QueryResult(columns, rows, truncated, (time.perf_counter() - started) * 1000)
+        self._cache.set(key, result)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        cache = self._cache.stats()
+        return {
+            **self._stats,
+            "cache_hits": cache["hits"],
+            "cache_size": cache["size"],
+            "max_rows": self.max_rows,
+            "timeout_ms": self.timeout_ms,
+        }
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The backend modules import their siblings either as ``backend.x`` or as
+# top-level ``x``; put the backend directory on the path for the latter.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,34 @@
+import pytest
+
+from batch_grading import GradingItem, normalize_answer
+
+
+@pytest.mark.parametrize("a, b", [
+    ("-3", "3"),
+    ("x > 5", "x < 5"),
+    ("a+b", "a-b"),
+    ("2/3", "2 3"),
+    ("1.5", "15"),
+    ("x^2", "x2"),
+])
+def test_different_answers_stay_different(a, b):
+    assert normalize_answer(a) != normalize_answer(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Paris", "paris"),
+    ("  The   Nile\n", "the nile"),
+    ("Photosynthesis.", "photosynthesis"),
+    ("ｘ＋１", "x+1"),
+])
+def test_case_whitespace_and_final_full_stop_are_ignored(a, b):
+    assert normalize_answer(a) == normalize_answer(b)
+
+
+def test_ellipsis_is_kept():
+    assert normalize_answer("and so on...") == "and so on..."
+
+
+def test_items_with_opposite_signs_get_different_keys():
+    question = "Solve x + 3 = 0"
+    assert GradingItem(1, question, "-3").key != GradingItem(2, question, "3").key
@@ -0,0 +1,34 @@
+import sqlite3
+import threading
+
+from db_pool import ConnectionPool
+
+
+def _pool(**kwargs):
+    return ConnectionPool(
+        lambda: sqlite3.connect(":memory:", check_same_thread=False),
+        minconn=0, healthcheck_after=None, **kwargs,
+    )
+
+
+def test_leaked_connection_can_be_returned_while_the_pool_lock_is_held():
+    pool = _pool(maxconn=1, timeout=1)
+    raw = pool.getconn()
+    # A finalizer may run on a thread that is inside the pool.
+    with pool._cond:
+        pool.return_leaked(raw)
+
+    assert pool.getconn() is raw
+    assert pool.stats()["leaked"] == 1
+
+
+def test_blocked_checkout_picks_up_a_leaked_connection():
+    pool = _pool(maxconn=1, timeout=5)
+    pool.leak_poll_interval = 0.05
+    raw = pool.getconn()
+    timer = threading.Timer(0.1, pool.return_leaked, (raw,))
+    timer.start()
+
+    assert pool.getconn() is raw
+    assert pool.stats()["in_use"] == 1
+    timer.join()
@@ -0,0 +1,57 @@
+import sqlite3
+
+from outbox import OutboxDispatcher, enqueue, outbox_ddl
+
+
+class _Connections:
+    """Opens sqlite connections on one file and counts how many are open."""
+
+    def __init__(self, path):
+        self.path = path
+        self.open = 0
+
+    def __call__(self):
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        self.open += 1
+        close = conn.close
+
+        def tracked_close():
+            self.open -= 1
+            close()
+
+        return _Tracked(conn, tracked_close)
+
+
+class _Tracked:
+    def __init__(self, conn, close):
+        self._conn = conn
+        self.close = close
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def test_external_channel_is_delivered_without_a_connection(tmp_path):
+    connect = _Connections(str(tmp_path / "outbox.db"))
+    conn = connect()
+    for statement in outbox_ddl("INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+    enqueue(conn, "email", [(None, "a@school.test", "Hi", "body"), (None, "b@school.test", "Hi", "body")])
+    conn.commit()
+    conn.close()
+
+    seen = []
+
+    def send_emails(handler_conn, items):
+        seen.append((handler_conn, connect.open))
+        return {item["id"]: None for item in items}
+
+    dispatcher = OutboxDispatcher(connect, {"email": send_emails}, external_channels=("email",))
+    assert dispatcher.dispatch_once() == 2
+
+    assert seen == [(None, 0)]
+    conn = connect()
+    statuses = [r["status"] for r in conn.execute("SELECT status FROM notification_outbox")]
+    conn.close()
+    assert statuses == ["sent", "sent"]
@@ -0,0 +1,45 @@
+import sqlite3
+
+from quiz_feedback import QuizFeedbackWorker, enqueue, feedback_jobs_ddl
+
+
+def _worker(path, **kwargs):
+    def connect():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    conn = connect()
+    for statement in feedback_jobs_ddl("INTEGER PRIMARY KEY AUTOINCREMENT"):
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+    return QuizFeedbackWorker(connect, None, None, None, **kwargs), connect
+
+
+def _enqueue(connect, school_id, count):
+    conn = connect()
+    for attempt_id in range(count):
+        enqueue(conn, attempt_id, None, "s", school_id)
+    conn.commit()
+    conn.close()
+
+
+def test_one_school_cannot_fill_the_batch(tmp_path):
+    worker, connect = _worker(str(tmp_path / "jobs.db"), batch_size=5, per_school=2)
+    _enqueue(connect, 1, 30)
+    _enqueue(connect, 2, 1)
+    _enqueue(connect, 3, 3)
+
+    schools = [job["school_id"] for job in worker._claim()]
+
+    assert sorted(schools) == [1, 1, 2, 3, 3]
+
+
+def test_remaining_jobs_are_claimed_by_later_passes(tmp_path):
+    worker, connect = _worker(str(tmp_path / "jobs.db"), batch_size=20, per_school=2)
+    _enqueue(connect, 1, 5)
+
+    claimed = [len(worker._claim()) for _ in range(4)]
+
+    assert claimed == [2, 2, 1, 0]
@@ -0,0 +1,42 @@
+import pytest
+
+from recommendation_model import RecommendationModelManager
+
+
+def _manager(load):
+    return RecommendationModelManager(load, lambda watermark: 0, {}, path="", retry_base=60, retry_max=600)
+
+
+def test_failed_training_is_reported_with_a_retry_time():
+    def load():
+        raise RuntimeError("database unavailable")
+
+    manager = _manager(load)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            manager.train_now()
+
+    status = manager.status()
+    assert manager.state == "failed"
+    assert status["last_error"] == "database unavailable"
+    assert status["consecutive_failures"] == 2
+    assert 60 < manager.retry_in() <= 2 * 60 * 1.2
+
+
+def test_a_later_run_clears_the_failure():
+    outcomes = [RuntimeError("database unavailable"), None]
+
+    def load():
+        outcome = outcomes.pop(0)
+        if outcome:
+            raise outcome
+        return None
+
+    manager = _manager(load)
+    with pytest.raises(RuntimeError):
+        manager.train_now()
+    manager.train_now()
+
+    assert manager.state == "insufficient_data"
+    assert manager.retry_in() is None
+    assert manager.status()["last_error"] is None
@@ -0,0 +1,43 @@
+import pytest
+
+from response_cache import ResponseCache, normalize_prompt
+
+
+@pytest.mark.parametrize("a, b", [
+    ("What is 7+8?", "what is 7-8"),
+    ("what is 7-8", "what is 7*8"),
+    ("what is 7*8", "what is 7/8"),
+    ("is x > 5", "is x < 5"),
+    ("is x >= 5", "is x = 5"),
+    ("solve -3 + x", "solve 3 + x"),
+    ("(2+3)*4", "2+3*4"),
+    ("what is 1.5 squared", "what is 15 squared"),
+    ("what is 5!", "what is 5"),
+])
+def test_different_prompts_get_different_keys(a, b):
+    assert normalize_prompt(a) != normalize_prompt(b)
+
+
+@pytest.mark.parametrize("a, b", [
+    ("What is 7+8?", "what is 7 + 8"),
+    ("Please explain photosynthesis!", "explain photosynthesis"),
+    ("What's a fraction?", "what's a fraction"),
+    ("  What   is  a noun.", "what is a noun"),
+])
+def test_rewording_noise_is_ignored(a, b):
+    assert normalize_prompt(a) == normalize_prompt(b)
+
+
+def test_cached_sum_is_not_returned_for_a_difference():
+    cache = ResponseCache(ttl=60)
+    cache.set(1, "fp", "What is 7+8?", "15")
+    assert cache.get(1, "fp", "what is 7 + 8") == "15"
+    assert cache.get(1, "fp", "what is 7-8") is None
+    assert cache.get(1, "fp", "what is 7*8") is None
+
+
+def test_similar_lookup_requires_same_operators():
+    cache = ResponseCache(ttl=60, similarity_threshold=0.5)
+    cache.set(1, "fp", "what is 7 + 8", "15")
+    assert cache.get(1, "fp", "what is 7 - 8") is None
+    assert cache.get(1, "fp", "tell me what 7 + 8 is") == "15"
@@ -0,0 +1,134 @@
+import sqlite3
+
+import pytest
+
+from sql_guard import QueryRejected, guard_select
+
+SCOPES = {
+    "students": "SELECT id, name, school_id FROM {schema}.students WHERE school_id = {school_id}",
+    "guardians": "SELECT g.student_id, g.phone FROM {schema}.guardians g JOIN {schema}.students s ON s.id = g.student_id WHERE s.school_id = {school_id}",
+    "groups": "SELECT id, name, school_id FROM {schema}.groups WHERE school_id = {school_id}",
+}
+LEARNER_TABLES = {"students", "groups"}
+
+
+@pytest.fixture
+def db():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(
+        """
+        CREATE TABLE students (id INTEGER PRIMARY KEY, name TEXT, password TEXT, school_id INTEGER);
+        CREATE TABLE guardians (student_id INTEGER, phone TEXT);
+        CREATE TABLE groups (id INTEGER PRIMARY KEY, name TEXT, school_id INTEGER);
+        INSERT INTO students VALUES (1, 'Ada', 'secret-1', 1), (2, 'Ben', 'secret-2', 2);
+        INSERT INTO guardians VALUES (1, '555-0001'), (2, '555-0002');
+        INSERT INTO groups VALUES (1, 'Maths', 1), (2, 'Art', 2);
+        """
+    )
+    yield conn
+    conn.close()
+
+
+def run(db, sql, allowed=None):
+    return db.execute(guard_select(sql, SCOPES, 1, 100, allowed=allowed).sql).fetchall()
+
+
+def test_plain_query_is_scoped_to_the_school(db):
+    assert run(db, "SELECT name FROM students ORDER BY id") == [("Ada",)]
+
+
+def test_parenthesised_table_is_scoped(db):
+    guarded = guard_select("SELECT name, school_id FROM (students)", SCOPES, 1, 100)
+    assert guarded.tables == {"students"}
+    assert db.execute(guarded.sql).fetchall() == [("Ada", 1)]
+
+
+def test_parenthesised_table_cannot_read_unscoped_columns(db):
+    with pytest.raises(sqlite3.OperationalError):
+        run(db, "SELECT password, school_id FROM (students)")
+
+
+def test_parenthesised_join_is_scoped():
+    guarded = guard_select(
+        "SELECT s.name, g.phone FROM groups JOIN (students s JOIN guardians g ON g.student_id = s.id) ON 1 = 1",
+        SCOPES, 1, 100,
+    )
+    assert guarded.tables == {"groups", "students", "guardians"}
+
+
+def test_parenthesised_join_respects_allowed_tables():
+    with pytest.raises(QueryRejected, match="guardians"):
+        guard_select(
+            "SELECT g.phone FROM groups JOIN (students s JOIN guardians g ON g.student_id = s.id) ON 1 = 1",
+            SCOPES, 1, 100, allowed=LEARNER_TABLES,
+        )
+
+
+def test_table_after_comma_in_parenthesised_from_list():
+    with pytest.raises(QueryRejected, match="guardians"):
+        guard_select("SELECT * FROM groups, (students, guardians)", SCOPES, 1, 100, allowed=LEARNER_TABLES)
+
+
+def test_select_after_a_nested_parenthesis_is_still_checked():
+    with pytest.raises(QueryRejected, match="guardians"):
+        guard_select(
+            "SELECT name FROM students WHERE id IN ((SELECT 1) UNION SELECT student_id FROM guardians)",
+            SCOPES, 1, 100, allowed=LEARNER_TABLES,
+        )
+
+
+def test_values_list_in_from_is_not_a_table(db):
+    assert run(db, "SELECT v.column1 FROM (VALUES (1), (2)) AS v") == [(1,), (2,)]
+
+
+def test_cte_shadowing_a_scoped_table_is_rejected():
+    with pytest.raises(QueryRejected, match="students"):
+        guard_select(
+            "WITH x AS (SELECT password FROM students), students AS (SELECT 1) SELECT * FROM x",
+            SCOPES, 1, 100,
+        )
+
+
+def test_earlier_cte_cannot_reach_a_table_through_a_later_cte_name():
+    # Postgres resolves "users" in x to the real table: a non-recursive CTE
+    # cannot see the CTEs after it.
+    with pytest.raises(QueryRejected, match="users"):
+        guard_select("WITH x AS (SELECT * FROM users), users AS (SELECT 1) SELECT * FROM x", SCOPES, 1, 100)
+
+
+def test_cte_referencing_an_earlier_cte_is_allowed(db):
+    sql = "WITH a AS (SELECT id, name FROM students), b AS (SELECT name FROM a) SELECT name FROM b"
+    assert run(db, sql) == [("Ada",)]
+
+
+def test_table_statement_is_rejected():
+    with pytest.raises(QueryRejected, match="TABLE"):
+        guard_select("SELECT * FROM (TABLE students) t", SCOPES, 1, 100)
+
+
+def test_unscoped_table_is_rejected():
+    with pytest.raises(QueryRejected):
+        guard_select("SELECT * FROM users", SCOPES, 1, 100)
+
+
+def test_function_with_from_keyword_is_not_a_table(db):
+    assert run(db, "SELECT substr(name, 1, 1) FROM students") == [("A",)]
+    guard_select("SELECT extract(year from date) FROM students", SCOPES, 1, 100)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT u.password FROM groups g JOIN students s ON 1=1, users u",
+    "SELECT u.password FROM groups g JOIN students s USING (id), users u",
+    "SELECT u.password FROM groups g JOIN students s ON g.id = s.id AND s.id IN (1, 2), users u",
+    "SELECT * FROM students s JOIN groups g ON g.id = s.id, (users)",
+])
+def test_table_after_join_condition_is_checked(sql):
+    with pytest.raises(QueryRejected, match="users"):
+        guard_select(sql, SCOPES, 1, 100)
+
+
+def test_comma_join_after_join_condition_is_scoped(db):
+    sql = "SELECT s.name, g.name FROM students s JOIN groups g ON g.school_id = s.school_id, guardians gu WHERE gu.student_id = s.id"
+    guarded = guard_select(sql, SCOPES, 1, 100)
+    assert guarded.tables == {"students", "groups", "guardians"}
+    assert db.execute(guarded.sql).fetchall() == [("Ada", "Maths")]
@@ -0,0 +1,307 @@
+"""Text extraction for uploaded files, deduplicated by content hash.
+
+PDF uploads (chat attachments, quiz / lesson-plan reference material, LMS
+modules, library resources) used to be parsed with pypdf inside the request,
+again on every upload of the same file. ``TextExtractionService`` instead:
+
+* hashes the uploaded bytes (sha256) and returns text already extracted for
+  that hash from the ``extracted_texts`` table;
+* otherwise parses the PDF in its own worker process (at most ``max_workers``
+  at a time), off the event loop and outside the GIL, reading at most
+  ``max_pages`` pages and stopping at ``timeout`` seconds (the text read so
+  far is kept and marked truncated);
+* kills a worker still running after ``hard_timeout`` seconds (a single page
+  can take arbitrarily long) and records the file as failed;
+* runs one extraction per hash: concurrent uploads of the same file share it.
+
+Workers are forked from a forkserver that has pypdf preloaded, so starting
+one per file is cheap; platforms without forkserver fall back to spawn.
+
+``submit`` returns a ``concurrent.futures.Future``; callers either wait on it
+(``wait``, bounded) or keep the hash and poll ``status`` later. Failures are
+stored too, so a broken file is not re-parsed on every upload.
+
+Plain-text files are decoded inline and not stored.
+"""
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from dataclasses import asdict, dataclass, replace
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    from backend.pdf_worker import extract_pdf_worker
+    from backend.ttl_cache import TTLCache
+except Exception:
+    from pdf_worker import extract_pdf_worker
+    from ttl_cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = (".txt", ".md", ".csv")
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_PENDING = "pending"
+STATUS_UNKNOWN = "unknown"
+
+
+def extraction_ddl(pk_def: str) -> List[str]:
+    return [
+        f"""
+        CREATE TABLE IF NOT EXISTS extracted_texts (
+            id {pk_def},
+            content_hash TEXT NOT NULL UNIQUE,
+            filename TEXT,
+            status TEXT NOT NULL,
+            text TEXT,
+            pages INTEGER DEFAULT 0,
+            truncated BOOLEAN DEFAULT FALSE,
+            error TEXT,
+            created_at TEXT
+        )
+        """,
+    ]
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_kind(filename: Optional[str]) -> Optional[str]:
+    """'pdf', 'text', or None when the type is not extractable."""
+    name = (filename or "").lower()
+    if name.endswith(".pdf"):
+        return "pdf"
+    if name.endswith(TEXT_EXTENSIONS):
+        return "text"
+    return None
+
+
+class WorkerCrashed(RuntimeError):
+    """The worker process died without a result (e.g. out of memory): not the file's fault."""
+
+
+@dataclass
+class ExtractionResult:
+    content_hash: str
+    status: str
+    text: str = ""
+    pages: int = 0
+    truncated: bool = False
+    error: Optional[str] = None
+    cached: bool = False
+
+    def to_dict(self, include_text: bool = True) -> Dict[str, Any]:
+        data = asdict(self)
+        if not include_text:
+            data.pop("text")
+            data["chars"] = len(self.text)
+        return data
+
+
+class TextExtractionService:
+    def __init__(
+        self,
+        connect: Callable[[], Any],
+        max_workers: int = 2,
+        max_pages: int = 50,
+        timeout: float = 20.0,
+        max_chars: int = 200_000,
+        hard_timeout: Optional[float] = None,
+        max_bytes: int = 20 * 1024 * 1024,
+    ):
+        self._connect = connect
+        self.max_workers = max_workers
+        self.max_pages = max_pages
+        self.timeout = timeout
+        self.max_chars = max_chars
+        self.hard_timeout = hard_timeout if hard_timeout is not None else timeout + 10
+        self.max_bytes = max_bytes
+        # One thread per running worker process; it waits for the result and enforces hard_timeout.
+        self._threads: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._mp = None
+        self._processes: set = set()
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, concurrent.futures.Future] = {}
+        self._recent = TTLCache(maxsize=64, ttl=600)
+        self._stats = {"submitted": 0, "cache_hits": 0, "joined": 0, "extracted": 0, "failed": 0, "killed": 0}
+
+    def _executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._threads is None:
+            self._threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="extract")
+        return self._threads
+
+    def _context(self):
+        if self._mp is None:
+            # Not fork: the API process runs threads, which fork() does not copy safely.
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                ctx = multiprocessing.get_context("forkserver")
+                ctx.set_forkserver_preload(["pypdf", extract_pdf_worker.__module__])
+            else:
+                ctx = multiprocessing.get_context("spawn")
+            self._mp = ctx
+        return self._mp
+
+    def _run_worker(self, data: bytes) -> Tuple[str, int, bool]:
+        """Parse ``data`` in a fresh worker process, killing it after ``hard_timeout`` seconds."""
+        ctx = self._context()
+        receiver, sender = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=extract_pdf_worker, args=(sender, data, self.max_pages, self.timeout, self.max_chars), daemon=True)
+        proc.start()
+        sender.close()
+        with self._lock:
+            self._processes.add(proc)
+        try:
+            if not receiver.poll(self.hard_timeout):
+                self._stats["killed"] += 1
+                proc.kill()
+                raise TimeoutError(f"Extraction did not finish within {self.hard_timeout:g}s")
+            try:
+                status, payload = receiver.recv()
+            except EOFError:
+                proc.join(1)
+                raise WorkerCrashed(f"Extraction worker exited with code {proc.exitcode}")
+            if status != "ok":
+                raise RuntimeError(payload)
+            return payload
+        finally:
+            proc.join(1)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+            receiver.close()
+            with self._lock:
+                self._processes.discard(proc)
+
+    def lookup(self, digest: str) -> Optional[ExtractionResult]:
+        result = self._recent.get(digest)
+        if result is not None:
+            return replace(result, cached=True)
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT status, text, pages, truncated, error FROM extracted_texts WHERE content_hash = ?", (digest,)
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        result = ExtractionResult(digest, row["status"], row["text"] or "", row["pages"] or 0, bool(row["truncated"]), row["error"], cached=True)
+        self._recent.set(digest, result)
+        return result
+
+    def status(self, digest: str) -> ExtractionResult:
+        with self._lock:
+            if digest in self._in_flight:
+                return ExtractionResult(digest, STATUS_PENDING)
+        return self.lookup(digest) or ExtractionResult(digest, STATUS_UNKNOWN)
+
+    def submit(self, data: bytes, filename: Optional[str]) -> concurrent.futures.Future:
+        """Future of the ExtractionResult for ``data``; already resolved on a cache hit."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        kind = file_kind(filename)
+        digest = content_hash(data)
+        if len(data) > self.max_bytes:
+            future.set_result(ExtractionResult(digest, STATUS_FAILED, error=f"File is larger than {self.max_bytes} bytes"))
+            return future
+        if kind != "pdf":
+            if kind == "text":
+                text = data.decode("utf-8", errors="ignore")
+                future.set_result(ExtractionResult(digest, STATUS_DONE, text[:self.max_chars], 0, len(text) > self.max_chars))
+            else:
+                future.set_result(ExtractionResult(digest, STATUS_FAILED, error=f"Unsupported file type: {filename}"))
+            return future
+
+        cached = self.lookup(digest)
+        if cached is not None:
+            self._stats["cache_hits"] += 1
+            future.set_result(cached)
+            return future
+        with self._lock:
+            running = self._in_flight.get(digest)
+            if running is not None:
+                self._stats["joined"] += 1
+                return running
+            self._in_flight[digest] = future
+            executor = self._executor()
+        self._stats["submitted"] += 1
+        job = executor.submit(self._run_worker, data)
+        job.add_done_callback(lambda done: self._finish(digest, filename, done, future))
+        return future
+
+    def _finish(self, digest: str, filename: Optional[str], job: concurrent.futures.Future, future: concurrent.futures.Future) -> None:
+        store = True
+        try:
+            text, pages, truncated = job.result()
+            result = ExtractionResult(digest, STATUS_DONE, text, pages, truncated)
+            self._stats["extracted"] += 1
+        except WorkerCrashed as e:
+            # Not the file's fault, so don't remember it.
+            logger.error(f"[Extraction] Worker crashed while parsing {filename or digest[:12]}: {e}")
+            result = ExtractionResult(digest, STATUS_FAILED, error="Extraction worker crashed")
+            store = False
+        except Exception as e:
+            logger.warning(f"[Extraction] {filename or digest[:12]} failed: {e}")
+            result = ExtractionResult(digest, STATUS_FAILED, error=str(e)[:500])
+            self._stats["failed"] += 1
+        if store:
+            try:
+                self._store(filename, result)
+            except Exception as e:
+                logger.error(f"[Extraction] Could not store result for {digest[:12]}: {e}")
+            self._recent.set(digest, result)
+        with self._lock:
+            self._in_flight.pop(digest, None)
+        future.set_result(result)
+
+    def _store(self, filename: Optional[str], result: ExtractionResult) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                """
+                INSERT INTO extracted_texts (content_hash, filename, status, text, pages, truncated, error, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (content_hash) DO UPDATE SET
+                    status = excluded.status, text = excluded.text, pages = excluded.pages,
+                    truncated = excluded.truncated, error = excluded.error
+                """,
+                (result.content_hash, os.path.basename(filename or "")[:255], result.status, result.text,
+                 result.pages, result.truncated, result.error, datetime.now().isoformat()),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    @staticmethod
+    async def wait(future: concurrent.futures.Future, timeout: Optional[float]) -> Optional[ExtractionResult]:
+        """The result, or None if it is not ready within ``timeout`` seconds (0 = don't wait)."""
+        if future.done():
+            return future.result()
+        if not timeout:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def shutdown(self) -> None:
+        if self._threads is not None:
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._threads = None
+        with self._lock:
+            running = list(self._processes)
+        for proc in running:
+            proc.kill()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._in_flight)
+        return {**self._stats, "in_flight": in_flight, "max_workers": self.max_workers,
+                "max_pages": self.max_pages, "timeout": self.timeout, "hard_timeout": self.hard_timeout,
+                "max_bytes": self.max_bytes}